@@ -320,6 +320,20 @@ MAPSERVER_HOST = env('MAPSERVER_HOST', default='localhost:8080')
 MAPFILE_DIR = env('MAPFILE_DIR', default='/dev/shm')
 URL_MAPFILE_DIR = env('URL_MAPFILE_DIR', default='/dev/shm')
 
+# Threads, shared by the requests of a process, used by the Query UI to generate independent options
+# concurrently, each on its own database connection, and the seconds an option may take before the
+# response is returned without it and its queries are stopped. With 0 workers options are generated
+# one after another within the request's transaction (as in tests).
+STOQS_OPTIONS_WORKERS = env.int('STOQS_OPTIONS_WORKERS', default=0)
+STOQS_OPTION_TIMEOUT = env.float('STOQS_OPTION_TIMEOUT', default=60.0)
+
+# Seconds that the Query UI options in utils.STOQSQManager.CACHED_OPTIONS are cached (0 to not cache them)
+STOQS_OPTION_CACHE_TIMEOUT = env.int('STOQS_OPTION_CACHE_TIMEOUT', default=60 * 15)
+
+# Bytes of section and parameter-parameter PNGs kept in MEDIA_ROOT for reuse by identical plot requests,
+# least recently used plots are removed beyond this (0 to not cache them)
+STOQS_RENDER_CACHE_BYTES = env.int('STOQS_RENDER_CACHE_BYTES', default=500 * 1024 * 1024)
+
 
 # STOQS specific logging
 LOGGING['formatters'] = {
@@ -31,27 +31,35 @@ except AttributeError:
     pass
 
 import DAPloaders
-import requests
 import urllib
 
 from SampleLoaders import SeabirdLoader, SubSamplesLoader, ParentSamplesLoader
 from loaders import LoadScript, FileNotFound
 from stoqs.models import InstantPoint
+from django.db import connections
 from django.db.models import Max
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime, timedelta
 from argparse import Namespace
-from lxml import etree
 from nettow import NetTow
 from planktonpump import PlanktonPump
-from thredds_crawler.crawl import Crawl
+from loaders.catalog import CatalogCrawler, SKIPS
 import logging
 import matplotlib as mpl
 mpl.use('Agg')               # Force matplotlib to not use any Xwindows backend
 import matplotlib.pyplot as plt
 from matplotlib.colors import rgb2hex
 import numpy as np
+import traceback
 import webob
 
+logger = logging.getLogger(__name__)
+
+
+class ParallelLoadError(Exception):
+    pass
+
+
 def getStrideText(stride):
     '''
     Format stride into a string to be appended to the Activity name, if stride==1 return empty string
@@ -61,6 +69,53 @@ def getStrideText(stride):
     else:
         return ' (stride=%d)' % stride
 
+def load_dorado_url(url, aname, campaignName, campaignDescription, pname, color, parms,
+                    dbAlias, stride, grdTerrain, command_line_args):
+    '''Load one Dorado survey and its Gulper samples. Module level function so that
+    it can be executed in a worker process by CANONLoader._execute_loads().
+    '''
+    try:
+        DAPloaders.runDoradoLoader(url, campaignName, campaignDescription, aname, 
+                                   pname, color, 'auv', 'AUV mission', 
+                                   parms, dbAlias, stride, grdTerrain=grdTerrain,
+                                   plotTimeSeriesDepth=0.0, command_line_args=command_line_args)
+        psl = ParentSamplesLoader('', '', dbAlias=dbAlias)
+        psl.load_gulps(aname, url.split('/')[-1], dbAlias)
+    except DAPloaders.DuplicateData as e:
+        logger.warn(str(e))
+        logger.info(f"Skipping load of {url}")
+
+def load_lrauv_url(url, aname, campaignName, campaignDescription, pname, color, parms,
+                   dbAlias, stride, grdTerrain, command_line_args, aux_coords):
+    '''Load one LRAUV log file and its ESP samples. Module level function so that
+    it can be executed in a worker process by CANONLoader._execute_loads().
+    '''
+    try:
+        # Early LRAUV data had time coord of 'Time', override with auxCoords setting from load script
+        DAPloaders.runLrauvLoader(url, campaignName, campaignDescription, aname, 
+                                  pname, color, 'auv', 'AUV mission',
+                                  parms, dbAlias, stride, 
+                                  grdTerrain=grdTerrain, command_line_args=command_line_args,
+                                  plotTimeSeriesDepth=0, auxCoords=aux_coords)
+        psl = ParentSamplesLoader('', '', dbAlias=dbAlias)
+        psl.load_lrauv_samples(pname, aname, url, dbAlias)
+    except DAPloaders.NoValidData:
+        logger.info("No valid data in %s" % url)
+
+def _load_in_worker(func, args):
+    '''Call func(*args) in a worker process returning the traceback text of
+    any exception rather than raising it, so that the parent can report it.
+    '''
+    try:
+        func(*args)
+    except Exception:
+        return traceback.format_exc()
+    finally:
+        # Each worker process has its own connections, don't leave them open
+        connections.close_all()
+
+    return None
+
 
 class CANONLoader(LoadScript):
     '''
@@ -137,16 +192,54 @@ class CANONLoader(LoadScript):
     for b, c in zip(roms_platforms, oranges(np.arange(0, oranges.N, oranges.N/num_roms))):
         colors[b] = rgb2hex(c)[1:]
 
+    def _execute_loads(self, loads, workers=None):
+        '''Execute loads, a list of (url, function, args) tuples. With workers > 1 the
+        first load is done in this process (so that the Campaign, Platform and Parameters
+        are created only once) and the rest are distributed to a pool of worker processes
+        that load their Activities into the same database. Errors are reported for each
+        url in the order of loads after all have finished.
+        '''
+        workers = workers or getattr(self.args, 'workers', 1)
+        if workers <= 1 or len(loads) < 2:
+            for url, func, args in loads:
+                func(*args)
+            return
+
+        url, func, args = loads[0]
+        func(*args)
+
+        # Worker processes must open their own database connections, not share the parent's
+        connections.close_all()
+        self.logger.info(f'Loading {len(loads) - 1} urls with {workers} worker processes')
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = [(url, executor.submit(_load_in_worker, func, args)) for url, func, args in loads[1:]]
+            errors = []
+            for url, future in futures:
+                try:
+                    error = future.result()
+                except Exception as e:
+                    # Likely a BrokenProcessPool from a worker that was killed
+                    error = f'{e.__class__.__name__}: {e}'
+                if error:
+                    errors.append((url, error))
+                    self.logger.error(f'Failed to load {url}:\n{error}')
+                else:
+                    self.logger.info(f'Loaded {url}')
+
+        if errors:
+            raise ParallelLoadError(f'{len(errors)} of {len(loads)} urls failed to load: '
+                                    f"{', '.join(url for url, _ in errors)}")
+
     def loadDorado(self, startdate=None, enddate=None,
                    parameters=[ 'temperature', 'oxygen', 'nitrate', 'bbp420', 'bbp700',
                     'fl700_uncorr', 'salinity', 'biolume', 'rhodamine',
                     'sepCountList', 'mepCountList', 'roll', 'pitch', 'yaw', ], stride=None,
-                    file_patterns=('.*_decim.nc$'), build_attrs=False):
+                    file_patterns=('.*_decim.nc$'), build_attrs=False, workers=None):
         '''
-        Support legacy use of loadDorad() and permit wider use by specifying startdate and endate
+        Support legacy use of loadDorad() and permit wider use by specifying startdate and endate.
+        Surveys are loaded in parallel by worker processes if workers (or --workers) is > 1.
         '''
         pname = 'dorado'
-        psl = ParentSamplesLoader('', '', dbAlias=self.dbAlias)
         if build_attrs:
             self.logger.info(f'Building load parameter attributes from crawling TDS')
             self.build_dorado_attrs(pname, startdate, enddate, parameters, file_patterns)
@@ -160,18 +253,15 @@ class CANONLoader(LoadScript):
         else:
             urls = self.dorado_urls
 
+        loads = []
         for url in urls:
             dfile = url.split('/')[-1]
             aname = dfile + getStrideText(stride)
-            try:
-                DAPloaders.runDoradoLoader(url, self.campaignName, self.campaignDescription, aname, 
-                                           pname, self.colors[pname], 'auv', 'AUV mission', 
-                                           self.dorado_parms, self.dbAlias, stride, grdTerrain=self.grdTerrain,
-                                           plotTimeSeriesDepth=0.0)
-                psl.load_gulps(aname, dfile, self.dbAlias)
-            except DAPloaders.DuplicateData as e:
-                self.logger.warn(str(e))
-                self.logger.info(f"Skipping load of {url}")
+            loads.append((url, load_dorado_url, (url, aname, self.campaignName, self.campaignDescription,
+                                                 pname, self.colors[pname], self.dorado_parms, self.dbAlias,
+                                                 stride, self.grdTerrain, self.args)))
+
+        self._execute_loads(loads, workers)
 
         self.addPlatformResources('https://stoqs.mbari.org/x3d/dorado/simpleDorado389.x3d', pname,
                                   scalefactor=2)
@@ -190,11 +280,11 @@ class CANONLoader(LoadScript):
                     'pose_longitude_DeadReckonUsingMultipleVelocitySources',
                     'pose_latitude_DeadReckonUsingMultipleVelocitySources',
                     'pose_depth_DeadReckonUsingMultipleVelocitySources',],
-                  stride=None, file_patterns=('.*2S_scieng.nc$'), build_attrs=True):
+                  stride=None, file_patterns=('.*2S_scieng.nc$'), build_attrs=True, workers=None):
         '''
         Loader for tethys, daphne, makai, ahi, aku, 
+        Log files are loaded in parallel by worker processes if workers (or --workers) is > 1.
         '''
-        psl = ParentSamplesLoader('', '', dbAlias=self.dbAlias)
         if build_attrs:
             self.logger.info(f'Building load parameter attributes from crawling TDS')
             self.build_lrauv_attrs(startdate.year, pname, startdate, enddate, parameters, file_patterns)
@@ -205,6 +295,7 @@ class CANONLoader(LoadScript):
         stride = stride or self.stride
         files = getattr(self, f'{pname}_files')
         base = getattr(self, f'{pname}_base')
+        loads = []
         for (aname, f) in zip([ a + getStrideText(stride) for a in files], files):
             url = os.path.join(base, f)
             # shorten the activity names
@@ -217,16 +308,11 @@ class CANONLoader(LoadScript):
             else:
                 setattr(self, f'{pname}s_aux_coords', None)
                 aux_coords = None
-            try:
-                # Early LRAUV data had time coord of 'Time', override with auxCoords setting from load script
-                DAPloaders.runLrauvLoader(url, self.campaignName, self.campaignDescription, aname, 
-                                          pname, self.colors[pname], 'auv', 'AUV mission',
-                                          parameters, self.dbAlias, stride, 
-                                          grdTerrain=self.grdTerrain, command_line_args=self.args,
-                                          plotTimeSeriesDepth=0, auxCoords=aux_coords)
-                psl.load_lrauv_samples(pname, aname, url, self.dbAlias)
-            except DAPloaders.NoValidData:
-                self.logger.info("No valid data in %s" % url)
+            loads.append((url, load_lrauv_url, (url, aname, self.campaignName, self.campaignDescription,
+                                                pname, self.colors[pname], parameters, self.dbAlias,
+                                                stride, self.grdTerrain, self.args, aux_coords)))
+
+        self._execute_loads(loads, workers)
 
         self.addPlatformResources(f'https://stoqs.mbari.org/x3d/lrauv/lrauv_{pname}.x3d', pname,
                                   scalefactor=2)
@@ -1115,29 +1201,27 @@ class CANONLoader(LoadScript):
         except IOError as e:
             self.logger.error(str(e))
 
+    def _catalog_crawler(self):
+        return CatalogCrawler(cache_dir=getattr(self.args, 'catalog_cache', None))
+
     def find_lrauv_urls(self, base, search_str, startdate, enddate):
-        '''Use Thredds Crawler to return a list of DAP urls.  Initially written for LRAUV data, for
-        which we don't initially know the urls.
+        '''Crawl THREDDS catalogs to return a list of DAP urls.  Initially written for LRAUV data, for
+        which we don't initially know the urls.  The mission directory catalogs are crawled concurrently.
         '''
-        INV_NS = "http://www.unidata.ucar.edu/namespaces/thredds/InvCatalog/v1.0"
         url = os.path.join(base, 'catalog.xml')
         self.logger.info(f"Crawling: {url}")
-        skips = Crawl.SKIPS + [".*Courier*", ".*Express*", ".*Normal*, '.*Priority*", ".*.cfg$" ]
+        skips = SKIPS + [".*Courier*", ".*Express*", ".*Normal*, '.*Priority*", ".*.cfg$" ]
         u = urllib.parse.urlsplit(url)
         name, ext = os.path.splitext(u.path)
         if ext == ".html":
             u = urllib.parse.urlsplit(url.replace(".html", ".xml"))
         url = u.geturl()
-        urls = []
-        # Get an etree object
-        r = requests.get(url)
-        tree = etree.XML(r.text.encode('utf-8'))
+        crawler = self._catalog_crawler()
+        tree = crawler.fetch(url)
 
-        # Crawl the catalogRefs:
-        for ref in tree.findall('.//{%s}catalogRef' % INV_NS):
-
-            # get the mission directory name and extract the start and ending dates
-            mission_dir_name = ref.attrib['{http://www.w3.org/1999/xlink}title']
+        # Select the mission directory catalogRefs by the start and ending dates in their names
+        catalogs = []
+        for mission_dir_name, catalog in crawler.catalog_refs(url, tree, skip=[]):
             if '_' in mission_dir_name:
                 dts = mission_dir_name.split('_')
                 dir_start =  datetime.strptime(dts[0], '%Y%m%d')
@@ -1146,12 +1230,11 @@ class CANONLoader(LoadScript):
                 # if within a valid range, grab the valid urls
                 self.logger.debug(f'{mission_dir_name}: Looking for {search_str} files between {startdate} and {enddate}')
                 if dir_start >= startdate and dir_end <= enddate:
-                    catalog = ref.attrib['{http://www.w3.org/1999/xlink}href']
-                    c = Crawl(os.path.join(base, catalog), select=[search_str], skip=skips)
-                    d = [s.get("url") for d in c.datasets for s in d.services if s.get("service").lower() == "opendap"]
-                    for url in d:
-                        self.logger.debug(f'{url}')
-                        urls.append(url)
+                    catalogs.append(catalog)
+
+        urls = crawler.crawl(catalogs, select=[search_str], skip=skips)
+        for url in urls:
+            self.logger.debug(f'{url}')
 
         if not urls:
             raise FileNotFound('No urls matching "{}" found in {}'.format(search_str, os.path.join(base, 'catalog.html')))
@@ -1184,13 +1267,11 @@ class CANONLoader(LoadScript):
             self.logger.debug(f'{e}')
 
     def find_dorado_urls(self, base, search_str, startdate, enddate):
-        '''Use Thredds Crawler to return a list of DAP urls.  Initially written for LRAUV data, for
-        which we don't initially know the urls.
+        '''Crawl THREDDS catalogs to return a list of DAP urls of Dorado surveys
         '''
         urls = []
         catalog_url = os.path.join(base, 'catalog.xml')
-        c = Crawl(catalog_url, select=[search_str])
-        d = [s.get("url") for d in c.datasets for s in d.services if s.get("service").lower() == "opendap"]
+        d = self._catalog_crawler().crawl([catalog_url], select=[search_str])
         for url in d:
             yyyy_yd = '_'.join(url.split('/')[-1].split('_')[1:3])
             file_dt = datetime.strptime(yyyy_yd, '%Y_%j')
@@ -24,11 +24,14 @@ project_dir = os.path.dirname(__file__)
 sys.path.insert(0, os.path.join(os.path.dirname(__file__), "../../../"))  # settings.py is three dirs up
 from django.conf import settings
 from stoqs import models as m
+from django.db import transaction
 from django.db.utils import IntegrityError
 from django.contrib.gis.geos import LineString
 from coards import to_udunits
 import numpy
 from utils.utils import percentile, median, mode
+from loaders.bulk import CopyIngest
+from .batching import MicroBatcher, consume
 
 logger = logging.getLogger('__main__')
 logger.setLevel(logging.DEBUG)
@@ -44,14 +47,19 @@ class Consumer(object):
 
     Credentials are read in from privateSettings
     '''
+    measVars = ['temperature', 'salinity', 'nitrate', 'gulper_id']
 
-    def __init__(self, vhost = 'trackingvhost', exchange_name = '', exchange_type = '', queue_name = '', routing_key = '', dbAlias = ''):
+    def __init__(self, vhost = 'trackingvhost', exchange_name = '', exchange_type = '', queue_name = '', routing_key = '', dbAlias = '',
+                 batch_size = 0, batch_seconds = 5.0):
         self.vhost = vhost
         self.exchange_name = exchange_name
         self.exchange_type = exchange_type
         self.queue_name = queue_name
         self.routing_key = routing_key
         self.dbAlias = dbAlias
+        # With a batch_size messages are persisted together when that many arrive or batch_seconds pass
+        self.batch_size = batch_size
+        self.batch_seconds = batch_seconds
 
         (self.connection, self.channel) = self.create_connection_and_channel(vhost)
 
@@ -83,76 +91,89 @@ class Consumer(object):
         return (connection, channel)
 
 
-    def persistMessage(self, message):
-        '''Callback function for AMQP message.  Assume that we are processing Frederic's trex sensor messages.'''
-        logger.info('persistMessage(): Received SensorMessage object: ')
+    def _samples(self, message):
+        '''Parse the trex SensorMessage in message.body, return list of (dt, depth, lat, lon, var, value)
+        tuples for each of the measVars present in its samples
+        '''
         sm = trex_sensor_pb2.SensorMessage()
-        logger.info("persistMessage(): Length of message.body = %i", len(message.body))
+        logger.info("Length of message.body = %i", len(message.body))
         sm.ParseFromString(message.body)
-        parameterCount = {}
-        i = 0
-        measVars = ['temperature', 'salinity', 'nitrate', 'gulper_id']
-        for s in sm.sample:
-            i += 1
-            print((20*'-'))
-            print(("%d. %s" % (i, s)))
+        rows = []
+        for i, s in enumerate(sm.sample):
+            logger.debug("%d. %s", i + 1, s)
             # Assume that every sample has utime, easting, northing, and depth (not every sample has all of the state variables)
-            for mv in measVars:
+            dt = datetime.datetime.fromtimestamp(s.utime)
+            (lon, lat) = self.utmProj(s.easting, s.northing, inverse = True)
+            for mv in self.measVars:
                 if s.HasField(mv):
-                    logger.debug("utime = %d", s.utime)
-                    dt = datetime.datetime.fromtimestamp(s.utime)
-                    print(("dt = %s" % dt))
-                    logger.debug("easting = %f", s.easting)
-                    logger.debug("northing = %f", s.northing)
-                    (lon, lat) = self.utmProj(s.easting, s.northing, inverse = True)
-                    print(("lat = %f" % lat))
-                    print(("lon = %f" % lon))
-
-                    print(("depth = %f" % s.depth))
-                    value = s.__getattribute__(mv)
-                    print(("%s = %f" % (mv, value)))
-        
-                    if mv == 'gulper_id':
-                        logger.info('>>> gulper_id = %s', value)
-                        self.persistSample(dt, s.depth, lat, lon, mv, value)
-                    else:
-                        try:
-                            self.persistMeasurement(dt, s.depth, lat, lon, mv, value)
-                        except Exception as e:
-                            logger.error("ERROR: *** Could not persist this measurement.  Is something wrong with PostgreSQL?  See details below. ***\n")
-                            logger.error(e)
-                            traceback.print_exc(file = sys.stdout)
-                            ##sys.exit(-1)
-                            print("Continuing on with processing messages...")
-                        else:
-                            if mv in parameterCount:
-                                parameterCount[mv] += 1
-                            else:
-                                parameterCount[mv] = 0
-                            logger.debug('parameterCount = %s', parameterCount)
-
-            # As a test email extrapolated position to driftertrack - this will obscure sensortrack data visualization
-            ##(lon, lat) = self.utmProj(s.easting, s.northing, inverse = True)
-            ##subjMsg = 'TREX_pos,%f,%f,%f' % (s.utime, lon, lat)
-            ##cmd = 'mutt -s %s driftertrack@mbari.org < /dev/null' % (subjMsg)
-            ##print "Mailing message to driftertrack with command:\n%s" % cmd
-            ##os.system(cmd);
+                    rows.append((dt, s.depth, lat, lon, mv, s.__getattribute__(mv)))
+
+        return rows
+
+    def persistMessage(self, message):
+        '''Callback function for AMQP message.  Assume that we are processing Frederic's trex sensor messages.'''
+        logger.info('persistMessage(): Received SensorMessage object')
+        self.persistMessages([message])
+
+    def persistMessages(self, messages):
+        '''Persist the samples of a batch of messages with bulk inserts, then update the maptrack,
+        SimpleDepthTime and ActivityParameter statistics of the Activity once for the whole batch.
+        '''
+        rows = []
+        for message in messages:
+            rows.extend(self._samples(message))
+
+        measurements = []
+        for dt, depth, lat, lon, mv, value in rows:
+            if mv == 'gulper_id':
+                logger.info('>>> gulper_id = %s', value)
+                self.persistSample(dt, depth, lat, lon, mv, value)
+            else:
+                measurements.append((dt, depth, lat, lon, mv, value))
+
+        try:
+            parameterCount = self.persistMeasurements(measurements)
+        except Exception as e:
+            logger.error("ERROR: *** Could not persist %d measurements.  Is something wrong with PostgreSQL?  See details below. ***\n", len(measurements))
+            logger.error(e)
+            traceback.print_exc(file = sys.stdout)
+            print("Continuing on with processing messages...")
+            return
+        logger.debug('parameterCount = %s', parameterCount)
 
         # Update Activity attributes with info that stoqs/query needs
         try:
-            pass
+            self.updateMaptrack()
+            self.updateSimpleDepthTime()
+            self.updateActivityParameterStats(parameterCount)
         except Exception as e:
             logger.error("ERROR: *** Could not update MapTrack or SimpleDepthTime.  Is something wrong with PostgreSQL?  See details below. ***\n")
             logger.error(e)
             traceback.print_exc(file = sys.stdout)
-            sys.exit(-1)
-        
-        self.updateMaptrack()
-        self.updateSimpleDepthTime()
-        self.updateActivityParameterStats(parameterCount)
 
-        logger.debug("EXITING for debug")
-        sys.exit(-1)
+    def persistMeasurements(self, rows):
+        '''Persist rows of (dt, depth, lat, lon, var, value) with one set-based insert per table, reusing
+        the InstantPoints, Measurements and MeasuredParameters already in the database.
+        Return dictionary of the number of values persisted for each var.
+        '''
+        parameterCount = {}
+        if not rows:
+            return parameterCount
+
+        ingest = CopyIngest(self.dbAlias)
+        with transaction.atomic(using=self.dbAlias):
+            ip_ids = ingest.upsert_instantpoints(self.activity.id, (dt for dt, *_ in rows))
+            meas_ids = ingest.upsert_measurements((ip_id, depth, lon, lat, None) for ip_id, (_, depth, lat, lon, _, _)
+                                                  in zip(ip_ids, rows))
+            for var in sorted(set(r[4] for r in rows)):
+                parm, _ = m.Parameter.objects.using(self.dbAlias).get_or_create(name = var)
+                values = [(me_id, float(value), None) for me_id, (_, _, _, _, mv, value) in zip(meas_ids, rows) if mv == var]
+                ingest.upsert_measuredparameters(parm.id, values)
+                parameterCount[var] = len(values)
+
+        logger.info('Persisted %d measurements of %s', len(rows), ', '.join(parameterCount))
+
+        return parameterCount
 
     def persistMeasurement(self, dt, depth, lat, lon, var, value):
         '''Call all of the create_ methods to properly persist this measurement in STOQS'''
@@ -258,11 +279,11 @@ class Consumer(object):
         '''
         Read measurement geometry accumulated so far for this activity and compute a maptrack for the path
         '''
-        qs = m.Measurement.objects.using(self.dbAlias).filter(instantpoint__activity = self.activity)
-        linestringPoints = [q.geom for q in qs]
+        qs = (m.Measurement.objects.using(self.dbAlias).filter(instantpoint__activity = self.activity)
+                .order_by('instantpoint__timevalue').values_list('geom', flat=True))
+        linestringPoints = list(qs)
         if len(linestringPoints) < 2:
             return
-        print(("linestringPoints = %s" % linestringPoints))
         path = LineString(linestringPoints).simplify(tolerance=.001)
 
         num_updated = m.Activity.objects.using(self.dbAlias).filter(id = self.activity.id).update(
@@ -275,90 +296,68 @@ class Consumer(object):
 
     def updateSimpleDepthTime(self):
         '''
-        Read the time series of depth values for this activity, simplify it and insert the values in the
-        SimpleDepthTime table that is related to the Activity.
+        Read the time series of depth values for this activity and replace the values in the
+        SimpleDepthTime table that is related to the Activity with them.  Telemetered data are
+        sparse enough that they are not simplified.
         '''
-        measurements = m.Measurement.objects.using(self.dbAlias).select_related(depth=2).filter(instantpoint__activity=self.activity)
-        for meas in measurements:
-            logger.debug("meas %s, id = %d", meas, meas.id)
-            logger.debug("meas.instantpoint %s", meas.instantpoint)
-            ems = 1000 * to_udunits(meas.instantpoint.timevalue, 'seconds since 1970-01-01')
-            logger.debug(ems)
-            d = float(meas.depth)
-            m.SimpleDepthTime.objects.using(self.dbAlias).create(activity = self.activity, instantpoint = meas.instantpoint, 
-                    depth = d, epochmilliseconds = ems)
+        points = (m.Measurement.objects.using(self.dbAlias).filter(instantpoint__activity=self.activity)
+                    .order_by('instantpoint__timevalue').values_list('instantpoint_id', 'instantpoint__timevalue', 'depth'))
+        with transaction.atomic(using=self.dbAlias):
+            m.SimpleDepthTime.objects.using(self.dbAlias).filter(activity=self.activity).delete()
+            sdts = m.SimpleDepthTime.objects.using(self.dbAlias).bulk_create(
+                        m.SimpleDepthTime(activity=self.activity, instantpoint_id=ip_id, depth=depth,
+                                          epochmilliseconds=1000 * to_udunits(tv, 'seconds since 1970-01-01'))
+                        for ip_id, tv, depth in points)
 
-        logger.info('Inserted %d values into SimpleDepthTime', len(measurements))
+        logger.info('Inserted %d values into SimpleDepthTime', len(sdts))
 
 
     def updateActivityParameterStats(self, parameterCounts):
         '''
         Examine the data for the Activity, compute and update some statistics on the measuredparameters
-        for this activity.  Store the historgram in the associated table.
+        for this activity.  Replace the historgram in the associated table.
         '''
         a = self.activity
         for pname in parameterCounts:
             logger.debug(pname)
             p = m.Parameter.objects.using(self.dbAlias).get(name=pname)
-            data = m.MeasuredParameter.objects.using(self.dbAlias).filter(parameter=p)
-            numpvar = numpy.array([float(v.datavalue) for v in data])
+            data = (m.MeasuredParameter.objects.using(self.dbAlias).filter(parameter=p, measurement__instantpoint__activity=a)
+                        .values_list('datavalue', flat=True))
+            numpvar = numpy.array(list(data), dtype='float64')
+            if not numpvar.size:
+                continue
             numpvar.sort()
             listvar = list(numpvar)
             logger.debug('parameter: %s, min = %f, max = %f, mean = %f, median = %f, mode = %f, p025 = %f, p975 = %f',
                             p, numpvar.min(), numpvar.max(), numpvar.mean(), median(listvar), mode(numpvar),
                             percentile(listvar, 0.025), percentile(listvar, 0.975))
 
-
-            # Save statistics
+            # Save statistics and histogram
+            (counts, bins) = numpy.histogram(numpvar,100)
             try:
-                ap, created = m.ActivityParameter.objects.using(self.dbAlias).get_or_create(
-                                        activity = a,
-                                        parameter = p,
-                                        number = len(listvar),
-                                        min = numpvar.min(),
-                                        max = numpvar.max(),
-                                        mean = numpvar.mean(),
-                                        median = median(listvar),
-                                        mode = mode(numpvar),
-                                        p025 = percentile(listvar, 0.025),
-                                        p975 = percentile(listvar, 0.975)
-                                        )
-
-                if created:
-                    logger.info('Created ActivityParameter for parameter.name = %s', p.name)
-                else:
-                    m.ActivityParameter.objects.using(self.dbAlias).update(
+                with transaction.atomic(using=self.dbAlias):
+                    ap, created = m.ActivityParameter.objects.using(self.dbAlias).update_or_create(
                                         activity = a,
                                         parameter = p,
-                                        number = len(listvar),
-                                        min = numpvar.min(),
-                                        max = numpvar.max(),
-                                        mean = numpvar.mean(),
-                                        median = median(listvar),
-                                        mode = mode(numpvar),
-                                        p025 = percentile(listvar, 0.025),
-                                        p975= percentile(listvar, 0.975)
+                                        defaults = dict(number = len(listvar),
+                                                        min = numpvar.min(),
+                                                        max = numpvar.max(),
+                                                        mean = numpvar.mean(),
+                                                        median = median(listvar),
+                                                        mode = mode(numpvar),
+                                                        p025 = percentile(listvar, 0.025),
+                                                        p975 = percentile(listvar, 0.975))
                                         )
-                    logger.info('Update ActivityParameter for parameter.name = %s', p.name)
-
+                    m.ActivityParameterHistogram.objects.using(self.dbAlias).filter(activityparameter=ap).delete()
+                    m.ActivityParameterHistogram.objects.using(self.dbAlias).bulk_create(
+                                        m.ActivityParameterHistogram(activityparameter=ap, bincount=count,
+                                                                     binlo=binlo, binhi=binhi)
+                                        for count, binlo, binhi in zip(counts.tolist(), bins[:-1].tolist(), bins[1:].tolist()))
             except IntegrityError:
                 logger.warn('IntegrityError: Cannot create ActivityParameter for parameter.name = %s. Skipping.', p.name)
+                continue
 
-            # Compute and save histogram
-            (counts, bins) = numpy.histogram(numpvar,100)
-            logger.info(counts)
-            logger.info(bins)
-            i = 0
-            for count in counts:
-                try:
-                    ##logger.info('Creating ActivityParameterHistogram...')
-                    logger.info('count = %d, binlo = %f, binhi = %f', count, bins[i], bins[i+1])
-                    m.ActivityParameterHistogram.objects.using(self.dbAlias).get_or_create(
-                                                    activityparameter=ap, bincount=count, binlo=bins[i], binhi=bins[i+1])
-                    i = i + 1
-                except IntegrityError:
-                    logger.warn('IntegrityError: Cannot create ActivityParameter for parameter.name = %s. Skipping.', p.name)
-
+            logger.info('%s ActivityParameter for parameter.name = %s', 'Created' if created else 'Updated', p.name)
 
         logger.info('Updated statistics for activity.name = %s', a.name)
 
@@ -396,7 +395,14 @@ class Consumer(object):
 
         # Let AMQP know to send us messages
         # Instantiate message object setting flag on whhether to use Protocol Buffers or not
-        if self.dbAlias:
+        batcher = None
+        if self.batch_size:
+            # Micro-batching: buffer messages and persist them together
+            batcher = MicroBatcher(self.persistMessages, max_messages = self.batch_size, max_seconds = self.batch_seconds)
+            consumer_tag = self.channel.basic_consume( queue = self.queue_name, 
+                no_ack = True,
+                callback = batcher.add )
+        elif self.dbAlias:
             consumer_tag = self.channel.basic_consume( queue = self.queue_name, 
                 no_ack = True,
                 callback = self.persistMessage )
@@ -415,8 +421,11 @@ class Consumer(object):
     
         print("Waiting for messages (Ctrl-C or send SIGTERM to cancel)...")
         try:
-            while True:
-                self.channel.wait()            
+            if batcher:
+                consume(self.connection, batcher)
+            else:
+                while True:
+                    self.channel.wait()            
 
         except KeyboardInterrupt:
             print("Received KeyboardInterrupt Exception")
@@ -425,6 +434,10 @@ class Consumer(object):
         except InterruptedBySignal:
             print("Received InterruptedBySignal Exception")
             self.channel.basic_cancel(consumer_tag)
+
+        if batcher:
+            # Persist messages received since the last batch
+            batcher.flush()
            
         # Close the channel
         self.channel.close()
@@ -455,7 +468,7 @@ if __name__ == '__main__':
 
     parser = OptionParser(usage="""\
 
-Synopsis: %prog --en <exchange_name> --et <exchange_type> --qn<queue_name> [--rk <routing_key> --vh <vhost> --persist <dbAlias> --testPersist <dbAlias>]
+Synopsis: %prog --en <exchange_name> --et <exchange_type> --qn<queue_name> [--rk <routing_key> --vh <vhost> --persist <dbAlias> --batchSize <n> --batchSeconds <s> --testPersist <dbAlias>]
 
 Starts a consumer for an AMQP exchange.  If the --persist option is specified then persist the
 sensor track information in the messages to a STOQS database that is configured via Django.
@@ -468,6 +481,9 @@ Examples:
    To persist messages to the Postgres database defined in settings.py:
      % persistTrex.py --en SensorMessagesFromTrex --et fanout --qn odss-staging_persist_trex --vh trackingvhost --persist stoqs_may2012_r
 
+   To persist bursts of messages in batches of up to 100, each at most 10 seconds after its first message:
+     % persistTrex.py --en SensorMessagesFromTrex --et fanout --qn odss-staging_persist_trex --vh trackingvhost --persist stoqs_may2012_r --batchSize 100 --batchSeconds 10
+
    To test with a saved Google Protobuf message:
      % persistTrex.py --testPersist stoqs_may2012_r
 
@@ -491,6 +507,12 @@ Examples:
     parser.add_option('', '--persist',
         type='string', action='store',
         help="Specify dbAlias from the settings file where the data need to be persisted")
+    parser.add_option('', '--batchSize',
+        type='int', action='store', default=0,
+        help="Persist messages in batches of up to this many messages, each written with bulk inserts")
+    parser.add_option('', '--batchSeconds',
+        type='float', action='store', default=5.0,
+        help="With --batchSize, the most seconds a message waits before its batch is persisted (default 5)")
     parser.add_option('', '--testPersist',
         type='string', action='store',
         help="Run a test to persist a saved message to dbAlias rather than connect to a queue.")
@@ -524,7 +546,7 @@ Examples:
 
     # Create Consumer object
     c = Consumer(vhost = opts.vh, exchange_name = opts.en, exchange_type = opts.et, queue_name = opts.qn, 
-        routing_key = opts.rk, dbAlias = opts.persist)
+        routing_key = opts.rk, dbAlias = opts.persist, batch_size = opts.batchSize, batch_seconds = opts.batchSeconds)
 
     # Create a dummy activity for this realtime data (paramaters set inside the method)
     c.createActivity('trex', 'auv', 'ffff00', 'unassigned', 'AUV_mission')
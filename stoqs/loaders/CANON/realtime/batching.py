@@ -0,0 +1,119 @@
+'''
+Micro-batching of realtime messages so that a burst of vehicle data is written
+to the database in bulk rather than a sample at a time.  A MicroBatcher
+buffers messages until max_messages have arrived or max_seconds have passed
+since the first one, then hands them all to its flush callback, e.g.
+Consumer.persistMessages().  consume() drives a batcher from an AMQP
+connection, or from the in-memory MemoryQueue stand-in for testing:
+
+    queue = MemoryQueue()
+    queue.put(body)
+    batcher = MicroBatcher(consumer.persistMessages, max_messages=100, max_seconds=5)
+    queue.basic_consume(queue='test', no_ack=True, callback=batcher.add)
+    consume(queue, batcher)
+
+This module has no dependencies beyond the standard library so that it may
+be imported without the AMQP, Protocol Buffer and projection packages.
+'''
+
+import logging
+import socket
+import time
+from collections import deque
+from timeit import default_timer
+
+logger = logging.getLogger('__main__')
+
+
+class MicroBatcher(object):
+    '''Buffer messages and pass them as a list to flush() when a count or time window closes
+    '''
+    def __init__(self, flush, max_messages=100, max_seconds=5.0, clock=default_timer):
+        self._flush = flush
+        self.max_messages = max_messages
+        self.max_seconds = max_seconds
+        self.clock = clock
+        self.pending = []
+        self._deadline = None
+
+    def add(self, message):
+        '''Callback for a delivered message, flushes when max_messages are pending
+        '''
+        if not self.pending:
+            self._deadline = self.clock() + self.max_seconds
+        self.pending.append(message)
+        if len(self.pending) >= self.max_messages:
+            self.flush()
+
+    def timeout(self):
+        '''Return seconds until the time window of the pending messages closes, None if none are pending
+        '''
+        if not self.pending:
+            return None
+
+        return max(0.0, self._deadline - self.clock())
+
+    def poll(self):
+        '''Flush if the time window of the pending messages has closed
+        '''
+        if self.pending and self.clock() >= self._deadline:
+            self.flush()
+
+    def flush(self):
+        '''Pass the pending messages to the flush callback, return the number passed
+        '''
+        messages, self.pending = self.pending, []
+        self._deadline = None
+        if messages:
+            logger.info('Flushing batch of %d messages', len(messages))
+            self._flush(messages)
+
+        return len(messages)
+
+
+def consume(connection, batcher, idle_timeout=None):
+    '''Deliver messages from connection.drain_events() to the callback registered with basic_consume(),
+    typically batcher.add(), and flush the batcher when its time window closes.  Return when no
+    message arrives for idle_timeout seconds and none are pending; with None wait indefinitely.
+    '''
+    while True:
+        timeout = batcher.timeout()
+        try:
+            connection.drain_events(timeout=idle_timeout if timeout is None else timeout)
+        except socket.timeout:
+            if not batcher.pending:
+                return
+        batcher.poll()
+
+
+class MemoryMessage(object):
+    def __init__(self, body):
+        self.body = body
+
+
+class MemoryQueue(object):
+    '''In-memory stand-in for the amqplib connection and channel used by consume(), for testing
+    and for persisting saved messages.  Waiting on an empty queue calls sleep(timeout), which
+    may advance a test clock, before timing out.
+    '''
+    def __init__(self, sleep=time.sleep):
+        self.messages = deque()
+        self.callback = None
+        self.sleep = sleep
+
+    def put(self, body):
+        self.messages.append(MemoryMessage(body))
+
+    def basic_consume(self, queue='', no_ack=True, callback=None):
+        self.callback = callback
+        return queue
+
+    def drain_events(self, timeout=None):
+        '''Deliver one message to the callback, an empty queue times out after timeout seconds,
+        or immediately if timeout is None as no message can arrive while waiting
+        '''
+        if not self.messages:
+            if timeout:
+                self.sleep(timeout)
+            raise socket.timeout('No messages in MemoryQueue')
+        self.callback(self.messages.popleft())
@@ -38,22 +38,28 @@ from django.conf import settings
 from django.db.models import Max
 from django.db.utils import IntegrityError, DatabaseError
 from django.db import transaction
-from jdcal import gcal2jd, jd2gcal
 from stoqs.models import (Activity, InstantPoint, Measurement, MeasuredParameter,
                           NominalLocation, Resource, ResourceType, ActivityResource,)
-from datetime import datetime, timedelta
+from datetime import datetime
 import pytz
 from pydap.client import open_url
 import pydap.model
 import math
 from coards import to_udunits, from_udunits, ParserError
+import json
 import logging
 import socket
 import seawater.eos80 as sw
-from utils.utils import mode, simplify_points
+from utils.utils import mode
+from utils.sectiontiles import remove_pyramids
 from loaders import (STOQS_Loader, SkipRecord, HasMeasurement, MEASUREDINSITU, FileNotFound,
                      SIGMAT, SPICE, SPICINESS, ALTITUDE)
-from loaders.SampleLoaders import get_closest_instantpoint, ClosestTimeNotFoundException
+from loaders.SampleLoaders import InstantPointMatcher
+from loaders.bulk import CopyIngest
+from loaders.dapcache import DAPCache
+from loaders.checkpoint import LoadCheckpoint
+from loaders.profiling import LoadProfile, save_report
+from loaders import timedecode
 import numpy as np
 import psycopg2
 from collections import defaultdict
@@ -190,11 +196,16 @@ class Base_Loader(STOQS_Loader):
         self.grdTerrain = grdTerrain
         self.command_line_args = command_line_args
         self.coord_dicts = {}
+        self.copier = None
+        self.profile = None
 
         self.url = url
         self.varsLoaded = []
+        self.dap_cache = None
+        if getattr(command_line_args, 'dap_cache', None):
+            self.dap_cache = DAPCache(command_line_args.dap_cache, getattr(command_line_args, 'dap_cache_mode', 'cache'))
         try:
-            self.ds = open_url(url)
+            self.ds = open_url(url, application=self.dap_cache)
         except (socket.error, pydap.exceptions.ServerError, pydap.exceptions.ClientError):
             message = 'Failed in attempt to open_url("%s")' % url
             self.logger.warn(message)
@@ -598,11 +609,10 @@ class Base_Loader(STOQS_Loader):
                 self.logger.warn("%s does not have 'Conventions', yet appears to be EPIC from its time/time2 variables", self.url)
 
         if isEPIC:
-            # True Julian dates are at noon, so take int() to match EPIC's time axis values and to satisfy:
+            # EPIC's time axis values are True Julian Days beginning at midnight, per:
             #   datum: Time (UTC) in True Julian Days: 2440000 = 0000 h on May 23, 1968
             #   NOTE: Decimal Julian day [days] = time [days] + ( time2 [msec] / 86400000 [msec/day] )
-            jbd = int(sum(gcal2jd(self.startDatetime.year, self.startDatetime.month, self.startDatetime.day)) + 0.5)
-            jed = int(sum(gcal2jd(self.endDatetime.year, self.endDatetime.month, self.endDatetime.day)) + 0.5)
+            (jbd, jed), (bms, ems) = timedecode.to_epic([self.startDatetime, self.endDatetime])
 
             t_indx = np.where((jbd <= timeAxis) & (timeAxis <= jed))[0]
             if not t_indx.any():
@@ -610,12 +620,8 @@ class Base_Loader(STOQS_Loader):
                                   self.startDatetime, self.endDatetime))
 
             # Refine indicies with fractional portion of the day (ms since midnight) as represented in the time2 variable
-            bms = 0
-            if self.startDatetime.hour or self.startDatetime.minute or self.startDatetime.second:
-                bms = self.startDatetime.hour * 3600000 + self.startDatetime.minute * 60000 + self.startDatetime.second * 1000
-            ems = 86400000
-            if self.endDatetime.hour or self.endDatetime.minute or self.endDatetime.second:
-                ems = self.endDatetime.hour * 3600000 + self.endDatetime.minute * 60000 + self.endDatetime.second * 1000
+            if not ems:
+                ems = timedecode.MS_PER_DAY
 
             # Tolerate datasets that begin or end inside the limits of self.startDatetime and self.endDatetime
             beg_day_indices = np.where(jbd == timeAxis)[0]
@@ -762,30 +768,36 @@ class Base_Loader(STOQS_Loader):
         return load_groups, coor_groups
 
     def _ips(self, mtimes):
+        # Bad times have been removed by the mask in _load_coords_from_dsg_ds()
         for mt in mtimes:
-            if mt:
-                yield InstantPoint(activity=self.activity, timevalue=mt)
-            else:
-                yield None
+            yield InstantPoint(activity=self.activity, timevalue=mt)
 
     def _meass(self, depths, longitudes, latitudes):
+        # Bad coordinates have been removed by the mask in _load_coords_from_dsg_ds()
         for de, lo, la in zip(depths, longitudes, latitudes):
-            # Accept depths that are 0.0, but not latitudes and longitudes that are zero
-            if de is not None and lo and la:
-                yield Measurement(depth=repr(de), geom=f'POINT({repr(lo)} {repr(la)})')
-            else:
-                yield None
+            yield Measurement(depth=repr(de), geom=f'POINT({repr(lo)} {repr(la)})')
+
+    def _dap_array(self, var):
+        '''Return 1-d numpy array of the data in pydap variable (or value) var
+        '''
+        with self.phase('dap_read') as phase:
+            if isinstance(var, pydap.model.BaseType):
+                var = var.data
+            values = np.atleast_1d(np.asarray(var, dtype='float64')).ravel()
+            phase.rows += len(values)
+
+        return values
 
     def _load_coords_from_dsg_ds(self, tindx, ac, pnames, axes):
         '''Pull coordinates from Discrete Sampling Geometry NetCDF dataset,
         (with accomodations made so that it works as well for EPIC conventions)
-        and bulk create in the database. Retain None values for bad coordinates.
+        and bulk create the good ones in the database. Return the Measurements
+        and a boolean mask of the bad coordinates that were not loaded.
         '''
-        times = self.ds[ac[TIME]][tindx[0]:tindx[-1]:self.stride]
+        times = self._dap_array(self.ds[ac[TIME]][tindx[0]:tindx[-1]:self.stride])
         time_units = self.ds[ac[TIME]].units.lower().replace('utc', 'UTC')
         if self.ds[ac[TIME]].units == 'seconds since 1970-01-01T00:00:00Z':
             time_units = 'seconds since 1970-01-01 00:00:00'          # coards doesn't like ISO format
-        mtimes = (from_udunits(mt, time_units) for mt in times)
 
         try:
             if isinstance(self.ds[ac[DEPTH]], pydap.model.GridType):
@@ -813,24 +825,36 @@ class Base_Loader(STOQS_Loader):
         else:
             longitudes = self.ds[ac[LONGITUDE]][tindx[0]:tindx[-1]:self.stride]
 
-        self.logger.debug(f'Getting good_coords for {pnames}...')
-        try:
-            mtimes, depths, latitudes, longitudes, dup_times = zip(*self.good_coords(
-                                        pnames, mtimes, depths, latitudes, longitudes))
-        except TypeError:
-            # When ac[DEPTH] is a number, convert one time value to a list
-            self.logger.info(f'Assuming coords are single valued and converting to lists')
-            mtimes = [from_udunits(float(times.data), time_units)]
-            latitudes = [float(latitudes.data)]
-            longitudes = [float(longitudes.data)]
-            mtimes, depths, latitudes, longitudes, dup_times = zip(*self.good_coords(
-                                        pnames, mtimes, depths, latitudes, longitudes))
-
-        # Reassign meass with Measurement objects that have their id set
-        meass, mask = self._bulk_load_coordinates(self._ips(mtimes), self._meass(
-                                            depths, longitudes, latitudes), dup_times, ac, axes)
-
-        return meass, dup_times, mask
+        depths = self._dap_array(depths)
+        latitudes = self._dap_array(latitudes)
+        longitudes = self._dap_array(longitudes)
+        if len(depths) == 1:
+            # Single depth given in auxCoords, or single valued coordinates
+            depths = np.repeat(depths, len(times))
+
+        self.logger.debug(f'Getting bad_coords for {pnames}...')
+        bad_coords, dup_times = self.bad_coords(pnames, times, depths, latitudes, longitudes)
+
+        # Accept depths that are 0.0, but not latitudes and longitudes that are zero
+        mask = bad_coords | dup_times | (latitudes == 0) | (longitudes == 0)
+        good = np.flatnonzero(~mask)
+        if not len(good):
+            raise ValueError(f'No good coordinates in {len(times)} values for {pnames}')
+
+        mtimes = timedecode.to_datetimes(timedecode.from_udunits(times[good], time_units))
+        depths, latitudes, longitudes = depths[good].tolist(), latitudes[good].tolist(), longitudes[good].tolist()
+
+        with self.phase('coordinates') as phase:
+            if self.copier:
+                # Reassign meass with list of Measurement ids
+                meass = self._copy_load_coordinates(mtimes, depths, latitudes, longitudes, ac, axes)
+            else:
+                # Reassign meass with Measurement objects that have their id set
+                meass = self._bulk_load_coordinates(self._ips(mtimes), self._meass(
+                                                depths, longitudes, latitudes), ac, axes)
+            phase.rows += len(meass)
+
+        return meass, mask
 
     def _load_coords_from_instr_ds(self, tindx, ac):
         '''Pull time coordinate from Instrument (time-coordinate-only) NetCDF dataset (e.g. LOPC),
@@ -848,23 +872,23 @@ class Base_Loader(STOQS_Loader):
         time_units = self.ds[ac[TIME]].units.lower().replace('utc', 'UTC')
         if self.ds[ac[TIME]].units == 'seconds since 1970-01-01T00:00:00Z':
             timeUnits = 'seconds since 1970-01-01 00:00:00'          # coards doesn't like ISO format
-        mtimes = (from_udunits(mt, time_units) for mt in times)
+        mtimes = timedecode.to_datetimes(timedecode.from_udunits(self._dap_array(times), time_units))
 
         max_secs_diff = 2
-        ips = []
+        matches = InstantPointMatcher(self.associatedActivityName, self.dbAlias).match(mtimes)
+        meas_by_ip = {meas.instantpoint_id: meas for meas in Measurement.objects.using(self.dbAlias).filter(
+                            instantpoint_id__in=set(ip.id for ip, _ in matches if ip))}
         meass = []
         i = 0
-        for mt in mtimes:
-            try:
-                ip, secs_diff = get_closest_instantpoint(self.associatedActivityName, mt, self.dbAlias)
-            except ClosestTimeNotFoundException as e:
-                self.logger.error('Could not find corresponding measurment for LOPC data measured at %s', tv)
-            else:
-                if secs_diff > max_secs_diff:
-                    i += 1
-                    self.logger.warn(f"{i:3d}. LOPC data at {mt.strftime('%Y-%m-%d %H:%M:%S')} more than {max_secs_diff} secs away from existing measurement: {secs_diff}")
+        for mt, (ip, secs_diff) in zip(mtimes, matches):
+            if ip is None:
+                self.logger.error('Could not find corresponding measurment for LOPC data measured at %s', mt)
+                continue
+            if secs_diff > max_secs_diff:
+                i += 1
+                self.logger.warn(f"{i:3d}. LOPC data at {mt.strftime('%Y-%m-%d %H:%M:%S')} more than {max_secs_diff} secs away from existing measurement: {secs_diff}")
 
-                meass.append(Measurement.objects.using(self.dbAlias).get(instantpoint=ip))
+            meass.append(meas_by_ip[ip.id])
 
         meass_set = set(meass)
         if len(meass_set) != len(meass):
@@ -872,15 +896,6 @@ class Base_Loader(STOQS_Loader):
 
         return meass_set
 
-    def _good_value_generator(self, pname, values):
-        '''Generate good data values where bad values and nans are replaced consistently with None
-        '''
-        for value in values:
-            if self.is_value_bad(pname, value):
-                value = None
-
-            yield value
-
     def load_trajectory(self):
         '''Stream trajectory data directly from pydap proxies to generators fed to bulk_create() calls
         '''
@@ -894,9 +909,15 @@ class Base_Loader(STOQS_Loader):
                 self.logger.warn(f'Failed to getTimeBegEndIndices() for axes {k} from {self.url}')
                 continue
 
+            index_range = {'start': int(tindx[0]), 'end': int(tindx[-1]), 'stride': self.stride}
             for i, pname in enumerate(pnames):
                 self.logger.debug(f'{i}, {pname}')
                 if i == 0:
+                    coords_checkpoint = self._resume_checkpoint(f'coordinates {k}', index_range)
+                if i == 0 and coords_checkpoint:
+                    self.logger.info(f'Resuming with coordinates for axes {k} committed before checkpoint')
+                    meass, mask = self._resume_coordinates(coords_checkpoint)
+                elif i == 0:
                     # First time through, bulk load the coordinates: instant_points and measurements
                     if DEPTH not in ac:
                         self.logger.warn(f'{self.param_by_key[pname]} does not have {DEPTH} in {ac}. Skipping.')
@@ -906,14 +927,14 @@ class Base_Loader(STOQS_Loader):
                         self.logger.info(f'{self.param_by_key[pname]} does not have {DEPTH} in {self.url}.')
                         self.logger.info(f'ac[DEPTH] = {ac[DEPTH]}. Assume that this depth coordinate was provided in auxCoords')
                         self.logger.info(f'Loading coordinates for axes {k}')
-                        meass, dup_times, mask = self._load_coords_from_dsg_ds(tindx, ac, pnames, k)
+                        meass, mask = self._load_coords_from_dsg_ds(tindx, ac, pnames, k)
                     elif ac[DEPTH] in self.ds and ac[LATITUDE] in self.ds and ac[LONGITUDE] in self.ds:
                         try:
                             # Expect CF Discrete Sampling Geometry or EPIC dataset
                             self.logger.info(f'Loading coordinates for axes {k}')
-                            meass, dup_times, mask = self._load_coords_from_dsg_ds(tindx, ac, pnames, k)
+                            meass, mask = self._load_coords_from_dsg_ds(tindx, ac, pnames, k)
                         except ValueError as e:
-                            # Likely ValueError: not enough values to unpack (expected 5, got 0) from good_coords()
+                            # Likely ValueError: No good coordinates from _load_coords_from_dsg_ds()
                             self.logger.debug(str(e))
                             self.logger.warn(f'No good coordinates for {pname} - skipping it')
                             continue
@@ -928,14 +949,23 @@ class Base_Loader(STOQS_Loader):
                         # Expect instrument (time-coordinate-only) dataset
                         self.logger.warn(f'{pname} has no {ac[DEPTH]} coordinate - processing as time-coordinate-only, e.g. LOPC')
                         meass = self._load_coords_from_instr_ds(tindx, ac)
+                        mask = None
+
+                    if mask is not None:
+                        self._checkpoint_coordinates(f'coordinates {k}', index_range, meass, mask)
+
+                if self._skip_checkpointed_parameter(pname, index_range):
+                    total_loaded += self.parameter_counts[self.param_by_key[pname]]
+                    continue
 
                 try:
-                    if isinstance(self.ds[pname], pydap.model.GridType):
-                        constraint_string = f"using python slice: ds['{pname}']['{pname}'][{tindx[0]}:{tindx[-1]}:{self.stride}]"
-                        values = self.ds[pname][pname].data[tindx[0]:tindx[-1]:self.stride]
-                    else:
-                        constraint_string = f"using python slice: ds['{pname}'][{tindx[0]}:{tindx[-1]}:{self.stride}]"
-                        values = self.ds[pname].data[tindx[0]:tindx[-1]:self.stride]
+                    with self.phase('dap_read'):
+                        if isinstance(self.ds[pname], pydap.model.GridType):
+                            constraint_string = f"using python slice: ds['{pname}']['{pname}'][{tindx[0]}:{tindx[-1]}:{self.stride}]"
+                            values = self.ds[pname][pname].data[tindx[0]:tindx[-1]:self.stride]
+                        else:
+                            constraint_string = f"using python slice: ds['{pname}'][{tindx[0]}:{tindx[-1]}:{self.stride}]"
+                            values = self.ds[pname].data[tindx[0]:tindx[-1]:self.stride]
                 except ValueError:
                     self.logger.warn(f'Stride of {self.stride} likely greater than range of data: {tindx[0]}:{tindx[-1]}')
                     self.logger.warn(f'Skipping load of {self.url}')
@@ -949,41 +979,85 @@ class Base_Loader(STOQS_Loader):
                     values = [float(values)]
 
                 self.logger.info(f"Time data: {self.url}.ascii?{ac[TIME]}[{tindx[0]}:{self.stride}:{tindx[-1] - 1}]")
-                if hasattr(values[0], '__iter__'):
-                    # For data like LOPC data - expect all values to be non-nan
-                    mps = (MeasuredParameter(measurement=me, parameter=self.param_by_key[pname], 
-                                                dataarray=list(va)) for me, va in zip(meass, values))
-                else:
-                    # Need to bulk_create() all values, set bad ones to None and remove them after insert
-                    values = self._good_value_generator(pname, values)
-                    mps = (MeasuredParameter(measurement=me, parameter=self.param_by_key[pname], 
-                                                datavalue=va) for me, va, dt, mk in zip(
-                                                meass, values, dup_times, mask) if not dt and not mk)
-
-                # All items but meass are generators, so we can call len() on it
-                self.logger.info(f'Bulk loading {len(meass)} {self.param_by_key[pname]} datavalues into MeasuredParameter {constraint_string}')
-                mps = self._measuredparameter_with_measurement(meass, mps)
-                mps = MeasuredParameter.objects.using(self.dbAlias).bulk_create(mps)
+                if self.copier:
+                    self.logger.info(f'Copying {len(meass)} {self.param_by_key[pname]} datavalues into MeasuredParameter {constraint_string}')
+                    with self.phase('measuredparameters') as phase:
+                        num_copied = self._copy_load_measuredparameters(pname, meass, values, mask)
+                        phase.rows += num_copied
+                    self.parameter_counts[self.param_by_key[pname]] = num_copied
+                    total_loaded += num_copied
+                    self.checkpoint.record(f'parameter {pname}', count=num_copied, **index_range)
+                    continue
+
+                param_meass, mps = self._trajectory_measuredparameters(pname, meass, values, mask)
+
+                # All items but param_meass are generators, so we can call len() on it
+                self.logger.info(f'Bulk loading {len(param_meass)} {self.param_by_key[pname]} datavalues into MeasuredParameter {constraint_string}')
+                with self.phase('measuredparameters') as phase:
+                    mps = self._measuredparameter_with_measurement(param_meass, mps)
+                    mps = MeasuredParameter.objects.using(self.dbAlias).bulk_create(mps)
+                    phase.rows += len(mps)
                 self.parameter_counts[self.param_by_key[pname]] = len(mps)
                 total_loaded += len(mps)
+                self.checkpoint.record(f'parameter {pname}', count=len(mps), **index_range)
 
         return total_loaded
 
+    def _resume_checkpoint(self, name, index_range):
+        '''Return checkpoint for name if resuming a load of the same index_range
+        '''
+        if getattr(self.command_line_args, 'resume', False):
+            return self.checkpoint.matches(name, index_range)
+
+        return None
+
+    def _skip_checkpointed_parameter(self, pname, index_range):
+        '''Return True if the MeasuredParameters for pname were committed before the checkpoint
+        '''
+        checkpoint = self._resume_checkpoint(f'parameter {pname}', index_range)
+        if checkpoint:
+            self.logger.info(f"Skipping {pname}: {checkpoint['count']} values committed before checkpoint")
+            self.parameter_counts[self.param_by_key[pname]] = checkpoint['count']
+            return True
+
+        return False
+
+    def _checkpoint_coordinates(self, name, index_range, meass, mask):
+        '''Record the range of Measurement ids committed for coordinates and the indices that were masked
+        '''
+        ids = [me if isinstance(me, int) else me.id for me in meass]
+        self.checkpoint.record(name, first_id=min(ids), last_id=max(ids), count=len(ids),
+                               length=len(mask), bad=np.flatnonzero(mask).tolist(), **index_range)
+
+    def _resume_coordinates(self, checkpoint):
+        '''Return Measurements (or ids if using COPY) and mask for coordinates committed before checkpoint
+        '''
+        qs = (Measurement.objects.using(self.dbAlias)
+                .filter(instantpoint__activity=self.activity, 
+                        id__gte=checkpoint['first_id'], id__lte=checkpoint['last_id'])
+                .order_by('id'))
+        if self.copier:
+            rows = qs.values_list('id', 'instantpoint_id')
+            meass = [me_id for me_id, _ in rows]
+            self.ip_ids = [ip_id for _, ip_id in rows]
+        else:
+            meass = list(qs.select_related('instantpoint'))
+            self.ips = [me.instantpoint for me in meass]
+
+        if len(meass) != checkpoint['count']:
+            raise DuplicateData(f"Found {len(meass)} of {checkpoint['count']} checkpointed Measurements"
+                                f" for {self.activity}, cannot resume load of {self.url}")
+
+        mask = np.zeros(checkpoint['length'], dtype=bool)
+        mask[checkpoint['bad']] = True
+
+        return list(meass), mask
+
     def _convert_EPIC_times(self, times, tindx):
         # Create COARDS time from EPIC data
         time2s = self.ds['time2']['time2'].data[tindx[0]:tindx[-1]:self.stride]
         time_units = 'seconds since 1970-01-01 00:00:00'
-        epoch_seconds = []
-        for jd, ms in zip(times, time2s):
-            gcal = jd2gcal(jd - 0.5, ms / 86400000.0)
-            try:
-                gcal_datetime = datetime(*gcal[:3]) + timedelta(days=gcal[3])
-            except ValueError as e:
-                # Encountered this error after removing start & end times for the load on this dataset:
-                # http://dods.mbari.org/opendap/data/CCE_Archive/MS3/20151005/Aquadopp2000/MBCCE_MS3_Aquadopp2000_20151005.nc.ascii?time[93900:1:94100]
-                self.logger.debug(f"{e} in {self.url}")
-
-            epoch_seconds.append(to_udunits(gcal_datetime, time_units))
+        epoch_seconds = timedecode.to_udunits(timedecode.from_epic(times, time2s), time_units)
 
         return epoch_seconds, time_units
 
@@ -992,10 +1066,13 @@ class Base_Loader(STOQS_Loader):
         '''
         time_axes_loaded = set()
         depth_axes_loaded = set()
+        ingest = CopyIngest(self.dbAlias)
         load_groups, coor_groups = self.get_load_structure()
         for k, pnames in load_groups.items():
             ac = coor_groups[k]
             total_loaded = 0   
+            # Reloads overlapping data already in the database use INSERT ... ON CONFLICT
+            upsert = getattr(self.command_line_args, 'upsert', False)
             for i, pname in enumerate(pnames):
                 if i == 0:
                     # First time through, bulk load the coordinates: instant_points and measurements
@@ -1010,7 +1087,8 @@ class Base_Loader(STOQS_Loader):
                     # CF (nee COARDS) has tzyx coordinate ordering, time is at index [1] and depth is at [2]
                     # - times: Assume CF/COARDS, override if EPIC data detected
                     tindx = self.getTimeBegEndIndices(self.ds[list(self.ds[firstp].keys())[1]])
-                    times = self.ds[list(self.ds[firstp].maps.keys())[0]].data[tindx[0]:tindx[-1]:self.stride]
+                    with self.phase('dap_read'):
+                        times = self.ds[list(self.ds[firstp].maps.keys())[0]].data[tindx[0]:tindx[-1]:self.stride]
                     time_units = self.ds[list(self.ds[firstp].maps.keys())[0]].units.lower()
 
                     if time_units == 'true julian day': # pragma: no cover
@@ -1020,7 +1098,7 @@ class Base_Loader(STOQS_Loader):
                     if self.ds[list(self.ds[firstp].maps.keys())[0]].units == 'seconds since 1970-01-01T00:00:00Z':
                         time_units = 'seconds since 1970-01-01 00:00:00'    # coards 1.0.4 and earlier doesn't like ISO format
 
-                    mtimes = [from_udunits(mt, time_units) for mt in times]
+                    mtimes = timedecode.to_datetimes(timedecode.from_udunits(times, time_units))
 
                     # - depths: first by CF/COARDS coordinate rules, then by EPIC conventions
                     nomDepths = None
@@ -1113,36 +1191,34 @@ class Base_Loader(STOQS_Loader):
                     # Ensure uniqueness
                     if hasattr(latitudes, '__iter__') and hasattr(longitudes, '__iter__'):
                         # We have precise gps positions, a location for each time value
-                        points = [f'POINT({repr(lo)} {repr(la)})' for lo, la in zip(longitudes, latitudes)]
+                        lonlats = list(zip(longitudes, latitudes))
                     else:
-                        points = [f'POINT({repr(longitudes)} {repr(latitudes)})'] * len(list(mtimes))
-
-                    points = points * len(list(depths))
-
-                    ips = (InstantPoint(activity=self.activity, timevalue=mt) for mt in mtimes)
-                    try:
-                        self.logger.info(f'Calling bulk_create() for InstantPoints in ips generator for firstp = {firstp}')
-                        ips = InstantPoint.objects.using(self.dbAlias).bulk_create(ips)
-                    except (IntegrityError, psycopg2.IntegrityError) as e:
-                        self.logger.info(f"Time axis '{ac[TIME]}' likely has timevalues already loaded from an axis in {time_axes_loaded}")
-                        self.logger.info(f'Getting matching InstantPoints from the database, creating new ones not yet there.')
-                        ips_new = []
-                        num_created = 0
-                        for ip in (InstantPoint(activity=self.activity, timevalue=mt) for mt in mtimes):
-                            ip_db, created = InstantPoint.objects.using(self.dbAlias).get_or_create(
-                                            activity=self.activity, timevalue=ip.timevalue)
-                            if created:
-                                num_created += 1
-
-                            ips_new.append(ip_db) 
-
-                        ips = ips_new 
-                        self.logger.info(f'Got {len(ips) - num_created} InstantPoints from the database, created {num_created} new ones')
-                       
-                        if not ips: 
-                            self.logger.error(f'Unable to load load InstantPoints for axis {ac[TIME]}. Exiting.')
-                            self.logger.exception(f"Maybe you should delete Activity '{self.activity.name}' first?")
-                            sys.exit(-1)
+                        lonlats = [(longitudes, latitudes)] * len(list(mtimes))
+
+                    lonlats = lonlats * len(list(depths))
+                    points = [f'POINT({repr(lo)} {repr(la)})' for lo, la in lonlats]
+
+                    with self.phase('coordinates') as phase:
+                        ips = None
+                        if not upsert:
+                            try:
+                                self.logger.info(f'Calling bulk_create() for InstantPoints in ips generator for firstp = {firstp}')
+                                ips = InstantPoint.objects.using(self.dbAlias).bulk_create(
+                                            InstantPoint(activity=self.activity, timevalue=mt) for mt in mtimes)
+                            except (IntegrityError, psycopg2.IntegrityError) as e:
+                                self.logger.info(f"Time axis '{ac[TIME]}' likely has timevalues already loaded from an axis in {time_axes_loaded}")
+                                upsert = True
+
+                        if upsert and ips is None:
+                            self.logger.info(f'Upserting InstantPoints for firstp = {firstp}, reusing those already in the database')
+                            ips = [InstantPoint(id=ip_id, activity=self.activity, timevalue=mt) for ip_id, mt in
+                                        zip(ingest.upsert_instantpoints(self.activity.id, mtimes), mtimes)]
+
+                            if not ips: 
+                                self.logger.error(f'Unable to load load InstantPoints for axis {ac[TIME]}. Exiting.')
+                                self.logger.exception(f"Maybe you should delete Activity '{self.activity.name}' first?")
+                                sys.exit(-1)
+                        phase.rows += len(ips)
 
                     # TIME axes are commonly shared amongst variables on different grids in timeseriesprofile data
                     # Keep track of axis names for use in logger info messages
@@ -1162,36 +1238,36 @@ class Base_Loader(STOQS_Loader):
                         nls = [None] * len(list(depths))
 
                     meass = []
+                    coords = []
+                    bad_depths = self.bad_coordinate_mask(firstp, depths)
                     for ip in ips:
-                        for de, po, nl in zip(depths, points, nls):
-                            if self.is_coordinate_bad(firstp, ip.timevalue, de):
+                        for de, po, (lo, la), nl, bad in zip(depths, points, lonlats, nls, bad_depths):
+                            if bad:
                                 self.logger.warn(f'Bad coordinate: {ip}, {de}')
                             meass.append(Measurement(depth=repr(de), geom=po, instantpoint=ip, nominallocation=nl))
-
-                    try:
-                        self.logger.info(f'Calling bulk_create() for {len(meass)} Measurements')
-                        meass = Measurement.objects.using(self.dbAlias).bulk_create(meass)
-                    except (IntegrityError, psycopg2.IntegrityError) as e:
-                        self.logger.info(f"Depth axis '{ac[DEPTH]}' likely has depths already loaded from an axis in {depth_axes_loaded}")
-                        self.logger.info(f'Getting matching Measurements from the database, creating new ones not yet there.')
-                        meass_new = []
-                        num_created = 0
-                        for meas in meass:
-                            meas_db, created = Measurement.objects.using(self.dbAlias).get_or_create(
-                                            instantpoint=meas.instantpoint, depth=meas.depth, 
-                                            geom=meas.geom, nominallocation=meas.nominallocation) 
-                            if created:
-                                num_created += 1
-
-                            meass_new.append(meas_db) 
-
-                        meass = meass_new
-                        self.logger.info(f'Got {len(meass) - num_created} Measurements from the database, created {num_created} new ones')
-
-                        if not meass:
-                            self.logger.error(f'Unable to load load Measurements for axis {ac[DEPTH]}. Exiting.')
-                            self.logger.exception(f"Maybe you should delete Activity '{self.activity.name}' first?")
-                            sys.exit(-1)
+                            coords.append((ip.id, de, lo, la, nl.id if nl else None))
+
+                    with self.phase('coordinates') as phase:
+                        loaded = False
+                        if not upsert:
+                            try:
+                                self.logger.info(f'Calling bulk_create() for {len(meass)} Measurements')
+                                meass = Measurement.objects.using(self.dbAlias).bulk_create(meass)
+                                loaded = True
+                            except (IntegrityError, psycopg2.IntegrityError) as e:
+                                self.logger.info(f"Depth axis '{ac[DEPTH]}' likely has depths already loaded from an axis in {depth_axes_loaded}")
+                                upsert = True
+
+                        if not loaded:
+                            self.logger.info(f'Upserting {len(meass)} Measurements, reusing those already in the database')
+                            for meas, meas_id in zip(meass, ingest.upsert_measurements(coords)):
+                                meas.id = meas_id
+
+                            if not meass:
+                                self.logger.error(f'Unable to load load Measurements for axis {ac[DEPTH]}. Exiting.')
+                                self.logger.exception(f"Maybe you should delete Activity '{self.activity.name}' first?")
+                                sys.exit(-1)
+                        phase.rows += len(meass)
 
                     # DEPTH axes are commonly shared amongst variables on different grids in timeseriesprofile data
                     # Keep track of axis names for use in logger info messages
@@ -1200,22 +1276,37 @@ class Base_Loader(STOQS_Loader):
 
                 # End if i == 0 (loading coords for list of pnames)
  
+                index_range = {'start': int(tindx[0]), 'end': int(tindx[-1]), 'stride': self.stride}
+                if self._skip_checkpointed_parameter(pname, index_range):
+                    total_loaded += self.parameter_counts[self.param_by_key[pname]]
+                    continue
+
                 constraint_string = f"using python slice: ds['{pname}']['{pname}'][{tindx[0]}:{tindx[-1]}:{self.stride}]"
-                values = self.ds[pname][pname].data[tindx[0]:tindx[-1]:self.stride]
+                with self.phase('dap_read') as phase:
+                    values = self.ds[pname][pname].data[tindx[0]:tindx[-1]:self.stride]
+                    phase.rows += values.size
                 if len(values.shape) == 1:
                     self.logger.info("len(values.shape) = 1; likely EPIC timeseries data - reshaping to add a 'depth' dimension")
                     values = values.reshape(values.shape[0], 1)
 
-                # Need to bulk_create() all values, set bad ones to None and remove them after insert
-                values = self._good_value_generator(pname, values.flatten())
-                mps = (MeasuredParameter(measurement=me, parameter=self.param_by_key[pname], 
-                                                datavalue=va) for me, va in zip(meass, values))
+                # Only the good values and their Measurements are inserted
+                param_meass, values = self.screen_values(pname, self.param_by_key[pname], meass, values.flatten())
 
                 # All items but mess are generators, so we can call len() on it
-                self.logger.info(f'Bulk loading {len(meass)} {self.param_by_key[pname]} datavalues into MeasuredParameter {constraint_string}')
+                self.logger.info(f'Bulk loading {len(param_meass)} {self.param_by_key[pname]} datavalues into MeasuredParameter {constraint_string}')
                 self.logger.info(f"Time data: {self.url}.ascii?{ac[TIME]}[{tindx[0]}:{self.stride}:{tindx[-1] - 1}]")
-                mps = MeasuredParameter.objects.using(self.dbAlias).bulk_create(mps)
+                with self.phase('measuredparameters') as phase:
+                    if upsert:
+                        # Coordinates overlap existing ones which may already have values for this Parameter
+                        mps = ingest.upsert_measuredparameters(self.param_by_key[pname].id,
+                                            ((me.id, va, None) for me, va in zip(param_meass, values)))
+                    else:
+                        mps = MeasuredParameter.objects.using(self.dbAlias).bulk_create(
+                                            MeasuredParameter(measurement=me, parameter=self.param_by_key[pname], 
+                                                    datavalue=va) for me, va in zip(param_meass, values))
+                    phase.rows += len(mps)
                 total_loaded += len(mps)
+                self.checkpoint.record(f'parameter {pname}', count=len(mps), **index_range)
 
         return total_loaded
 
@@ -1224,23 +1315,14 @@ class Base_Loader(STOQS_Loader):
             meas.instantpoint = ip
             yield meas
        
-    def _bulk_load_coordinates(self, ips, meass, dup_times, ac, axes):
-
+    def _bulk_load_coordinates(self, ips, meass, ac, axes):
+        '''Bulk create good coordinates in ips and meass, return list of Measurements
+        '''
         self.logger.info(f'Calling bulk_create() for InstantPoints in ips generator')
-        # Create mask array in case any coordinate is None, so that we can know which MPs to bulk_create()
-        mask = []
-        ips_to_load = []
-        meas_to_load = []
-        for ip, meas, dt in zip(ips, meass, dup_times):
-            if not ip or not meas or dt:
-                mask.append(True)
-            else:
-                mask.append(False)
-                ips_to_load.append(ip)
-                meas_to_load.append(meas)
+        meas_to_load = list(meass)
        
         try:
-            self.ips = InstantPoint.objects.using(self.dbAlias).bulk_create(ips_to_load)
+            self.ips = InstantPoint.objects.using(self.dbAlias).bulk_create(ips)
         except IntegrityError as e:
             # Some data sets (e.g. Waveglider) share time coordinates with different depths
             # Report the reuse of previous self.ips values
@@ -1256,22 +1338,82 @@ class Base_Loader(STOQS_Loader):
         self.logger.info(f'Calling bulk_create() for Measurements in meass generator')
         meass = Measurement.objects.using(self.dbAlias).bulk_create(meass)
 
-        return meass, mask
+        return meass
+
+    def _copy_load_coordinates(self, mtimes, depths, latitudes, longitudes, ac, axes):
+        '''COPY counterpart of _bulk_load_coordinates(): stream good coordinates into InstantPoint
+        and Measurement and return list of Measurement ids.
+        '''
+        coords = list(zip(mtimes, depths, longitudes, latitudes))
+
+        self.logger.info(f'Copying {len(coords)} InstantPoints')
+        try:
+            self.ip_ids = self.copier.copy_instantpoints(self.activity.id, (c[0] for c in coords))
+        except (IntegrityError, psycopg2.IntegrityError) as e:
+            # Some data sets (e.g. Waveglider) share time coordinates with different depths
+            if hasattr(self, 'ip_ids'):
+                self.logger.info(f"Duplicate time values for axes {axes}. Reusing previously loaded time values for {ac['time']}")
+            else:
+                self.logger.error(f"{e}")
+                self.logger.error(f"It's likely that the {ac['time']} variable in {self.url} has a duplicate value")
+                raise DuplicateData(f"Duplicate data from {self.url} in {self.dbAlias}")
+
+        self.logger.info(f'Copying {len(coords)} Measurements')
+        meas_ids = self.copier.copy_measurements((ip_id, de, lo, la) for ip_id, (_, de, lo, la) in zip(self.ip_ids, coords))
+
+        return meas_ids
+
+    def _copy_load_measuredparameters(self, pname, meass, values, mask=None):
+        '''COPY counterpart of the bulk_create() of MeasuredParameters in load_trajectory().
+        Return the number of MeasuredParameters copied.
+        '''
+        parameter_id = self.param_by_key[pname].id
+        if hasattr(values[0], '__iter__'):
+            # For data like LOPC data meass are Measurement objects from _load_coords_from_instr_ds()
+            return len(self.copier.copy_measuredparameters(parameter_id,
+                                ((me.id, None, list(va)) for me, va in zip(meass, values))))
+
+        meass, values = self.screen_values(pname, self.param_by_key[pname], meass, self._as_float_array(values)[~mask])
+
+        return len(self.copier.copy_measuredparameters(parameter_id,
+                                ((me_id, va, None) for me_id, va in zip(meass, values))))
+
+    def _trajectory_measuredparameters(self, pname, meass, values, mask):
+        '''Return list of the Measurements of pname's good values and generator of their MeasuredParameters.
+        meass are shared by all of the Parameters with the same coordinates, values at mask (bad coordinates)
+        have no Measurement and bad values are not inserted, leaving meass as it is for the next Parameter.
+        '''
+        parameter = self.param_by_key[pname]
+        if hasattr(values[0], '__iter__'):
+            # For data like LOPC data - expect all values to be non-nan
+            return meass, (MeasuredParameter(measurement=me, parameter=parameter, dataarray=list(va))
+                           for me, va in zip(meass, values))
+
+        values = self._as_float_array(values)
+        if mask is not None:
+            values = values[~mask]
+        param_meass, values = self.screen_values(pname, parameter, meass, values)
+
+        return param_meass, (MeasuredParameter(measurement=me, parameter=parameter, datavalue=va)
+                             for me, va in zip(param_meass, values))
 
     def _measuredparameter_with_measurement(self, meass, mps):
         for meas, mp in zip(meass, mps):
             mp.measurement = meas
             yield mp
 
-    def _delete_bad_datavalues(self, pname):
-        num, _ = (MeasuredParameter.objects.using(self.dbAlias)
-                    .filter(parameter__name=pname, datavalue=np.nan).delete())
-        if num:
-            self.logger.info(f'Deleted {num} nan {pname} MeasuredParameters')
-        num, _ = (MeasuredParameter.objects.using(self.dbAlias)
-                    .filter(parameter__name=pname, datavalue=np.inf).delete())
-        if num:
-            self.logger.info(f'Deleted {num} inf {pname} MeasuredParameters')
+    def _save_load_profile(self, mps_loaded, featureType, rejected=None, completed=True):
+        '''Log the phase timing report of the load and save it as a Resource of the Campaign
+        '''
+        try:
+            report = self.profile.report(activity=self.activity.name, url=self.url, featureType=featureType,
+                                         stride=self.stride, measuredparameters=mps_loaded,
+                                         rejected=rejected or {}, completed=completed)
+        finally:
+            self.profile.close()
+            self.profile = None
+        self.logger.info(f'Load profile: {json.dumps(report)}')
+        save_report(self.dbAlias, self.campaign, self.activity.name, report)
 
     def _post_process_updates(self, mps_loaded, featureType=''):
 
@@ -1299,19 +1441,17 @@ class Base_Loader(STOQS_Loader):
 
         # Add additional Parameters for all appropriate Measurements
         self.logger.info("Adding SigmaT and Spiciness to the Measurements...")
-        self.addSigmaTandSpice(self.activity)
+        with self.phase('derived_parameters'):
+            self.addSigmaTandSpice(self.activity)
 
         if self.grdTerrain:
             self.logger.info("Adding altitude to the Measurements...")
             try:
-                self.addAltitude(self.activity)
+                with self.phase('altitude'):
+                    self.addAltitude(self.activity)
             except FileNotFound as e:
                 self.logger.warn(str(e))
 
-        # Bulk loading of stoqs calculated values may introduce NaNs, remove them
-        for pname in (SIGMAT, SPICE, ALTITUDE):
-            self._delete_bad_datavalues(pname)
-
         # Update the Activity with information we now have following the load
         try:
             varList = ', '.join(self.varsLoaded)
@@ -1353,17 +1493,25 @@ class Base_Loader(STOQS_Loader):
         # Update the stats and store simple line values
         #
         self.updateActivityMinMaxDepth()
-        self.updateActivityParameterStats()
+        with self.phase('activityparameter_stats'):
+            self.updateActivityParameterStats()
         self.updateCampaignStartEnd()
         self.assignParameterGroup(groupName=MEASUREDINSITU)
-        if featureType == TRAJECTORY:
-            self.insertSimpleDepthTimeSeries()
-            self.saveBottomDepth()
-            self.insertSimpleBottomDepthTimeSeries()
-        elif featureType == TIMESERIES or featureType == TIMESERIESPROFILE:
-            self.insertSimpleDepthTimeSeriesByNominalDepth()
-        elif featureType == TRAJECTORYPROFILE:
-            self.insertSimpleDepthTimeSeriesByNominalDepth(trajectoryProfileDepths=self.timeDepthProfiles)
+        with self.phase('simple_depth_time'):
+            if featureType == TRAJECTORY:
+                self.insertSimpleDepthTimeSeries()
+                self.saveBottomDepth()
+                self.insertSimpleBottomDepthTimeSeries()
+            elif featureType == TIMESERIES or featureType == TIMESERIESPROFILE:
+                self.insertSimpleDepthTimeSeriesByNominalDepth()
+            elif featureType == TRAJECTORYPROFILE:
+                self.insertSimpleDepthTimeSeriesByNominalDepth(trajectoryProfileDepths=self.timeDepthProfiles)
+        if getattr(self.command_line_args, 'section_tiles', False) and featureType != TIMESERIES:
+            with self.phase('section_tiles'):
+                self.buildSectionTiles()
+        else:
+            # Pyramids of an earlier load do not include the data of an --append
+            remove_pyramids(self.dbAlias, self.activity.id)
         self.logger.info("Data load complete, %d records loaded.", mps_loaded)
 
         return path
@@ -1431,10 +1579,12 @@ class Base_Loader(STOQS_Loader):
                 self.logger.error(str(e))
 
         self.initDB()
+        self.checkpoint = LoadCheckpoint(self.activity, self.dbAlias)
 
         path = None
         parmCount = {}
         self.parameter_counts = {}
+        self.rejected_counts = defaultdict(int)
         for key in self.include_names:
             parmCount[key] = 0
 
@@ -1444,59 +1594,87 @@ class Base_Loader(STOQS_Loader):
                                             .filter(activity__name=self.getActivityName())
                                             .aggregate(Max('timevalue'))['timevalue__max'])
 
-        self.param_by_key = {}
-        self.mv_by_key = {}
-        self.fv_by_key = {}
-
-        for key in (set(self.include_names) & set(self.ds.keys())):
-            parameter_name, _ = self.parameter_name(key)
-            self.param_by_key[key] = self.getParameterByName(parameter_name)
-            self.parameter_counts[self.param_by_key[key]] = 0
+        if getattr(self.command_line_args, 'copy', False):
+            self.logger.info('Using COPY FROM STDIN in place of bulk_create() to load data')
+            self.copier = CopyIngest(self.dbAlias)
 
-        for key in self.ds.keys():
-            self.mv_by_key[key] = self.getmissing_value(key)
-            self.fv_by_key[key] = self.get_FillValue(key)
-
-        self.logger.info("From: %s", self.url)
-        if featureType:
-            featureType = featureType.lower()
-        else:
-            featureType = self.getFeatureType()
+        if getattr(self.command_line_args, 'profile', False):
+            self.profile = LoadProfile(self.dbAlias)
 
         mps_loaded = 0
+        rejected = None
+        completed = False
         try:
-            if featureType== TRAJECTORY:
-                mps_loaded = self.load_trajectory()
-            elif featureType == TIMESERIES:
-                mps_loaded = self.load_timeseriesprofile()
-            elif featureType == TIMESERIESPROFILE:
-                mps_loaded = self.load_timeseriesprofile()
-            elif featureType == TRAJECTORYPROFILE:
-                pass
+            self.param_by_key = {}
+            self.mv_by_key = {}
+            self.fv_by_key = {}
+
+            for key in (set(self.include_names) & set(self.ds.keys())):
+                parameter_name, _ = self.parameter_name(key)
+                self.param_by_key[key] = self.getParameterByName(parameter_name)
+                self.parameter_counts[self.param_by_key[key]] = 0
+
+            for key in self.ds.keys():
+                self.mv_by_key[key] = self.getmissing_value(key)
+                self.fv_by_key[key] = self.get_FillValue(key)
+
+            self.logger.info("From: %s", self.url)
+            if featureType:
+                featureType = featureType.lower()
             else:
-                raise Exception(f"Global attribute 'featureType' is not one of '{TRAJECTORY}',"
-                        " '{TIMESERIES}', or '{TIMESERIESPROFILE}' - see:"
-                        " http://cf-pcmdi.llnl.gov/documents/cf-conventions/1.6/ch09.html")
-            self.totalRecords = mps_loaded
-        except IntegrityError as e:
-            # Likely duplicate key value violates unique constraint "stoqs_measuredparameter_measurement_id_parameter_1328c3fb_uniq"
-            # Can't append data from source with bulk_create(), give appropriate warning
-            self.logger.exception(str(e))
-            self.logger.error(f'Failed to bulk_create() data from URL: {self.url}')
-            self.logger.error(f'If you need to load data that has been appended to the URL then delete its Activity before loading.')
-
-            return mps_loaded, path, parmCount
-        except KeyError as e:
-            # Likely an include_name variable has a bad coordinates attribute, give a better error message than just KeyError
-            self.logger.exception(str(e))
-            self.logger.error(f'Failed to bulk_create() data from URL: {self.url}')
+                featureType = self.getFeatureType()
 
-            return mps_loaded, path, parmCount
-
-        if mps_loaded:
-            # Bulk loading may introduce None values, remove them
-            MeasuredParameter.objects.using(self.dbAlias).filter(datavalue=None, dataarray=None).delete()
-            path = self._post_process_updates(mps_loaded, featureType)
+            try:
+                if featureType== TRAJECTORY:
+                    mps_loaded = self.load_trajectory()
+                elif featureType == TIMESERIES:
+                    mps_loaded = self.load_timeseriesprofile()
+                elif featureType == TIMESERIESPROFILE:
+                    mps_loaded = self.load_timeseriesprofile()
+                elif featureType == TRAJECTORYPROFILE:
+                    pass
+                else:
+                    raise Exception(f"Global attribute 'featureType' is not one of '{TRAJECTORY}',"
+                            " '{TIMESERIES}', or '{TIMESERIESPROFILE}' - see:"
+                            " http://cf-pcmdi.llnl.gov/documents/cf-conventions/1.6/ch09.html")
+                self.totalRecords = mps_loaded
+            except IntegrityError as e:
+                # Likely duplicate key value violates unique constraint "stoqs_measuredparameter_measurement_id_parameter_1328c3fb_uniq"
+                # Can't append data from source with bulk_create(), give appropriate warning
+                self.logger.exception(str(e))
+                self.logger.error(f'Failed to bulk_create() data from URL: {self.url}')
+                self.logger.error(f'If you need to load data that has been appended to the URL then delete its Activity before loading.')
+
+                return mps_loaded, path, parmCount
+            except KeyError as e:
+                # Likely an include_name variable has a bad coordinates attribute, give a better error message than just KeyError
+                self.logger.exception(str(e))
+                self.logger.error(f'Failed to bulk_create() data from URL: {self.url}')
+
+                return mps_loaded, path, parmCount
+
+            if self.dap_cache:
+                self.logger.info(f'DAP cache ({self.dap_cache.mode}): {self.dap_cache.hits} responses from cache,'
+                                 f' {self.dap_cache.misses} from {self.url}')
+
+            if mps_loaded:
+                with self.phase('post_process'):
+                    path = self._post_process_updates(mps_loaded, featureType)
+            rejected = self.report_rejected()
+
+            # Load of the Activity is complete, there is nothing left to resume
+            self.checkpoint.clear()
+            completed = True
+        finally:
+            if self.profile:
+                # Saved when the load fails too, with the phases done before the failure
+                try:
+                    self._save_load_profile(mps_loaded, featureType, rejected, completed)
+                except Exception as e:
+                    if completed:
+                        raise
+                    # Likely the database error that failed the load, which must not be replaced by this one
+                    self.logger.exception(f'Could not save profile of the failed load: {e}')
 
         return mps_loaded, path, parmCount
 
@@ -1805,7 +1983,7 @@ def runBEDTrajectoryLoader(url, cName, cDesc, aName, pName, pColor, pTypeName, a
     loader.logger.debug("Loaded Activity with name = %s", aName)
 
 def runDoradoLoader(url, cName, cDesc, aName, pName, pColor, pTypeName, aTypeName, parmList, 
-                    dbAlias, stride, grdTerrain=None, plotTimeSeriesDepth=None):
+                    dbAlias, stride, grdTerrain=None, plotTimeSeriesDepth=None, command_line_args=None):
     '''
     Run the DAPloader for Dorado AUVCTD trajectory data and update the Activity with 
     attributes resulting from the load into dbAlias. Designed to be called from script
@@ -1822,7 +2000,8 @@ def runDoradoLoader(url, cName, cDesc, aName, pName, pColor, pTypeName, aTypeNam
             platformColor = pColor,
             platformTypeName = pTypeName,
             stride = stride,
-            grdTerrain = grdTerrain)
+            grdTerrain = grdTerrain,
+            command_line_args = command_line_args)
 
     if parmList:
         loader.include_names = parmList
@@ -1866,7 +2045,7 @@ def runDoradoLoader(url, cName, cDesc, aName, pName, pColor, pTypeName, aTypeNam
                                         activityName = lopc_aName, activitytypeName = aTypeName,
                                         platformName = pName, platformColor = pColor,
                                         platformTypeName = pTypeName, stride = stride,
-                                        grdTerrain = grdTerrain)
+                                        grdTerrain = grdTerrain, command_line_args = command_line_args)
         except Exception:
             loader.logger.warn('No LOPC data to load at %s', lopc_url)
             return
@@ -28,6 +28,7 @@ from datetime import datetime, timedelta
 from decimal import Decimal
 from pydap.model import BaseType, DatasetType
 import csv
+import numpy as np
 from urllib.request import urlopen, HTTPError
 import requests
 import logging
@@ -115,6 +116,75 @@ def get_closest_instantpoint(aName, tv, dbAlias):
     return qs[i_min], secdiff[i_min]
 
 
+class InstantPointMatcher(object):
+    '''Find the InstantPoints closest in time to many time values with one query.
+    The timevalues of the InstantPoints of Activities with names containing aName
+    are read once into a sorted array and each lookup is a binary search of it,
+    rather than the series of widening time window queries that get_closest_instantpoint()
+    makes for every time value.  Usage:
+
+        matcher = InstantPointMatcher(activityName, dbAlias)
+        for ip, secs_diff in matcher.match(timevalues):
+            ...
+    '''
+    def __init__(self, aName, dbAlias, max_secs=86400):
+        self.max_secs = max_secs
+        ips = InstantPoint.objects.using(dbAlias).filter(activity__name__contains=aName
+                                    ).order_by('timevalue').values_list('id', 'timevalue', 'activity_id')
+        ids, timevalues, activity_ids = list(zip(*ips)) or ((), (), ())
+        self.ids = np.array(ids, dtype='int64')
+        self.activity_ids = np.array(activity_ids, dtype='int64')
+        self.timevalues = np.array(timevalues, dtype='datetime64[us]')
+        if len(self.ids) == 1:
+            # Duplicate a single point so that there is always a left and right neighbor to compare
+            self.ids, self.activity_ids, self.timevalues = (np.repeat(a, 2) for a in
+                                                (self.ids, self.activity_ids, self.timevalues))
+        logger.debug('Read %d InstantPoint timevalues for Activities with names containing %s', len(self.ids), aName)
+
+    def nearest(self, tvs):
+        '''Return (indices into the sorted timevalues, whole seconds difference) of the closest
+        timevalue to each of tvs.  The earlier point is chosen when two are equally close.
+        '''
+        tvs = np.atleast_1d(np.asarray(tvs, dtype='datetime64[us]'))
+        right = np.clip(np.searchsorted(self.timevalues, tvs), 1, len(self.timevalues) - 1)
+        left = right - 1
+        left_diff = np.abs(tvs - self.timevalues[left])
+        right_diff = np.abs(self.timevalues[right] - tvs)
+        use_right = right_diff < left_diff
+        indices = np.where(use_right, right, left)
+        diffs = np.where(use_right, right_diff, left_diff)
+
+        # Like timedelta.seconds: whole seconds, the fraction is dropped
+        return indices, diffs.astype('timedelta64[s]').astype('int64')
+
+    def match(self, tvs):
+        '''Return list of (InstantPoint, seconds difference) for the datetimes in tvs,
+        (None, None) for those not within max_secs of any InstantPoint
+        '''
+        if not len(self.timevalues):
+            return [(None, None)] * len(tvs)
+
+        indices, diffs = self.nearest(tvs)
+        matches = []
+        for i, secs_diff in zip(indices.tolist(), diffs.tolist()):
+            if secs_diff >= self.max_secs:
+                matches.append((None, None))
+            else:
+                matches.append((InstantPoint(id=int(self.ids[i]), timevalue=self.timevalues[i].item(),
+                                             activity_id=int(self.activity_ids[i])), secs_diff))
+
+        return matches
+
+    def closest(self, tv):
+        '''Return (InstantPoint, seconds difference) for datetime tv as get_closest_instantpoint() does
+        '''
+        ip, secs_diff = self.match([tv])[0]
+        if ip is None:
+            raise ClosestTimeNotFoundException
+
+        return ip, secs_diff
+
+
 class ParentSamplesLoader(STOQS_Loader):
     '''Holds methods customized for reading sample event information from mainly AUV syslog files
     '''
@@ -153,6 +223,7 @@ class ParentSamplesLoader(STOQS_Loader):
 
             r_decoded = (line.decode('utf-8') for line in r.iter_lines())
             reader = csv.DictReader(r_decoded, dialect='excel-tab')
+            matcher = InstantPointMatcher(activityName, dbAlias)
             for row in reader:
                 # Need to subtract 1 day from odv file as 1.0 == midnight on 1 January
                 try:
@@ -161,7 +232,7 @@ class ParentSamplesLoader(STOQS_Loader):
                     self.logger.error('%s.  Skipping this Sample - you may want to fix the input file', e)
                     continue
                 try:
-                    ip, seconds_diff = get_closest_instantpoint(activityName, timevalue, dbAlias)
+                    ip, seconds_diff = matcher.closest(timevalue)
                     point = 'POINT(%s %s)' % (repr(float(row[r'Lon (degrees_east)']) - 360.0), row[r'Lat (degrees_north)'])
                     stuple = Sample.objects.using(dbAlias).get_or_create( name = row[r'Bottle Number [count]'],
                                                                         depth = row[r'DEPTH [m]'],
@@ -457,9 +528,10 @@ class SeabirdLoader(STOQS_Loader):
                 loaded += 1
                 self.logger.debug("Inserted value (id=%(id)s) for %(pn)s = %(value)s", {'pn': pn, 'value': value, 'id': mp.pk})
 
-    def load_btl(self, lat, lon, depth, timevalue, bottleName):
+    def load_btl(self, lat, lon, depth, timevalue, bottleName, matcher=None):
         '''
-        Load a single Niskin Bottle sample
+        Load a single Niskin Bottle sample.  Pass an InstantPointMatcher for self.activityName
+        when loading several bottles so that the InstantPoints are read just once.
         '''
 
         # Get the Activity from the Database
@@ -480,7 +552,10 @@ class SeabirdLoader(STOQS_Loader):
         (sample_purpose, created) = SamplePurpose.objects.using(self.dbAlias).get_or_create(name = 'StandardDepth')
         self.logger.debug('samplepurpose %s, created = %s', sample_purpose, created)
         try:
-            ip, _ = get_closest_instantpoint(self.activityName, timevalue, self.dbAlias)
+            if matcher:
+                ip, _ = matcher.closest(timevalue)
+            else:
+                ip, _ = get_closest_instantpoint(self.activityName, timevalue, self.dbAlias)
             point = 'POINT(%s %s)' % (lon, lat)
             Sample.objects.using(self.dbAlias).get_or_create( name = bottleName,
                                                                     depth = str(depth),     # Must be str to convert to Decimal
@@ -579,6 +654,7 @@ class SeabirdLoader(STOQS_Loader):
         self.url = btlUrl
         self.add_parameters(self.ds)
 
+        bottles = []
         for r in csv.DictReader(open(tmpFile), delimiter=' ', skipinitialspace=True):
             dt = datetime(year, 1, 1, 0, 0, 0) + timedelta(days=float(r['TimeJ'])) - timedelta(days=1)
             ##esDiff = dt - datetime(1970, 1, 1, 0, 0, 0)
@@ -606,11 +682,14 @@ class SeabirdLoader(STOQS_Loader):
                         raise KeyError(e)
 
             self.load_data(lat, lon, float(r['DepSM']), dt, parmNameValues)
+            bottles.append((lat, lon, float(r['DepSM']), dt, bName))
 
-            # Load Bottle sample
+        # Load Bottle samples after their InstantPoints are all in the database
+        matcher = InstantPointMatcher(self.activityName, self.dbAlias)
+        for bottle in bottles:
             if _debug:
-                self.logger.info('Calling load_btl(%s,%s,%s,%s,%s)', lat, lon, float(r['DepSM']), dt, bName)
-            self.load_btl(lat, lon, float(r['DepSM']), dt, bName)
+                self.logger.info('Calling load_btl(%s,%s,%s,%s,%s)', *bottle)
+            self.load_btl(*bottle, matcher=matcher)
 
         os.remove(tmpFile)
 
@@ -16,29 +16,29 @@ import django
 django.setup()
 
 from collections import defaultdict
+from itertools import compress, groupby
 from django.conf import settings
 from django.contrib.gis.geos import Polygon
 from django.db.utils import IntegrityError
-from django.db import transaction, DatabaseError
+from django.db import connections, transaction, DatabaseError, DataError
 from django.db.models import Max, Min
 from stoqs import models as m
 from datetime import datetime
-from django.core.exceptions import ObjectDoesNotExist, MultipleObjectsReturned
-import time
+from django.core.exceptions import ObjectDoesNotExist
 import re
-import subprocess
 import math
 import numpy as np
-from coards import to_udunits
-import seawater.eos80 as sw
 import csv
 import requests
 from contextlib import closing
 import logging
-from utils.utils import percentile, median, mode, simplify_points, spiciness
-from tempfile import NamedTemporaryFile
+from utils.simplify import simplify_series
+from utils.sectiontiles import build_pyramid
+from scipy.spatial.qhull import QhullError
+from loaders import apstats, derived, timedecode
+from loaders.profiling import unprofiled
+from loaders.terrain import TerrainGrid, TerrainGridError
 import pprint
-from netCDF4 import Dataset
 
 
 # When settings.DEBUG is True Django will fill up a hash with stats on every insert done to the database.
@@ -57,9 +57,7 @@ X3D_MODEL_SCALEFACTOR = 'X3D_MODEL_scalefactor'
 X3DPLATFORMMODEL = 'x3dplatformmodel'
 
 # Parameter names created by STOQS Loads, shared with at least DAPloaders
-SIGMAT = 'sigmat'
-SPICE = 'spice'
-SPICINESS = 'Spiciness'
+from loaders.derived import SIGMAT, SPICE, SPICINESS  # noqa: F401 SPICINESS is imported from here by other loaders
 ALTITUDE = 'altitude'
 
 if settings.DEBUG:
@@ -67,10 +65,6 @@ if settings.DEBUG:
 
 missing_value = 1e-34
 
-def cmd_exists(cmd):
-    return subprocess.call("type " + cmd, shell=True,
-        stdout=subprocess.PIPE, stderr=subprocess.PIPE) == 0
-    
 
 class SkipRecord(Exception):
     pass
@@ -170,6 +164,29 @@ class LoadScript(object):
                             help='Stride value (default=1)')
         parser.add_argument('-a', '--append', action='store_true', 
                             help='Append data to existing activity - for use in repetative runs')
+        parser.add_argument('-w', '--workers', action='store', type=int, default=1,
+                            help='Number of worker processes for loading urls in parallel (default=1)')
+        parser.add_argument('--catalog_cache', action='store',
+                            help='Directory in which to cache THREDDS catalog XML between runs')
+        parser.add_argument('--dap_cache', action='store',
+                            help='Directory in which to cache OPeNDAP responses, for reloads and offline replay')
+        parser.add_argument('--dap_cache_mode', action='store', choices=('cache', 'record', 'replay'), default='cache',
+                            help='cache: use cached responses, fetching those not yet cached (default)\n'
+                                 'record: fetch all responses from the server and cache them\n'
+                                 'replay: use only cached responses, do not contact the server')
+        parser.add_argument('--resume', action='store_true',
+                            help='Resume failed loads, skipping data committed before their last checkpoints')
+        parser.add_argument('--copy', action='store_true',
+                            help='Use PostgreSQL COPY FROM STDIN in place of bulk_create() to load trajectory data')
+        parser.add_argument('--upsert', action='store_true',
+                            help='Use INSERT ... ON CONFLICT to reload timeseries and timeseriesprofile data\n'
+                                 'that overlap data already in the database')
+        parser.add_argument('--profile', action='store_true',
+                            help='Record the time, rows, database round trips and peak memory of each phase of\n'
+                                 'the load of an Activity and save the report as a Campaign Resource')
+        parser.add_argument('--section_tiles', action='store_true',
+                            help='Build depth-time section tile pyramids of each Activity and Parameter from which\n'
+                                 'the Query UI composes contoured sections')
         parser.add_argument('-v', '--verbose', action='store_true', 
                             help='Turn on DEBUG level logging output')
 
@@ -752,94 +769,113 @@ class STOQS_Loader(object):
             raise SkipRecord
 
         return measurement
-   
-    def is_coordinate_bad(self, key, mtime, depth, lat=None, lon=None, min_depth=-1000, max_depth=5000,
-                                         min_lat=-90, max_lat=90, min_lon=-720, max_lon=720):
-        '''Return True if coordinate is missing or fill_value, or falls outside of reasonable bounds
+
+    def phase(self, name):
+        '''Return context manager recording phase name of the load in self.profile, a
+        LoadProfile set when the --profile option is given.  It yields a Phase with rows to count.
         '''
-        # Missing value rejections
-        ac = self.coord_dicts[key]
-        if 'depth' in ac:   # Tolerate EPIC 'sensor_depth' type data
-            try:
-                if self.mv_by_key[ac['depth']]:
-                    if np.isclose(depth, self.mv_by_key[ac['depth']]):
-                        return True
-            except KeyError:
-                # Tolerate ac[DEPTH] == 0.0, or other value given in auxCoords
-                pass
+        profile = getattr(self, 'profile', None)
+        if profile:
+            return profile.phase(name)
 
-        if lat:
-            if self.mv_by_key[ac['latitude']]:
-                if np.isclose(lat, self.mv_by_key[ac['latitude']]):
-                    return True
+        return unprofiled(name)
 
-        if lon:
-            if self.mv_by_key[ac['longitude']]:
-                if np.isclose(lon, self.mv_by_key[ac['longitude']]):
-                    return True
+    @staticmethod
+    def _as_float_array(values):
+        '''Return values as a 1-d float64 array, non-numeric values (e.g. 'null') become NaN
+        '''
+        try:
+            return np.atleast_1d(np.asarray(values, dtype='float64')).ravel()
+        except (TypeError, ValueError):
+            floats = []
+            for value in values:
+                try:
+                    floats.append(float(value))
+                except (TypeError, ValueError):
+                    floats.append(np.nan)
+            return np.array(floats, dtype='float64')
 
-        # fill_value rejections
-        if 'depth' in ac:   # Tolerate EPIC 'sensor_depth' type data
+    def _flag_mask(self, key, values):
+        '''Return boolean array that is True where values match the missing_value or _FillValue of key
+        '''
+        mask = np.zeros(values.shape, dtype=bool)
+        for flags in (self.mv_by_key, self.fv_by_key):
             try:
-                if self.fv_by_key[ac['depth']]:
-                    if np.isclose(depth, self.fv_by_key[ac['depth']]):
-                        return True
-            except KeyError:
-                # Tolerate ac[DEPTH] == 0.0, or other value given in auxCoords
-                pass
-
-        if lat:
-            if self.fv_by_key[ac['latitude']]:
-                if np.isclose(lat, self.fv_by_key[ac['latitude']]):
-                    return True
-
-        if lon:
-            if self.fv_by_key[ac['longitude']]:
-                if np.isclose(lon, self.fv_by_key[ac['longitude']]):
-                    return True
+                flag = flags[key]
+            except (KeyError, TypeError):
+                # Tolerate key that is a value given in auxCoords, e.g. ac[DEPTH] == 0.0
+                continue
+            if flag:
+                mask |= np.isclose(values, flag)
 
-        # Brute force QC check on depth to remove egregous outliers
-        if depth < min_depth or depth > max_depth:
-            return True
+        return mask
 
-        if lat and lon:
-            # Brute force QC check on latitude and longitude to remove egregous outliers
-            if lat < min_lat or lat > max_lat:
-                return True
-            if lon < min_lon or lon > max_lon:
-                return True
-
-        # NaN value rejections - Ideally a Trajectory file won't have any NaN-valued coordinates, but sometimes people write them
-        try:
-            if np.isnan(lat) or np.isnan(lon):
-                return True
-        except TypeError:
-            # Likely TypeError: ufunc 'isnan' not supported for the input types, and the inputs could not be safely coerced to any supported types
-            pass
+    def bad_value_mask(self, key, values):
+        '''Return boolean array that is True where values are missing_value, _FillValue, NaN or inf
+        '''
+        values = self._as_float_array(values)
+        return ~np.isfinite(values) | self._flag_mask(key, values)
 
-        return False
+    def count_rejected(self, parameter, num):
+        '''Add num to the count of datavalues of parameter rejected before they were inserted
+        '''
+        if not hasattr(self, 'rejected_counts'):
+            self.rejected_counts = defaultdict(int)
+        self.rejected_counts[parameter] += int(num)
+
+    def screen_values(self, key, parameter, items, values):
+        '''Return list of the items (e.g. Measurements) and list of the float values that are not
+        bad values of key (see bad_value_mask()) so that only good datavalues are inserted.
+        The number left out is counted in self.rejected_counts[parameter].
+        '''
+        values = self._as_float_array(values)
+        good = ~self.bad_value_mask(key, values)
+        self.count_rejected(parameter, good.size - good.sum())
 
-    def is_value_bad(self, key, value):
-        if self.mv_by_key[key]:
-            if np.isclose(value, self.mv_by_key[key]):
-                return True
+        return list(compress(items, good)), values[good].tolist()
 
-        if self.fv_by_key[key]:
-            if np.isclose(value, self.fv_by_key[key]):
-                return True
+    def report_rejected(self):
+        '''Log the count of datavalues rejected before insert for each Parameter, return
+        dictionary of the counts keyed by Parameter name
+        '''
+        rejected = {p.name: n for p, n in getattr(self, 'rejected_counts', {}).items() if n}
+        for name, num in sorted(rejected.items()):
+            self.logger.info(f'Rejected {num} bad {name} datavalues before insert')
 
-        if value == 'null' or np.isnan(value):
-            return True
+        return rejected
 
-        return False
+    def bad_coordinate_mask(self, key, depths, latitudes=None, longitudes=None, min_depth=-1000, max_depth=5000,
+                            min_lat=-90, max_lat=90, min_lon=-720, max_lon=720):
+        '''Return boolean array that is True where a coordinate is missing, fill_value, NaN, or
+        falls outside of reasonable bounds.  Latitudes and longitudes are checked if provided.
+        '''
+        ac = self.coord_dicts[key]
+        depths = self._as_float_array(depths)
 
-    def good_coords(self, pnames, mtimes, depths, latitudes, longitudes):
-        '''Use attributes to determine if coordinate values are good.  Yield None
-        values for all coordinates if any are bad (e.g. _FillValue, time decreasing).
+        # Brute force QC check on depth to remove egregous outliers
+        mask = ~np.isfinite(depths) | (depths < min_depth) | (depths > max_depth)
+        if 'depth' in ac:   # Tolerate EPIC 'sensor_depth' type data
+            mask |= self._flag_mask(ac['depth'], depths)
+
+        if latitudes is not None and longitudes is not None:
+            latitudes = self._as_float_array(latitudes)
+            longitudes = self._as_float_array(longitudes)
+            # NaN value rejections - Ideally a Trajectory file won't have any NaN-valued coordinates, but sometimes people write them
+            mask |= ~np.isfinite(latitudes) | ~np.isfinite(longitudes)
+            mask |= (latitudes < min_lat) | (latitudes > max_lat)
+            mask |= (longitudes < min_lon) | (longitudes > max_lon)
+            mask |= self._flag_mask(ac['latitude'], latitudes)
+            mask |= self._flag_mask(ac['longitude'], longitudes)
+
+        return mask
+
+    def bad_coords(self, pnames, times, depths, latitudes, longitudes):
+        '''Use attributes to determine if coordinate values are good.  Return boolean arrays
+        (bad_coords, bad_times), bad_coords is True where any coordinate is bad (e.g. _FillValue),
+        bad_times is True where a time is duplicated or decreasing.
         Appropriate for trajectory data where there is one-to-one match of coordinates.
         '''
-        # Checking for duplicate or decreasing times is time consuming, do it for only known
-        # problematic sources of data
+        # Checking for duplicate or decreasing times is done for only known problematic sources of data
         known_dup_or_decr_time_sources = ('pctd', 'Daphne_ECOHAB_March2013')
 
         known_dup_or_decr_time_problem = False
@@ -848,37 +884,21 @@ class STOQS_Loader(object):
                 self.logger.info(f'Setting known_dup_or_decr_time_problem for known_dup_or_decr_time_source: {string}')
                 known_dup_or_decr_time_problem = True
 
-        # Coordinates (mtimes, depths, latitudes, longitudes) are generators read from the DAP URL as
-        # identified in CF metadata as associated with all variables in pnames - use just the first one 
-        # for .is_coordinate_bad() check
-        previous_times = []
-        for i, (mt, de, la, lo) in enumerate(zip(mtimes, depths, latitudes, longitudes)):
-            if self.is_coordinate_bad(pnames[0], mt, de, la, lo):
-                mt = None
-                de = None
-                la = None
-                lo = None
-
-            bad_time = False
-            if known_dup_or_decr_time_problem:
-                dup_time = False
-                decr_time = False
-                if mt in previous_times:
-                    self.logger.warn(f'Will not load data from duplicate time coordinate: {mt} at index {i}')
-                    dup_time = True
-                elif mt and i > 0 and previous_times:
-                    if mt <= previous_times[-1]:
-                        self.logger.warn(f'Will not load data from decreasing time coordinate: {mt} at index {i}')
-                        decr_time = True
-               
-                bad_time = dup_time or not mt or decr_time
-                self.logger.debug(f'{mt} at index {i}: bad_time = {bad_time}')
-
-                if not bad_time: 
-                    # Save only not None, non-duplicate, and non-decreasing times
-                    previous_times.append(mt)
-
-            yield mt, de, la, lo, bad_time
+        # Coordinates are identified in CF metadata as associated with all variables in pnames
+        # - use just the first one for the bad_coordinate_mask() check
+        times = self._as_float_array(times)
+        bad_coords = ~np.isfinite(times) | self.bad_coordinate_mask(pnames[0], depths, latitudes, longitudes)
+
+        bad_times = np.zeros(times.shape, dtype=bool)
+        if known_dup_or_decr_time_problem:
+            # A time is bad if it's not greater than all of the good times preceding it
+            good_times = np.where(bad_coords, -np.inf, times)
+            previous_max = np.concatenate(([-np.inf], np.maximum.accumulate(good_times)[:-1]))
+            bad_times = bad_coords | (times <= previous_max)
+            for i in np.flatnonzero(bad_times & ~bad_coords):
+                self.logger.warn(f'Will not load data from duplicate or decreasing time coordinate: {times[i]} at index {i}')
+
+        return bad_coords, bad_times
 
     def preProcessParams(self, row):
         '''
@@ -975,70 +995,41 @@ class STOQS_Loader(object):
     @staticmethod
     def update_ap_stats(dbAlias, activity, parameters, sampledFlag=False):
         '''Update the database with descriptive statistics for parameters
-        belonging to the activity.
+        belonging to the activity.  The statistics and histograms are computed
+        by the database for all parameters at once.
         '''
-        for p in list(parameters.keys()):
-            if sampledFlag:
-                data = m.SampledParameter.objects.using(dbAlias).filter(
-                                parameter=p, sample__instantpoint__activity=activity
-                                ).values_list('datavalue', flat=True)
-            else:
-                data = m.MeasuredParameter.objects.using(dbAlias).filter(
-                                parameter=p, measurement__instantpoint__activity=activity
-                                ).values_list('datavalue', flat=True)
-
-            # Just don't create an ActivityParameter for data that don't exist
-            if len(data) == 0:
-                continue
-
+        parameter_by_id = {p.id: p for p in parameters}
+        # Use smaller number of histogram bins for Sampled Parameters
+        bins = 10 if sampledFlag else 100
+        with connections[dbAlias].cursor() as cursor:
+            stats = apstats.parameter_stats(cursor, activity.id, parameter_by_id, sampledFlag)
+            try:
+                with transaction.atomic(using=dbAlias):
+                    modes = apstats.parameter_histograms(cursor, activity.id, stats, apstats.MODE_BINS, sampledFlag)
+                    histograms = apstats.parameter_histograms(cursor, activity.id, stats, bins, sampledFlag)
+            except DataError:
+                # Likely 'value out of range: overflow' from width_bucket() for really wild data, e.g. LRAUV:
+                # http://dods.mbari.org/opendap/data/lrauv/tethys/missionlogs/2015/20150824_20150825/20150825T055243/201508250552_201508250553_2S_eng.nc.ascii?control_inputs_mass_position[0:1:13]
+                # Contunue silently (as this is a static method) without the mode and histograms
+                modes, histograms = {}, {}
+
+        # Just don't create an ActivityParameter for data that don't exist
+        for parameter_id, values in stats.items():
             ap, _ = m.ActivityParameter.objects.using(dbAlias).get_or_create(
-                            parameter=p, activity=activity)
+                            parameter=parameter_by_id[parameter_id], activity=activity)
+            for name, value in values.items():
+                setattr(ap, name, value)
+            if parameter_id not in histograms:
+                ap.save(using=dbAlias)
+                continue
 
-            np_data = np.array([float(d) for d in data if d is not None])
-            np_data.sort()
-            ap.number = len(np_data)
-            try:
-                ap.min = np_data.min()
-                ap.max = np_data.max()
-            except ValueError as err:
-                if not err.args:
-                    err.args=('',)
-
-                err.args += (f'Parameter: {p}',)
-                raise
-
-            ap.mean = np_data.mean()
-            ap.median = median(list(np_data))
-            ap.mode = mode(np_data)
-            ap.p025 = percentile(list(np_data), 0.025)
-            ap.p975 = percentile(list(np_data), 0.975)
-            ap.p010 = percentile(list(np_data), 0.010)
-            ap.p990 = percentile(list(np_data), 0.990)
+            ap.mode = apstats.histogram_mode(modes[parameter_id])
             ap.save(using=dbAlias)
 
-            # Compute and save histogram, use smaller number of bins 
-            # for Sampled Parameters
-            if sampledFlag:
-                (counts, bins) = np.histogram(np_data,10)
-            else:
-                try:
-                    (counts, bins) = np.histogram(np_data,100)
-                except IndexError:
-                    # Likely something like 'index -9223372036854775808 is out of bounds for axis 1 with size 101' 
-                    # from numpy/lib/function_base.py.  Encoutered in really wild LRAUV data, e.g.:
-                    # http://dods.mbari.org/opendap/data/lrauv/tethys/missionlogs/2015/20150824_20150825/20150825T055243/201508250552_201508250553_2S_eng.nc.ascii?control_inputs_mass_position[0:1:13]
-                    # These kind of messages will appear in the log:
-                    # /vagrant/dev/stoqsgit/venv-stoqs/lib64/python3.6/site-packages/numpy/lib/function_base.py:766: RuntimeWarning: overflow encountered in double_scalars
-                    #  norm = n_equal_bins / (last_edge - first_edge)
-                    #/vagrant/dev/stoqsgit/venv-stoqs/lib64/python3.6/site-packages/numpy/lib/function_base.py:788: RuntimeWarning: invalid value encountered in multiply
-                    # tmp_a *= norm
-                    # Contunue silently (as this is a static method), with the above errors given as a warning.
-                    continue
-
-            for i,count in enumerate(counts):
-                m.ActivityParameterHistogram.objects.using(dbAlias).get_or_create(
-                        activityparameter=ap, bincount=count, 
-                        binlo=bins[i], binhi=bins[i+1])
+            m.ActivityParameterHistogram.objects.using(dbAlias).filter(activityparameter=ap).delete()
+            m.ActivityParameterHistogram.objects.using(dbAlias).bulk_create(
+                    m.ActivityParameterHistogram(activityparameter=ap, bincount=bincount, binlo=binlo, binhi=binhi)
+                    for binlo, binhi, bincount in histograms[parameter_id])
 
     @classmethod
     def update_activityparameter_stats(cls, dbAlias, activity, parameters, sampledFlag=False):
@@ -1067,6 +1058,95 @@ class STOQS_Loader(object):
 
         self.logger.info('Updated statistics for activity.name = %s', act.name)
 
+    def _rebuildSimpleDepthTime(self, critSimpleDepthTime, byNominalLocation=False, trajectoryProfileDepths=None):
+        '''
+        Read the depth time series of this activity, one for each NominalLocation if byNominalLocation,
+        with a single query, simplify each and replace the Activity's SimpleDepthTime points with one
+        bulk insert.  When appending data (self.dataStartDatetime is set) a series is simplified again
+        only from its last SimpleDepthTime point before the appended data, earlier points are kept.
+        Returns the number of points inserted.
+        '''
+        sdts = m.SimpleDepthTime.objects.using(self.dbAlias).filter(activity=self.activity)
+        start = getattr(self, 'dataStartDatetime', None)
+        anchors = {}
+        if start and not trajectoryProfileDepths:
+            anchors = dict(sdts.filter(instantpoint__timevalue__lt=start)
+                               .values_list('nominallocation_id')
+                               .annotate(Max('instantpoint__timevalue')))
+
+        mqs = m.Measurement.objects.using(self.dbAlias).filter(instantpoint__activity=self.activity)
+        order = ['instantpoint__timevalue']
+        if byNominalLocation:
+            mqs = mqs.filter(nominallocation__isnull=False)
+            order.insert(0, 'nominallocation_id')
+            series = list(m.NominalLocation.objects.using(self.dbAlias).filter(activity=self.activity)
+                                            .order_by('id').values_list('id', flat=True))
+        else:
+            series = [None]
+        if anchors and set(series) <= set(anchors):
+            # Only the Measurements from the earliest anchor on are needed when all series are anchored
+            mqs = mqs.filter(instantpoint__timevalue__gte=min(anchors.values()))
+        rows = mqs.order_by(*order).values_list('nominallocation_id' if byNominalLocation else 'instantpoint__activity_id',
+                                                'instantpoint__timevalue', 'depth', 'instantpoint_id')
+        keys, times, depths, pklookup = (list(column) for column in (list(zip(*rows)) or ((), (), (), ())))
+        self.logger.info('Number of points in original depth time series = %d', len(times))
+        if not times:
+            return 0
+
+        ems = 1000 * timedecode.to_udunits(times, 'seconds since 1970-01-01')
+        depths = np.array(depths, dtype='float64')
+        simple_sdts = []
+        series_deletes = []
+        for key, group in groupby(range(len(keys)), key=keys.__getitem__):
+            nl_id = key if byNominalLocation else None
+            idx = np.fromiter(group, dtype='int64')
+            series_depths = depths[idx]
+            if trajectoryProfileDepths:
+                # Depth columns are in the order of all of the NominalLocations, including any without Measurements
+                column = series.index(nl_id)
+                series_depths = np.array([d[column] for d in trajectoryProfileDepths[:len(idx)]], dtype='float64')
+                idx = idx[:len(series_depths)]
+            if nl_id in anchors:
+                anchor_ems = 1000 * timedecode.to_udunits([anchors[nl_id]], 'seconds since 1970-01-01')[0]
+                after = ems[idx] >= anchor_ems
+                idx, series_depths = idx[after], series_depths[after]
+                series_deletes.append(sdts.filter(nominallocation_id=nl_id, instantpoint__timevalue__gte=anchors[nl_id]))
+            elif start:
+                series_deletes.append(sdts.filter(nominallocation_id=nl_id))
+
+            keep = simplify_series(ems[idx], series_depths, critSimpleDepthTime)
+            self.logger.debug('Number of points in simplified depth time series for nominallocation_id = %s: %d',
+                              nl_id, len(keep))
+            simple_sdts.extend(m.SimpleDepthTime(activity=self.activity, nominallocation_id=nl_id,
+                                                 instantpoint_id=pklookup[idx[k]], depth=series_depths[k],
+                                                 epochmilliseconds=ems[idx[k]])
+                               for k in keep.tolist())
+
+        with transaction.atomic(using=self.dbAlias):
+            for series in (series_deletes if start else [sdts]):
+                series.delete()
+            m.SimpleDepthTime.objects.using(self.dbAlias).bulk_create(simple_sdts)
+
+        return len(simple_sdts)
+
+    def buildSectionTiles(self):
+        '''
+        Build the depth-time section tile pyramids of the Parameters of this activity so that contoured sections
+        in the Query UI are composed from them rather than gridding the MeasuredParameters of each request.
+        Return the number built; Parameters whose measurements cannot be gridded are skipped.
+        '''
+        count = 0
+        for parameter in m.Parameter.objects.using(self.dbAlias).filter(activityparameter__activity=self.activity):
+            try:
+                if build_pyramid(self.dbAlias, self.activity, parameter):
+                    count += 1
+            except (QhullError, ValueError) as e:
+                self.logger.warn(f'Could not build section tiles for {parameter.name}: {e}')
+
+        self.logger.info('Built section tiles for %d Parameters', count)
+
+        return count
+
     def insertSimpleDepthTimeSeries(self, critSimpleDepthTime=10):
         '''
         Read the time series of depth values for this activity, simplify it and insert the values in the
@@ -1075,130 +1155,62 @@ class STOQS_Loader(object):
         simple depth time series for display in flot.
         @param critSimpleDepthTime: An integer for the simplification factor, 10 is course, .0001 is fine
         '''
-        vlqs = (m.Measurement.objects.using(self.dbAlias)
-                        .filter(instantpoint__activity=self.activity)
-                        .values_list('instantpoint__timevalue', 'depth', 'instantpoint__pk'))
-        line = []
-        pklookup = []
-        for dt,dd,pk in vlqs:
-            ems = 1000 * to_udunits(dt, 'seconds since 1970-01-01')
-            d = float(dd)
-            line.append((ems,d,))
-            pklookup.append(pk)
-
-        self.logger.info('Number of points in original depth time series = %d', len(line))
-        ##self.logger.debug('line = %s', line)
-        try:
-            # Original simplify_points code modified: the index from the original line is added as 3rd item in the return
-            simple_line = simplify_points(line, critSimpleDepthTime)
-        except IndexError:
-            simple_line = []        # Likely "list index out of range" from a stride that's too big
-        self.logger.info('Number of points in simplified depth time series = %d', len(simple_line))
-        self.logger.debug('simple_line = %s', simple_line)
-
-        for t,d,k in simple_line:
-            try:
-                ip = m.InstantPoint.objects.using(self.dbAlias).get(id=pklookup[k])
-                m.SimpleDepthTime.objects.using(self.dbAlias).create(
-                                            activity=self.activity, 
-                                            instantpoint=ip,
-                                            depth=d, 
-                                            epochmilliseconds=t)
-            except ObjectDoesNotExist:
-                self.logger.warn('InstantPoint with id = %d does not exist; from point at index k = %d', pklookup[k], k)
-
-        self.logger.info('Inserted %d values into SimpleDepthTime', len(simple_line))
+        count = self._rebuildSimpleDepthTime(critSimpleDepthTime)
+        self.logger.info('Inserted %d values into SimpleDepthTime', count)
 
     def saveBottomDepth(self):
-        @transaction.atomic(using=self.dbAlias)
-        def _innerSaveBottomDepth(self):
-            '''
-            Read the time series of Parameter altitude and add to depth values to compute BottomDepth
-            and add it to the Measurement so that our Matplotlib plots can also ieasily include the depth profile.  
-            This procedure is suitable for only trajectory data.
-            '''
-            mpQS = m.MeasuredParameter.objects.using(self.dbAlias).select_related('measurement'
-                                          ).filter( datavalue__isnull=False,
-                                                    measurement__instantpoint__activity=self.activity, 
-                                                    parameter__standard_name='height_above_sea_floor')
-            count =  mpQS.count()
-            self.logger.info('mpQS.count() = %s', count)
-
-            counter = 0
-            for mp in mpQS:
-                counter += 1
+        '''
+        Add the altitude Parameter to depth values to compute BottomDepth and save it in the Measurement
+        so that our Matplotlib plots can also ieasily include the depth profile.  The Measurements of the
+        Activity are updated with a single UPDATE ... FROM statement.  This procedure is suitable for only
+        trajectory data.
+        '''
+        me = m.Measurement._meta.db_table
+        mp = m.MeasuredParameter._meta.db_table
+        ip = m.InstantPoint._meta.db_table
+        p = m.Parameter._meta.db_table
+        with transaction.atomic(using=self.dbAlias):
+            with connections[self.dbAlias].cursor() as cursor:
                 try:
-                    mp.measurement.bottomdepth = mp.measurement.depth + mp.datavalue
-                    mp.measurement.save(using=self.dbAlias)
+                    cursor.execute(f'''UPDATE {me} me SET bottomdepth = me.depth + mp.datavalue
+                                       FROM {mp} mp, {p} p, {ip} ip
+                                       WHERE mp.measurement_id = me.id AND p.id = mp.parameter_id
+                                         AND ip.id = me.instantpoint_id AND ip.activity_id = %s
+                                         AND p.standard_name = 'height_above_sea_floor' AND mp.datavalue IS NOT NULL''',
+                                   [self.activity.id])
                 except DatabaseError as e:
                     self.logger.warn(e)
+                    return
 
-                if counter % 10000 == 0:
-                    self.logger.info('%d of %d mp.measurement.bottomdepth records saved', counter, count)
-
-            return _innerSaveBottomDepth(self)
+                self.logger.info('%d measurement.bottomdepth records saved', cursor.rowcount)
 
     def insertSimpleBottomDepthTimeSeries(self, critSimpleBottomDepthTime=10):
-        @transaction.atomic(using=self.dbAlias)
-        def _innerInsertSimpleBottomDepthTimeSeries(self, critSimpleBottomDepthTime=10):
-            '''
-            Read the bottomdepth from Measurement for the Activity, simplify it 
-            and insert the values in the SimpleBottomDepthTime table that is related to the Activity.  
-            This procedure is suitable for only trajectory data.
-            @param critSimpleBottomDepthTime: An integer for the simplification factor, 10 is course, .0001 is fine
-            '''
-            tbdQS = m.MeasuredParameter.objects.using(self.dbAlias).filter(measurement__instantpoint__activity=self.activity
-                                          ).values('measurement__instantpoint__timevalue', 'measurement__bottomdepth',
-                                          'measurement__instantpoint__id')
-            count =  tbdQS.count()
-
-            # simplify_points() has a limit of how many points it can handle
-            maxRecords = .1e6
-            stride = 1
-            if count > maxRecords:
-                stride = int((count + maxRecords / 2)/ maxRecords)
-                self.logger.info('Striding tbdQS by %d to be kind to simplify_points()', stride)
-
-            # Now, get time and bottomdepth that we just saved for building the SimpleBottomDepth time series
-            line = []
-            pklookup = []
-            i = 0
-            counter = 0
-            for tbd in tbdQS:
-                i += 1
-                if i % stride == 0:
-                    counter += 1
-                    ems = 1000 * to_udunits(tbd['measurement__instantpoint__timevalue'], 'seconds since 1970-01-01')
-                    if tbd['measurement__bottomdepth']:
-                        line.append( (ems, tbd['measurement__bottomdepth']) )
-                        pklookup.append(tbd['measurement__instantpoint__id'])
-                        if counter % 10000 == 0:
-                            self.logger.info('%d of %d points read', counter, int(count / stride))
-
-            if line:
-                try:
-                    # Original simplify_points code modified: the index from the original line is added as 3rd item in the return
-                    self.logger.info('Calling simplify_points with len(line) = %d', len(line))
-                    simple_line = simplify_points(line, critSimpleBottomDepthTime)
-                except IndexError:
-                    simple_line = []        # Likely "list index out of range" from a stride that's too big
-            else:
-                simple_line = []
+        '''
+        Read the full resolution bottomdepth from Measurement for the Activity, simplify it 
+        and insert the values in the SimpleBottomDepthTime table that is related to the Activity.  
+        This procedure is suitable for only trajectory data.
+        @param critSimpleBottomDepthTime: An integer for the simplification factor, 10 is course, .0001 is fine
+        '''
+        tbds = (m.Measurement.objects.using(self.dbAlias)
+                        .filter(instantpoint__activity=self.activity, bottomdepth__isnull=False)
+                        .order_by('instantpoint__timevalue')
+                        .values_list('instantpoint__timevalue', 'bottomdepth', 'instantpoint__id'))
+        times, bottomdepths, pklookup = (list(column) for column in (list(zip(*tbds)) or ((), (), ())))
+        self.logger.info('Number of points in bottom depth time series = %d', len(times))
+        if not times:
+            return
 
-            self.logger.info('Number of points in simplified depth time series = %d', len(simple_line))
-            self.logger.debug('simple_line = %s', simple_line)
+        ems = (1000 * timedecode.to_udunits(times, 'seconds since 1970-01-01')).tolist()
+        keep = simplify_series(ems, bottomdepths, critSimpleBottomDepthTime).tolist()
+        self.logger.info('Number of points in simplified depth time series = %d', len(keep))
 
-            for t,d,k in simple_line:
-                try:
-                    ip = m.InstantPoint.objects.using(self.dbAlias).get(id = pklookup[k])
-                    m.SimpleBottomDepthTime.objects.using(self.dbAlias).create(
-                            activity=self.activity, instantpoint=ip, bottomdepth=d, epochmilliseconds=t)
-                except ObjectDoesNotExist:
-                    self.logger.warn('InstantPoint with id = %d does not exist; from point at index k = %d', pklookup[k], k)
-
-            self.logger.info('Inserted %d values into SimpleBottomDepthTime', len(simple_line))
+        with transaction.atomic(using=self.dbAlias):
+            m.SimpleBottomDepthTime.objects.using(self.dbAlias).bulk_create(
+                    m.SimpleBottomDepthTime(activity=self.activity, instantpoint_id=pklookup[k],
+                                            bottomdepth=bottomdepths[k], epochmilliseconds=ems[k])
+                    for k in keep)
 
-        return _innerInsertSimpleBottomDepthTimeSeries(self, critSimpleBottomDepthTime)
+        self.logger.info('Inserted %d values into SimpleBottomDepthTime', len(keep))
 
     def insertSimpleDepthTimeSeriesByNominalDepth(self, critSimpleDepthTime=10, trajectoryProfileDepths=None):
         '''
@@ -1206,90 +1218,11 @@ class STOQS_Loader(object):
         and insert the values in the SimpleDepthTime table that is related via the NominalLocations
         to the Activity.  This procedure is suitable for timeSeries and timeSeriesProfile data
         @param critSimpleDepthTime: An integer for the simplification factor, 10 is course, .0001 is fine
+        @param trajectoryProfileDepths: Time ordered list of the depths of each NominalLocation, in place of Measurement depths
         '''
-        for i,nl in enumerate(m.NominalLocation.objects.using(self.dbAlias).filter(activity=self.activity)):
-            nomDepth = nl.depth
-            self.logger.debug('nomDepth = %s', nomDepth)
-            # Collect depth time series into a timeseries by activity and nominal depth hash
-            ndlqs = m.Measurement.objects.using(self.dbAlias).filter( instantpoint__activity=self.activity, nominallocation__depth=nomDepth
-                                        ).values_list('instantpoint__timevalue', 'depth', 'instantpoint__pk').order_by('instantpoint__timevalue')
-            line = []
-            pklookup = []
-            if trajectoryProfileDepths:
-                self.logger.info('Loading time varying depths in SimpleDepthTime for nomDepth=%s', nomDepth)
-                for (dt,dd,pk), depths in zip(ndlqs, trajectoryProfileDepths):
-                    ems = 1000 * to_udunits(dt, 'seconds since 1970-01-01')
-                    d = depths[i]
-                    line.append((ems,d,))
-                    pklookup.append(pk)
-            else:
-                for dt,dd,pk in ndlqs:
-                    ems = 1000 * to_udunits(dt, 'seconds since 1970-01-01')
-                    d = float(dd)
-                    line.append((ems,d,))
-                    pklookup.append(pk)
-
-            self.logger.debug('line = %s', line)
-            self.logger.debug('Number of points in original depth time series = %d', len(line))
-            try:
-                # Original simplify_points code modified: the index from the original line is added as 3rd item in the return
-                simple_line = simplify_points(line, critSimpleDepthTime)
-            except IndexError:
-                simple_line = []        # Likely "list index out of range" from a stride that's too big
-            self.logger.debug('Number of points in simplified depth time series = %d', len(simple_line))
-            self.logger.debug('simple_line = %s', simple_line)
-            if len(simple_line) != 2:
-                self.logger.warn('len(simple_line) != 2. If appending data, then all points will be added to SimpleDepthTime')
-
-            if self.dataStartDatetime and len(simple_line) == 2:
-                # Assume that we are appending data. Make sure first time point exists
-                t0,d0,k0 = simple_line[0]
-                self.logger.debug('First point t0,d0,k0 = %s, %s, %s', t0,d0,k0)
-                try:
-                    ip = m.InstantPoint.objects.using(self.dbAlias).get(id = pklookup[k0])
-                    self.logger.debug('ip = %s', ip)
-                    m.SimpleDepthTime.objects.using(self.dbAlias).get_or_create(activity=self.activity, nominallocation=nl,
-                                                                                instantpoint=ip, depth=d0, epochmilliseconds=t0)
-                except ObjectDoesNotExist:
-                    self.logger.warn('InstantPoint with id = %d does not exist; from point at index k = %d', pklookup[k0], k0)
-                except MultipleObjectsReturned as e:
-                    self.logger.warn(e)
-                    firstPoints = m.SimpleDepthTime.objects.using(self.dbAlias).filter(activity=self.activity, nominallocation=nl,
-                                                                                       instantpoint=ip, depth=d0, epochmilliseconds=t0)
-                    self.logger.info('Deleting multiple points and creating just one.')
-                    for fp in firstPoints:
-                        fp.delete(using=self.dbAlias)
-                    m.SimpleDepthTime.objects.using(self.dbAlias).create(activity=self.activity, nominallocation=nl,
-                                                                         instantpoint=ip, depth=d0, epochmilliseconds=t0)
-
-                # Update last point's time value by first deleting all times at depth for the activity > first time point
-                t1,d1,k1 = simple_line[1]
-                self.logger.debug('Last point t1,d1,k1 = %s, %s, %s', t1,d1,k1)
-                lastPoints = m.SimpleDepthTime.objects.using(self.dbAlias).filter(
-                        activity=self.activity, nominallocation=nl, depth=d1, epochmilliseconds__gt=t0)
-                for lp in lastPoints:
-                    self.logger.debug('Deleting SimpleDepthTime point with epochmilliseconds=%s', lp.epochmilliseconds)
-                    lp.delete(using=self.dbAlias)
-                try:
-                    ip = m.InstantPoint.objects.using(self.dbAlias).get(id = pklookup[k1])
-                    self.logger.debug('ip = %s', ip)
-                    m.SimpleDepthTime.objects.using(self.dbAlias).create(activity=self.activity, nominallocation=nl,
-                                                                         instantpoint=ip, depth=d1, epochmilliseconds=t1)
-                except ObjectDoesNotExist:
-                    self.logger.warn('InstantPoint with id = %d does not exist; from point at index k = %d', pklookup[k1], k1)
-                
-            else:
-                for t,d,k in simple_line:
-                    self.logger.debug('t,d,k = %s, %s, %s', t,d,k)
-                    try:
-                        ip = m.InstantPoint.objects.using(self.dbAlias).get(id = pklookup[k])
-                        self.logger.debug('ip = %s', ip)
-                        m.SimpleDepthTime.objects.using(self.dbAlias).create(activity=self.activity, nominallocation=nl,
-                                                                         instantpoint=ip, depth=d, epochmilliseconds=t)
-                    except ObjectDoesNotExist:
-                        self.logger.warn('InstantPoint with id = %d does not exist; from point at index k = %d', pklookup[k], k)
-
-            self.logger.debug('Inserted %d values into SimpleDepthTime for nomDepth = %f', len(simple_line), nomDepth)
+        count = self._rebuildSimpleDepthTime(critSimpleDepthTime, byNominalLocation=True,
+                                             trajectoryProfileDepths=trajectoryProfileDepths)
+        self.logger.info('Inserted %d values into SimpleDepthTime for nominal depths', count)
 
     def updateActivityMinMaxDepth(self):
         '''
@@ -1329,34 +1262,6 @@ class STOQS_Loader(object):
                 except Exception as e:
                     self.logger.warn('%s: Cannot create ParameterGroupParameter name = %s for parameter.name = %s. Skipping.', e, groupName, p.name)
 
-    def _generate_sigmat_mps(self, p_sigmat, ms, salinity_standard_name):
-        '''Yield calculated sigmat from ms QuerySet
-        '''
-        for measurement in ms:
-            mps = m.MeasuredParameter.objects.using(self.dbAlias).filter(measurement=measurement)
-
-            temp_mp = mps.filter(parameter__standard_name='sea_water_temperature')
-            sal_mp = mps.filter(parameter__standard_name=salinity_standard_name)
-
-            sigmat = sw.pden(sal_mp[0].datavalue, temp_mp[0].datavalue, sw.pres(measurement.depth, measurement.geom.y)) - 1000.0
-            sigmat_mp = m.MeasuredParameter(measurement=measurement, parameter=p_sigmat, datavalue=sigmat)
-
-            yield sigmat_mp
-
-    def _generate_spice_mps(self, p_spice, ms, salinity_standard_name):
-        '''Yield calculated spice from ms QuerySet
-        '''
-        for measurement in ms:
-            mps = m.MeasuredParameter.objects.using(self.dbAlias).filter(measurement=measurement)
-
-            temp_mp = mps.filter(parameter__standard_name='sea_water_temperature')
-            sal_mp = mps.filter(parameter__standard_name=salinity_standard_name)
-
-            spice = spiciness(temp_mp[0].datavalue, sal_mp[0].datavalue)
-            spice_mp = m.MeasuredParameter(measurement=measurement, parameter=p_spice, datavalue=spice)
-            
-            yield spice_mp
-
     def _get_sea_water_parameters(self):
         '''Check for more than one set of sea_water_temperature nand sea_water_salinity standard names as in
         http://odss.mbari.org/thredds/dodsC/CANON/2016_Sep/Platforms/ROMS/roms_spray_0313.nc.html.
@@ -1409,147 +1314,114 @@ class STOQS_Loader(object):
     def addSigmaTandSpice(self, activity=None):
         ''' 
         For all measurements that have standard_name parameters of (sea_water_salinity or sea_water_practical_salinity) and sea_water_temperature 
-        compute sigma-t and add it as a parameter
+        compute sigma-t and spice and add them as parameters
         '''                 
-        # Find all measurements with 'sea_water_temperature' and ('sea_water_salinity' or 'sea_water_practical_salinity')
-        ms = m.Measurement.objects.using(self.dbAlias)
-        if activity:
-            self.logger.info(f'activity = {activity}')
-            ms = ms.filter(instantpoint__activity=activity)
+        # Legacy databases may have a 'spice' Parameter loaded from the data
+        names = {SPICE: 'stoqs_spice'} if 'spice' in self.include_names else {}
+        self.addDerivedParameters(activity, (SIGMAT, SPICE), names)
 
+    def addDerivedParameters(self, activity=None, derived_names=None, names=None):
+        '''
+        For all measurements of activity that have the input Parameters of the registered DerivedParameters
+        (all of them or those in derived_names) compute the derived values on whole arrays and bulk load them.
+        The names dictionary may map a DerivedParameter name to the name of the Parameter to load it as.
+        '''
+        activity = activity or self.activity
+        names = names or {}
         try:
-            sea_water_temperature_parm, sea_water_salinity_parm, salinity_standard_name = self._get_sea_water_parameters()
+            sea_water_temperature_parm, sea_water_salinity_parm, _ = self._get_sea_water_parameters()
         except NameError as e:
             self.logger.info(f'{e}')
-            self.logger.info("No sea_water_temperature and sea_water_salinity Parameters. Not adding SigmaT and Spice.")
+            self.logger.info("No sea_water_temperature and sea_water_salinity Parameters. Not adding derived Parameters.")
             return
 
-        ms = ms.filter(measuredparameter__parameter=sea_water_temperature_parm)
-        ms = ms.filter(measuredparameter__parameter=sea_water_salinity_parm)
+        # The salinity input is whichever of sea_water_salinity or sea_water_practical_salinity is present
+        inputs = {p.standard_name: p for p in self.parameter_dict.values() if p.standard_name}
+        inputs.update({derived.TEMPERATURE: sea_water_temperature_parm, derived.SALINITY: sea_water_salinity_parm})
 
-        if not ms:
-            self.logger.info("No sea_water_temperature and sea_water_salinity measurements. Not adding SigmaT and Spice.")
-            return
+        columns_by_inputs = {}
+        for name, dp in derived.REGISTRY.items():
+            if derived_names and name not in derived_names:
+                continue
+            if not all(standard_name in inputs for standard_name in dp.inputs):
+                self.logger.info(f'No Parameters with standard_names {dp.inputs}. Not adding {name}.')
+                continue
+
+            # Read the input arrays once for all DerivedParameters with the same inputs
+            if dp.inputs not in columns_by_inputs:
+                columns_by_inputs[dp.inputs] = derived.fetch_columns(self.dbAlias, activity,
+                                                    {k: inputs[k] for k in dp.inputs}, self.dataStartDatetime)
+            columns = columns_by_inputs[dp.inputs]
+            if not len(columns['measurement_id']):
+                self.logger.info(f'No Measurements with {dp.inputs} datavalues. Not adding {name}.')
+                continue
+
+            parameter = dp.get_parameter(self.dbAlias, names.get(name))
+            measurement_ids, values = derived.derive(dp, columns)
+            self.count_rejected(parameter, len(columns['measurement_id']) - len(values))
+            self.logger.info(f'Bulk loading {len(values)} {parameter} MeasuredParameters')
+            measurements = m.Measurement.objects.using(self.dbAlias).filter(instantpoint__activity=activity)
+            if self.dataStartDatetime:
+                measurements = measurements.filter(instantpoint__timevalue__gt=self.dataStartDatetime)
+            self._replace_measuredparameters(parameter, measurements,
+                    (m.MeasuredParameter(measurement_id=me_id, parameter=parameter, datavalue=value)
+                        for me_id, value in zip(measurement_ids.tolist(), values.tolist())))
+            self.parameter_counts[parameter] = len(values)
 
-        if self.dataStartDatetime:
-            ms = ms.filter(instantpoint__timevalue__gt=self.dataStartDatetime)
-
-        # Create our new Parameters
-        p_sigmat, _ = m.Parameter.objects.using(self.dbAlias).get_or_create(
-                standard_name='sea_water_sigma_t',
-                long_name='Sigma-T',
-                units='kg m-3',
-                name=SIGMAT,
-        )
-        if 'spice' in self.include_names:
-            p_spice, _ = m.Parameter.objects.using(self.dbAlias).get_or_create( 
-                    name='stoqs_spice',
-                    defaults={'long_name': SPICINESS}
-            )
-        else:
-            p_spice, _ = m.Parameter.objects.using(self.dbAlias).get_or_create( 
-                    name=SPICE,
-                    defaults={'long_name': SPICINESS}
-            )
-        # Update with descriptions, being kind to legacy databases
-        p_sigmat.description = ("Calculated in STOQS loader from Measured Parameters having standard_names"
-                                " sea_water_temperature and sea_water_salinity, and pressure converted from depth"
-                                " using seawater.eos80 module: sw.pden(s, t, sw.pres(me.depth, me.geom.y)) - 1000.0.")
-        p_sigmat.save(using=self.dbAlias)
-        p_spice.description = ("Calculated in STOQS loader from Measured Parameters having standard_names"
-                               " sea_water_temperature and sea_water_salinity using algorithm from Flament (2002):"
-                               " http://www.satlab.hawaii.edu/spice.")
-        p_spice.save(using=self.dbAlias)
-
-        self.parameter_counts[p_sigmat] = ms.count()
-        self.parameter_counts[p_spice] = ms.count()
-        self.assignParameterGroup(groupName=MEASUREDINSITU)
         self.assignParameterGroup(groupName=MEASUREDINSITU)
 
-        sigmat_mps = []
-        spice_mps = []
-        self.logger.info(f'Calculating {self.parameter_counts[p_sigmat]} sigmat & spice MeasuredParameters')
-        sigmat_mps = self._generate_sigmat_mps(p_sigmat, ms, salinity_standard_name)
-        spice_mps = self._generate_spice_mps(p_spice, ms, salinity_standard_name)
+    def _replace_measuredparameters(self, parameter, measurements, mps):
+        '''
+        Bulk load mps, MeasuredParameters of parameter, in place of any of parameter already loaded for
+        the Measurements of queryset measurements, so that post-processing interrupted part way through
+        can be done again by --resume.  Return the number loaded.
+        '''
+        with transaction.atomic(using=self.dbAlias):
+            deleted, _ = m.MeasuredParameter.objects.using(self.dbAlias).filter(parameter=parameter,
+                                            measurement__in=measurements).delete()
+            if deleted:
+                self.logger.info(f'Replacing {deleted} {parameter} MeasuredParameters loaded before')
 
-        self.logger.info(f'Bulk loading {self.parameter_counts[p_sigmat]} sigmat MeasuredParameters')
-        m.MeasuredParameter.objects.using(self.dbAlias).bulk_create(sigmat_mps)
-        self.logger.info(f'Bulk loading {self.parameter_counts[p_spice]} spice MeasuredParameters')
-        m.MeasuredParameter.objects.using(self.dbAlias).bulk_create(spice_mps)
+            return len(m.MeasuredParameter.objects.using(self.dbAlias).bulk_create(mps, batch_size=10000))
 
     def addAltitude(self, activity=None):
         ''' 
-        For all measurements lookup the water depth from a GMT grd file using grdtrack(1), 
+        For all measurements interpolate the water depth from the GMT grd file in self.grdTerrain,
         subtract the depth and add altitude as a new Parameter to the Measurement
         To be called from load script after process_command_line().
         '''
-        # Read the bounding box of the terrain file. The grdtrack command quietly does not write any lines for points outside of the grid.
-        if self.grdTerrain:
-            try:
-                fh = Dataset(self.grdTerrain)
-                # Old GMT format
-                xmin, xmax = fh.variables['x_range'][:]
-                ymin, ymax = fh.variables['y_range'][:]
-            except IOError as e:
-                self.logger.error(f'Cannot add {ALTITUDE}. Make sure file {self.grdTerrain} is present.')
-                self.logger.info(f'cd stoqs/loaders && wget https://stoqs.mbari.org/terrain/{self.grdTerrain}')
-            except KeyError as e:
-                try:
-                    # New GMT format
-                    xmin, xmax = fh.variables['lon'].actual_range
-                    ymin, ymax = fh.variables['lat'].actual_range
-                except Exception as e:
-                    try:
-                        # Yet another format (seen in SanPedroBasin50.grd)
-                        xmin, xmax = fh.variables['x'].actual_range
-                        ymin, ymax = fh.variables['y'].actual_range
-                    except Exception as e:
-                        self.logger.error(f'Cannot read range metadata from {self.grdTerrain}. Not able to load'
-                                          ' {ALTITUDE}, bottomdepth or simplebottomdepthtime')
-                        return
-            except Exception as e:
-                self.logger.exception(e)
-                return
-            finally:
-                fh.close()
-
-            bbox = Polygon.from_bbox( (xmin, ymin, xmax, ymax) )
-
-        # Build file of Measurement lon & lat for grdtrack to process
-        xyFileName = NamedTemporaryFile(dir='/dev/shm', prefix='STOQS_LatLon_', suffix='.txt').name
-        xyFH = open(xyFileName, 'w')
-        ms = m.Measurement.objects.using(self.dbAlias).filter(geom__within=bbox)
+        if not self.grdTerrain:
+            return
+
+        try:
+            grid = TerrainGrid(self.grdTerrain)
+        except TerrainGridError as e:
+            self.logger.error(f'Cannot add {ALTITUDE}. Make sure file {self.grdTerrain} is present. {e}')
+            self.logger.info(f'cd stoqs/loaders && wget https://stoqs.mbari.org/terrain/{self.grdTerrain.split("/")[-1]}')
+            return
+        except (KeyError, StopIteration, AttributeError) as e:
+            self.logger.error(f'Cannot read range metadata from {self.grdTerrain}. Not able to load'
+                              f' {ALTITUDE}, bottomdepth or simplebottomdepthtime')
+            return
+
+        bbox = Polygon.from_bbox(grid.bbox)
+        measurements = m.Measurement.objects.using(self.dbAlias).filter(geom__within=bbox)
         if activity:
-            ms = ms.filter(instantpoint__activity=activity)
-        ms = ms.order_by('instantpoint__activity__id', 'instantpoint__timevalue').values('id', 'geom', 'depth').distinct()
+            measurements = measurements.filter(instantpoint__activity=activity)
+        ms = measurements.order_by('instantpoint__activity__id', 'instantpoint__timevalue').values_list('id', 'geom', 'depth').distinct()
         mList = []
-        depthList = []
-        for me in ms:
-            mList.append(me['id'])
-            depthList.append(me['depth'])
-            xyFH.write("%f %f\n" % (me['geom'].x, me['geom'].y))
-
-        xyFH.close()
-        inputFileCount = len(mList)
-        self.logger.debug('Wrote file %s with %d records', xyFileName, inputFileCount)
-
-        # Requires GMT (yum install GMT)
-        bdepthFileName = NamedTemporaryFile(dir='/dev/shm', prefix='STOQS_BDepth', suffix='.txt').name
-        if cmd_exists('grdtrack'):
-            cmd = "grdtrack %s -V -G%s > %s" % (xyFileName, self.grdTerrain, bdepthFileName)
-        else:
-            # Assume we have GMT Version 5 installed
-            cmd = "gmt grdtrack %s -V -G%s > %s" % (xyFileName, self.grdTerrain, bdepthFileName)
-
-        self.logger.info('Executing %s' % cmd)
-        os.system(cmd)
-        if self.totalRecords > 1e6:
-            self.logger.info('This is lame... Sleeping 60 seconds to give time for system call to finish writing to %s', bdepthFileName)
-            time.sleep(60)
-        if self.totalRecords > 1e7:
-            self.logger.info('Sleeping another 300 seconds to give time for system call to'
-                             ' finish writing to %s for more than 10 million records', bdepthFileName)
-            time.sleep(300)
+        lons = []
+        lats = []
+        depths = []
+        for me_id, geom, depth in ms:
+            mList.append(me_id)
+            lons.append(geom.x)
+            lats.append(geom.y)
+            depths.append(depth)
+
+        altitudes = -grid.sample(lons, lats) - np.array(depths, dtype='float64')
+        good = np.isfinite(altitudes)
+        self.logger.info(f'Interpolated bottom depths from {self.grdTerrain} for {good.sum()} of {len(mList)} Measurements')
 
         # Create our new Parameter
         self.logger.debug('Getting or creating new altitude Parameter')
@@ -1557,42 +1429,36 @@ class STOQS_Loader(object):
             p_alt, _ = m.Parameter.objects.using(self.dbAlias).get_or_create(
                     standard_name='height_above_sea_floor',
                     long_name='Altitude',
-                    description=("Calculated in STOQS loader by using GMT's grdtrack(1) program on the Platform's"
-                                 " latitude, longitude values and differencing the Platform's depth with the"
-                                 " bottom depth data in file %s." % self.grdTerrain.split('/')[-1]),
+                    description=("Calculated in STOQS loader by bilinear interpolation of the bottom depth data in file"
+                                 " %s at the Platform's latitude, longitude values and differencing the Platform's"
+                                 " depth with it." % self.grdTerrain.split('/')[-1]),
                     units='m',
                     name=ALTITUDE,
-                    origin='https://github.com/stoqs/stoqs/blob/45f53d134d336fdbdb38f73959a2ce3be4148227/stoqs/loaders/__init__.py#L1216-L1322'
+                    origin='https://github.com/stoqs/stoqs/blob/master/stoqs/loaders/terrain.py'
             )
         except IntegrityError:
             # A bit of a mystery why sometimes this Exception happens (simply get p_alt if it happens):
             # IntegrityError: duplicate key value violates unique constraint "stoqs_parameter_name_key"
             p_alt = m.Parameter.objects.using(self.dbAlias).get(name=ALTITUDE)
 
-        self.parameter_counts[p_alt] = ms.count()
+        self.parameter_counts[p_alt] = len(mList)
+        self.count_rejected(p_alt, len(mList) - good.sum())
         self.assignParameterGroup(groupName=MEASUREDINSITU)
 
-        # Read values from the grid sampling (bottom depths) and add datavalues to the altitude parameter using the save Measurements
-        count = 0
-        with open(bdepthFileName) as altFH:
-            try:
-                with transaction.atomic():
-                    for line in altFH:
-                        bdepth = line.split()[2]
-                        alt = -float(bdepth)-depthList.pop(0)
-                        meas = m.Measurement.objects.using(self.dbAlias).get(id=mList.pop(0))
-                        mp_alt = m.MeasuredParameter(datavalue=alt, measurement=meas, parameter=p_alt)
-                        mp_alt.save(using=self.dbAlias)
-                        count += 1
-            except IntegrityError as e:
-                self.logger.warn(e)
-            except DatabaseError as e:
-                self.logger.warn(e)
-
-        # Cleanup and sanity check
-        os.remove(xyFileName)
-        os.remove(bdepthFileName)
-        if inputFileCount != count:
-            self.logger.warn('Counts are not equal! inputFileCount = %s, count from grdtrack output = %s', inputFileCount, count)
+        # Add datavalues to the altitude parameter for the Measurements in one bulk insert
+        mps = (m.MeasuredParameter(measurement_id=me_id, parameter=p_alt, datavalue=alt)
+                    for me_id, alt in zip(np.array(mList)[good].tolist(), altitudes[good].tolist()))
+        try:
+            count = self._replace_measuredparameters(p_alt, measurements, mps)
+        except IntegrityError as e:
+            self.logger.warn(e)
+            return
+        except DatabaseError as e:
+            self.logger.warn(e)
+            return
+
+        # Sanity check
+        if good.sum() != count:
+            self.logger.warn('Counts are not equal! Good altitude count = %s, count of altitudes loaded = %s', good.sum(), count)
 
         return
@@ -0,0 +1,96 @@
+'''
+ActivityParameter statistics and histograms computed in the database.
+
+Rather than reading every datavalue of an Activity into Python to sort it,
+the aggregates are computed by PostgreSQL for all Parameters of the Activity
+at once: min, max, mean and percentile_cont() percentiles grouped by
+Parameter, and histograms counted with width_bucket() over equal width bins.
+'''
+
+import logging
+from stoqs import models as m
+
+logger = logging.getLogger(__name__)
+
+# Percentiles saved in ActivityParameter, percentile_cont() interpolates as utils.utils.percentile() does
+PERCENTILES = (('median', 0.5), ('p025', 0.025), ('p975', 0.975), ('p010', 0.010), ('p990', 0.990))
+
+# Number of bins from which ActivityParameter.mode is found, as in utils.utils.mode()
+MODE_BINS = 99
+
+
+def _data_sql(sampledFlag):
+    '''Return SQL selecting (parameter_id, datavalue) of the finite datavalues of an Activity's Parameters,
+    with parameters %(activity_id)s and %(parameter_ids)s
+    '''
+    ip = m.InstantPoint._meta.db_table
+    if sampledFlag:
+        sp = m.SampledParameter._meta.db_table
+        sample = m.Sample._meta.db_table
+        sql = f'''SELECT sp.parameter_id, sp.datavalue::float8 AS datavalue FROM {sp} sp
+                  JOIN {sample} s ON s.id = sp.sample_id
+                  JOIN {ip} ip ON ip.id = s.instantpoint_id'''
+    else:
+        mp = m.MeasuredParameter._meta.db_table
+        me = m.Measurement._meta.db_table
+        sql = f'''SELECT mp.parameter_id, mp.datavalue FROM {mp} mp
+                  JOIN {me} me ON me.id = mp.measurement_id
+                  JOIN {ip} ip ON ip.id = me.instantpoint_id'''
+
+    # NaN sorts above all other values and would be a bound for width_bucket(), leave it and +/-inf out
+    return f'''SELECT parameter_id, datavalue FROM ({sql} WHERE ip.activity_id = %(activity_id)s
+                                                      AND parameter_id = ANY(%(parameter_ids)s)) AS activity_data
+               WHERE datavalue IS NOT NULL AND datavalue NOT IN ('NaN', 'Infinity', '-Infinity')'''
+
+
+def parameter_stats(cursor, activity_id, parameter_ids, sampledFlag=False):
+    '''Return dictionary keyed by parameter_id of dictionaries of number, min, max, mean and the
+    PERCENTILES of the datavalues.  Parameters with no datavalues are not in the dictionary.
+    '''
+    cursor.execute(f'''SELECT parameter_id, count(*), min(datavalue), max(datavalue), avg(datavalue),
+                              percentile_cont(%(percents)s) WITHIN GROUP (ORDER BY datavalue)
+                       FROM ({_data_sql(sampledFlag)}) AS data GROUP BY parameter_id''',
+                   {'activity_id': activity_id, 'parameter_ids': list(parameter_ids),
+                    'percents': [percent for _, percent in PERCENTILES]})
+
+    stats = {}
+    for parameter_id, number, min_, max_, mean, percentiles in cursor.fetchall():
+        stats[parameter_id] = dict(number=number, min=min_, max=max_, mean=mean)
+        stats[parameter_id].update(zip((name for name, _ in PERCENTILES), percentiles))
+
+    return stats
+
+
+def parameter_histograms(cursor, activity_id, parameter_ids, bins, sampledFlag=False):
+    '''Return dictionary keyed by parameter_id of lists of (binlo, binhi, bincount) for bins
+    equal width bins between the min and max datavalue.  As for numpy.histogram() the last bin
+    includes the max value and the range is widened by 0.5 either side for a single value.
+    '''
+    cursor.execute(f'''WITH data AS ({_data_sql(sampledFlag)}),
+                       bounds AS (SELECT parameter_id,
+                                    CASE WHEN min(datavalue) = max(datavalue) THEN min(datavalue) - 0.5 ELSE min(datavalue) END AS lo,
+                                    CASE WHEN min(datavalue) = max(datavalue) THEN max(datavalue) + 0.5 ELSE max(datavalue) END AS hi
+                                  FROM data GROUP BY parameter_id),
+                       counts AS (SELECT d.parameter_id, LEAST(width_bucket(d.datavalue, r.lo, r.hi, %(bins)s), %(bins)s) AS bin,
+                                         count(*) AS bincount
+                                  FROM data d JOIN bounds r ON r.parameter_id = d.parameter_id GROUP BY 1, 2)
+                       SELECT r.parameter_id, r.lo + (b.bin - 1) * (r.hi - r.lo) / %(bins)s,
+                              r.lo + b.bin * (r.hi - r.lo) / %(bins)s, COALESCE(c.bincount, 0)
+                       FROM bounds r CROSS JOIN generate_series(1, %(bins)s) AS b(bin)
+                       LEFT JOIN counts c ON c.parameter_id = r.parameter_id AND c.bin = b.bin
+                       ORDER BY r.parameter_id, b.bin''',
+                   {'activity_id': activity_id, 'parameter_ids': list(parameter_ids), 'bins': bins})
+
+    histograms = {}
+    for parameter_id, binlo, binhi, bincount in cursor.fetchall():
+        histograms.setdefault(parameter_id, []).append((binlo, binhi, bincount))
+
+    return histograms
+
+
+def histogram_mode(histogram):
+    '''Return middle of the (first) fullest bin of histogram, a list of (binlo, binhi, bincount)
+    '''
+    binlo, binhi, _ = max(histogram, key=lambda b: b[2])
+
+    return (binlo + binhi) / 2.0
@@ -0,0 +1,209 @@
+'''
+Set-based write paths for loading large volumes of measurement data into a
+STOQS database.  PostgreSQL's COPY FROM STDIN is used in place of Django's
+bulk_create() so that rows are streamed to the server without constructing
+ORM objects or compiling batched INSERT statements.
+
+Primary keys are reserved from each table's sequence one batch at a time,
+this lets the ids be handed back to the caller for use as foreign keys in
+the next table loaded: InstantPoint -> Measurement -> MeasuredParameter.
+
+For reloads of data that may overlap rows already in the database the
+upsert_*() methods COPY rows into a temporary staging table and move them
+into place with INSERT ... ON CONFLICT, so that existing rows are reused
+(or updated) in one statement per batch rather than with get_or_create()
+calls for each row.
+'''
+
+import io
+import logging
+import math
+from itertools import islice
+from django.db import connections, transaction
+from stoqs.models import InstantPoint, Measurement, MeasuredParameter
+
+logger = logging.getLogger(__name__)
+
+# Number of rows sent in each COPY statement
+COPY_BATCH_SIZE = 100000
+
+# Text format representation of a NULL value for COPY
+NULL = r'\N'
+
+
+def _batches(iterable, size):
+    '''Yield lists of up to size items from iterable
+    '''
+    it = iter(iterable)
+    while True:
+        batch = list(islice(it, size))
+        if not batch:
+            return
+        yield batch
+
+
+def format_float(value):
+    '''Return COPY text representation of a floating point value
+    '''
+    if value is None:
+        return NULL
+    value = float(value)
+    if math.isnan(value):
+        return 'NaN'
+    if math.isinf(value):
+        return 'Infinity' if value > 0 else '-Infinity'
+    return repr(value)
+
+
+def format_array(values):
+    '''Return COPY text representation of a float[] value
+    '''
+    if values is None:
+        return NULL
+    return '{' + ','.join(format_float(v) for v in values) + '}'
+
+
+def format_id(value):
+    '''Return COPY text representation of a nullable foreign key
+    '''
+    if value is None:
+        return NULL
+    return str(int(value))
+
+
+def format_time(dt):
+    '''Return COPY text representation of a naive UTC datetime (USE_TZ = False)
+    '''
+    return dt.isoformat(' ')
+
+
+def format_point(lon, lat, srid=4326):
+    '''Return COPY text representation of a PostGIS point as EWKT
+    '''
+    return f'SRID={srid};POINT({float(lon)!r} {float(lat)!r})'
+
+
+class CopyIngest(object):
+    '''Stream rows into the InstantPoint, Measurement and MeasuredParameter tables
+    using COPY FROM STDIN.  Each copy_*() method returns the list of primary keys
+    assigned to the rows, in the order that the rows were given.
+    '''
+    def __init__(self, dbAlias, batch_size=COPY_BATCH_SIZE):
+        self.dbAlias = dbAlias
+        self.batch_size = batch_size
+
+    def _reserve_ids(self, cursor, table, count):
+        cursor.execute("SELECT nextval(pg_get_serial_sequence(%s, 'id')) FROM generate_series(1, %s)",
+                       [table, count])
+        return [row[0] for row in cursor.fetchall()]
+
+    def _copy(self, table, columns, rows):
+        '''Copy rows (tuples of COPY formatted strings, without the id) into table
+        '''
+        ids = []
+        sql = f"COPY {table} (id, {', '.join(columns)}) FROM STDIN"
+        with transaction.atomic(using=self.dbAlias):
+            with connections[self.dbAlias].cursor() as cursor:
+                for batch in _batches(rows, self.batch_size):
+                    batch_ids = self._reserve_ids(cursor, table, len(batch))
+                    buf = io.StringIO()
+                    for id_, row in zip(batch_ids, batch):
+                        buf.write(str(id_))
+                        buf.write('\t')
+                        buf.write('\t'.join(row))
+                        buf.write('\n')
+                    buf.seek(0)
+                    cursor.copy_expert(sql, buf)
+                    ids.extend(batch_ids)
+                    logger.debug('Copied %d rows into %s', len(batch_ids), table)
+
+        return ids
+
+    def copy_instantpoints(self, activity_id, timevalues):
+        '''Copy datetimes in timevalues into InstantPoint for activity_id
+        '''
+        rows = ((str(activity_id), format_time(tv)) for tv in timevalues)
+        return self._copy(InstantPoint._meta.db_table, ('activity_id', 'timevalue'), rows)
+
+    def copy_measurements(self, coords):
+        '''Copy coords, tuples of (instantpoint_id, depth, longitude, latitude), into Measurement
+        '''
+        rows = ((str(ip_id), format_float(de), format_point(lo, la)) for ip_id, de, lo, la in coords)
+        return self._copy(Measurement._meta.db_table, ('instantpoint_id', 'depth', 'geom'), rows)
+
+    def copy_measuredparameters(self, parameter_id, values):
+        '''Copy values, tuples of (measurement_id, datavalue, dataarray), into MeasuredParameter
+        '''
+        rows = ((str(me_id), str(parameter_id), format_float(dv), format_array(da))
+                for me_id, dv, da in values)
+        return self._copy(MeasuredParameter._meta.db_table,
+                          ('measurement_id', 'parameter_id', 'datavalue', 'dataarray'), rows)
+
+    def _upsert(self, table, columns, key, rows, update=()):
+        '''Insert rows (tuples of COPY formatted strings, without the id) into table.  Rows
+        whose key columns match an existing row are not inserted, the update columns of the
+        existing row are set from them instead.  Return the list of primary keys of the new
+        or existing rows in the order that the rows were given.
+        '''
+        ids = []
+        staging = f'{table}_upsert'
+        cols = ', '.join(columns)
+        keys = ', '.join(key)
+        if update:
+            # A row may be updated only once per statement, the last of duplicate keys wins
+            select = f'SELECT DISTINCT ON ({keys}) {cols} FROM {staging} ORDER BY {keys}, ord DESC'
+            conflict = 'DO UPDATE SET ' + ', '.join(f'{c} = EXCLUDED.{c}' for c in update)
+        else:
+            select = f'SELECT {cols} FROM {staging} ORDER BY ord'
+            conflict = 'DO NOTHING'
+        join = ' AND '.join(f't.{k} = s.{k}' for k in key)
+
+        with transaction.atomic(using=self.dbAlias):
+            with connections[self.dbAlias].cursor() as cursor:
+                cursor.execute(f'DROP TABLE IF EXISTS {staging}')
+                cursor.execute(f'CREATE TEMPORARY TABLE {staging} ON COMMIT DROP AS '
+                               f'SELECT 0::bigint AS ord, {cols} FROM {table} WITH NO DATA')
+                for batch in _batches(rows, self.batch_size):
+                    buf = io.StringIO()
+                    for ord_, row in enumerate(batch, start=len(ids)):
+                        buf.write(str(ord_))
+                        buf.write('\t')
+                        buf.write('\t'.join(row))
+                        buf.write('\n')
+                    buf.seek(0)
+                    cursor.execute(f'TRUNCATE {staging}')
+                    cursor.copy_expert(f'COPY {staging} (ord, {cols}) FROM STDIN', buf)
+                    cursor.execute(f'INSERT INTO {table} ({cols}) {select} ON CONFLICT ({keys}) {conflict}')
+                    num_written = cursor.rowcount
+                    cursor.execute(f'SELECT t.id FROM {staging} s JOIN {table} t ON {join} ORDER BY s.ord')
+                    ids.extend(row[0] for row in cursor.fetchall())
+                    logger.debug('Upserted %d rows into %s: %d %s', len(batch), table, num_written,
+                                 'inserted or updated' if update else 'inserted')
+
+        return ids
+
+    def upsert_instantpoints(self, activity_id, timevalues):
+        '''Insert datetimes in timevalues into InstantPoint for activity_id, reusing existing InstantPoints
+        '''
+        rows = ((str(activity_id), format_time(tv)) for tv in timevalues)
+        return self._upsert(InstantPoint._meta.db_table, ('activity_id', 'timevalue'),
+                            ('activity_id', 'timevalue'), rows)
+
+    def upsert_measurements(self, coords):
+        '''Insert coords, tuples of (instantpoint_id, depth, longitude, latitude, nominallocation_id),
+        into Measurement, reusing existing Measurements
+        '''
+        rows = ((str(ip_id), format_float(de), format_point(lo, la), format_id(nl_id))
+                for ip_id, de, lo, la, nl_id in coords)
+        return self._upsert(Measurement._meta.db_table, ('instantpoint_id', 'depth', 'geom', 'nominallocation_id'),
+                            ('instantpoint_id', 'depth', 'geom'), rows)
+
+    def upsert_measuredparameters(self, parameter_id, values):
+        '''Insert values, tuples of (measurement_id, datavalue, dataarray), into MeasuredParameter,
+        replacing the datavalue and dataarray of existing MeasuredParameters
+        '''
+        rows = ((str(me_id), str(parameter_id), format_float(dv), format_array(da))
+                for me_id, dv, da in values)
+        return self._upsert(MeasuredParameter._meta.db_table,
+                            ('measurement_id', 'parameter_id', 'datavalue', 'dataarray'),
+                            ('measurement_id', 'parameter_id'), rows, update=('datavalue', 'dataarray'))
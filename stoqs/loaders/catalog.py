@@ -0,0 +1,241 @@
+'''
+Concurrent crawler for THREDDS catalogs.  Walking a catalog tree one request
+at a time (as thredds_crawler does) spends nearly all of its time waiting on
+the server; here up to max_in_flight catalog fetches are outstanding at once.
+
+Catalog XML may also be cached on disk.  Cached entries are keyed by the url
+and the Last-Modified header returned by the server, a conditional GET with
+If-Modified-Since is made for urls already in the cache so that an unchanged
+catalog is read from disk without being transferred again.
+'''
+
+import hashlib
+import json
+import logging
+import os
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from urllib.parse import urljoin
+
+import requests
+from lxml import etree
+
+logger = logging.getLogger(__name__)
+
+INV_NS = 'http://www.unidata.ucar.edu/namespaces/thredds/InvCatalog/v1.0'
+XLINK_NS = 'http://www.w3.org/1999/xlink'
+
+# Maximum number of catalog requests outstanding at any time
+MAX_IN_FLIGHT = 8
+
+# Same default skips as thredds_crawler's Crawl.SKIPS
+SKIPS = ['.*files.*', '.*Individual Files.*', '.*File_Access.*', '.*Forecast Model Run.*',
+         '.*Constant Forecast Offset.*', '.*Constant Forecast Date.*']
+
+
+class CatalogError(Exception):
+    pass
+
+
+class CatalogCache(object):
+    '''Catalog XML stored in cache_dir.  An index file for each url records the
+    Last-Modified value of the most recent response, the XML itself is stored
+    under a name derived from both the url and Last-Modified.
+    '''
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def _path(self, *keys):
+        digest = hashlib.sha256('\n'.join(keys).encode('utf-8')).hexdigest()
+        return os.path.join(self.cache_dir, digest)
+
+    def last_modified(self, url):
+        '''Return Last-Modified of the cached copy of url, None if it's not cached
+        '''
+        try:
+            with open(self._path(url) + '.json') as f:
+                last_modified = json.load(f)['last_modified']
+        except (OSError, ValueError, KeyError):
+            return None
+
+        if not os.path.exists(self._path(url, last_modified) + '.xml'):
+            return None
+
+        return last_modified
+
+    def get(self, url, last_modified):
+        with open(self._path(url, last_modified) + '.xml', 'rb') as f:
+            return f.read()
+
+    def put(self, url, last_modified, content):
+        # Write to temporary files and rename so that concurrent crawls never see partial files
+        xml_file = self._path(url, last_modified) + '.xml'
+        with open(xml_file + '.tmp', 'wb') as f:
+            f.write(content)
+        os.replace(xml_file + '.tmp', xml_file)
+
+        index_file = self._path(url) + '.json'
+        with open(index_file + '.tmp', 'w') as f:
+            json.dump({'url': url, 'last_modified': last_modified}, f)
+        os.replace(index_file + '.tmp', index_file)
+
+
+class CatalogCrawler(object):
+    '''Find OPeNDAP urls of datasets in THREDDS catalogs and all of the catalogs
+    they reference.  Usage:
+
+        crawler = CatalogCrawler(cache_dir='/tmp/catalogs')
+        urls = crawler.crawl(['http://dods.mbari.org/thredds/catalog/auv/dorado/2018/netcdf/catalog.xml'],
+                             select=['.*_decim.nc$'])
+    '''
+    def __init__(self, max_in_flight=MAX_IN_FLIGHT, cache_dir=None, timeout=60):
+        self.max_in_flight = max_in_flight
+        self.cache = CatalogCache(cache_dir) if cache_dir else None
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def _session(self):
+        # requests.Session is not documented as thread safe, use one per thread
+        if not hasattr(self._local, 'session'):
+            self._local.session = requests.Session()
+        return self._local.session
+
+    def fetch(self, url):
+        '''Return the parsed catalog at url, reading it from the cache if unchanged on the server
+        '''
+        headers = {}
+        last_modified = self.cache.last_modified(url) if self.cache else None
+        if last_modified:
+            headers['If-Modified-Since'] = last_modified
+
+        r = self._session().get(url, headers=headers, timeout=self.timeout)
+        if r.status_code == 304:
+            logger.debug(f'Reading unmodified {url} from cache')
+            content = self.cache.get(url, last_modified)
+        elif r.status_code == 200:
+            content = r.content
+            if self.cache and r.headers.get('Last-Modified'):
+                self.cache.put(url, r.headers['Last-Modified'], content)
+        else:
+            raise CatalogError(f'Status {r.status_code} returned for {url}')
+
+        try:
+            return etree.XML(content)
+        except etree.XMLSyntaxError as e:
+            raise CatalogError(f'Cannot parse {url}: {e}')
+
+    @staticmethod
+    def _matches(patterns, value):
+        return value is not None and any(p.match(value) for p in patterns)
+
+    def catalog_refs(self, url, tree, skip=SKIPS):
+        '''Return list of (title, url) for the catalogRefs in tree, skipping titles that match skip
+        '''
+        skips = [re.compile(s) for s in skip]
+        refs = []
+        for ref in tree.findall(f'.//{{{INV_NS}}}catalogRef'):
+            title = ref.get(f'{{{XLINK_NS}}}title')
+            if self._matches(skips, title):
+                continue
+            refs.append((title, urljoin(url, ref.get(f'{{{XLINK_NS}}}href'))))
+
+        return refs
+
+    def _opendap_bases(self, tree):
+        '''Return dict of service name to base path for OPeNDAP services, including
+        those nested in compound services
+        '''
+        bases = {}
+        for service in tree.iter(f'{{{INV_NS}}}service'):
+            if service.get('serviceType', '').lower() == 'opendap':
+                bases[service.get('name')] = service.get('base')
+
+        return bases
+
+    def _service_name(self, dataset):
+        # serviceName may be an attribute, a child element, or inherited metadata of a parent dataset
+        node = dataset
+        while node is not None and node.tag == f'{{{INV_NS}}}dataset':
+            if node.get('serviceName'):
+                return node.get('serviceName')
+            name = node.find(f'{{{INV_NS}}}serviceName')
+            if name is None:
+                name = node.find(f'{{{INV_NS}}}metadata/{{{INV_NS}}}serviceName')
+            if name is not None:
+                return name.text.strip()
+            node = node.getparent()
+
+        return None
+
+    def opendap_urls(self, url, tree, select=None, skip=SKIPS):
+        '''Return OPeNDAP urls of datasets in tree whose ID matches select and whose name does not match skip
+        '''
+        selects = [re.compile(s) for s in select] if select else None
+        skips = [re.compile(s) for s in skip]
+        bases = self._opendap_bases(tree)
+        if not bases:
+            return []
+
+        urls = []
+        for dataset in tree.iter(f'{{{INV_NS}}}dataset'):
+            url_path = dataset.get('urlPath')
+            if not url_path or self._matches(skips, dataset.get('name')):
+                continue
+            if selects and not self._matches(selects, dataset.get('ID') or url_path):
+                continue
+            base = bases.get(self._service_name(dataset)) or next(iter(bases.values()))
+            urls.append(urljoin(url, base + url_path))
+
+        return urls
+
+    def _crawl_one(self, url, select, skip):
+        tree = self.fetch(url)
+        return (self.opendap_urls(url, tree, select, skip),
+                [ref_url for _, ref_url in self.catalog_refs(url, tree, skip)])
+
+    def crawl(self, urls, select=None, skip=SKIPS):
+        '''Return list of OPeNDAP urls found by crawling the catalogs in urls and all
+        catalogs that they reference.  The urls are returned in the same order as a
+        depth first walk of the catalogs would find them.
+        '''
+        results = {}
+        pending = {}
+        with ThreadPoolExecutor(max_workers=self.max_in_flight) as executor:
+            def submit(catalog_url):
+                if catalog_url not in results and catalog_url not in pending.values():
+                    pending[executor.submit(self._crawl_one, catalog_url, select, skip)] = catalog_url
+
+            for url in urls:
+                submit(url)
+            while pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    catalog_url = pending.pop(future)
+                    try:
+                        results[catalog_url] = future.result()
+                        logger.debug(f'Crawled {catalog_url}')
+                    except (CatalogError, requests.RequestException) as e:
+                        # Like thredds_crawler, don't let one bad catalogRef stop the crawl
+                        logger.warning(f'Skipping {catalog_url}: {e}')
+                        results[catalog_url] = ([], [])
+                    for ref_url in results[catalog_url][1]:
+                        submit(ref_url)
+
+        found = []
+        visited = set()
+        def walk(catalog_url):
+            if catalog_url in visited:
+                return
+            visited.add(catalog_url)
+            datasets, refs = results[catalog_url]
+            found.extend(datasets)
+            for ref_url in refs:
+                walk(ref_url)
+
+        for url in urls:
+            walk(url)
+
+        return found
+
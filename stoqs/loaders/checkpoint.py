@@ -0,0 +1,83 @@
+'''
+Checkpoints for resuming a load that failed part way through.
+
+As each set of coordinates and each Parameter's MeasuredParameters are
+committed by a DAP loader the index range loaded is recorded as a Resource
+of ResourceType 'load_checkpoint' associated with the Activity.  Loading
+again with --resume skips what the checkpoints show was committed for the
+same index range and stride.  The post-processing that follows is not
+checkpointed, it is done again in full: the derived Parameters and altitude
+replace any MeasuredParameters of theirs loaded before the failure.  The
+checkpoints are removed when the load of the Activity completes.
+'''
+
+import json
+import logging
+from django.db import transaction
+from stoqs.models import Resource, ResourceType, ActivityResource
+
+logger = logging.getLogger(__name__)
+
+CHECKPOINT = 'load_checkpoint'
+
+
+class LoadCheckpoint(object):
+    '''Get and record checkpoints, dictionaries of index range and other state, by name for activity
+    '''
+    def __init__(self, activity, dbAlias):
+        self.activity = activity
+        self.dbAlias = dbAlias
+
+    def _resources(self, name=None):
+        resources = Resource.objects.using(self.dbAlias).filter(resourcetype__name=CHECKPOINT,
+                                        activityresource__activity=self.activity)
+        if name:
+            resources = resources.filter(name=name)
+
+        return resources
+
+    def get(self, name):
+        '''Return the checkpoint recorded for name, None if there is none
+        '''
+        resource = self._resources(name).first()
+        if resource:
+            return json.loads(resource.value)
+
+        return None
+
+    def matches(self, name, index_range):
+        '''Return the checkpoint recorded for name if it was for index_range, else None
+        '''
+        checkpoint = self.get(name)
+        if checkpoint and all(checkpoint.get(k) == v for k, v in index_range.items()):
+            return checkpoint
+
+        if checkpoint:
+            logger.warning(f'Checkpoint for {name} is for a different index range: {checkpoint}, not using it')
+
+        return None
+
+    def record(self, name, **state):
+        '''Save state as the checkpoint for name, replacing any previous one
+        '''
+        with transaction.atomic(using=self.dbAlias):
+            resource = self._resources(name).first()
+            if resource:
+                resource.value = json.dumps(state)
+                resource.save(using=self.dbAlias)
+            else:
+                resourceType, _ = ResourceType.objects.using(self.dbAlias).get_or_create(name=CHECKPOINT,
+                                    defaults={'description': 'Index range committed by a load, for resuming it'})
+                resource = Resource.objects.using(self.dbAlias).create(name=name, value=json.dumps(state),
+                                    resourcetype=resourceType)
+                ActivityResource.objects.using(self.dbAlias).create(activity=self.activity, resource=resource)
+
+        logger.debug(f'Checkpoint {name}: {state}')
+
+    def clear(self):
+        '''Remove all checkpoints for the activity
+        '''
+        num, _ = self._resources().delete()
+        if num:
+            logger.debug(f'Removed {num} checkpoint objects for {self.activity}')
+
@@ -0,0 +1,126 @@
+'''
+Local cache of OPeNDAP responses for the DAP loaders.
+
+DAPCache is a WSGI application given to pydap's open_url() so that all of the
+DDS, DAS and data (.dods) requests made for a dataset pass through it.  Each
+request url - the dataset url, variable and index range constraint - is mapped
+to the SHA-256 digest of its response body, bodies are stored once under their
+digest.  In 'replay' mode responses are served only from the cache so that a
+load can be repeated offline, e.g. for reloading after a schema change or for
+benchmarking; a request not in the cache raises DAPCacheMiss.
+'''
+
+import hashlib
+import json
+import logging
+import os
+from urllib.parse import unquote
+
+import requests
+from webob import Request, Response
+
+logger = logging.getLogger(__name__)
+
+# 'cache': serve from cache, fetch and store what's not there
+# 'record': always fetch from the server and store the response
+# 'replay': serve from cache only, never contact the server
+MODES = ('cache', 'record', 'replay')
+
+# Response headers that pydap may look at, others (e.g. Content-Encoding) are not replayed
+HEADERS = ('Content-Type', 'Content-Description', 'XDODS-Server', 'XOPeNDAP-Server', 'XDAP')
+
+
+class DAPCacheMiss(Exception):
+    pass
+
+
+class DAPCache(object):
+    '''WSGI application that serves OPeNDAP responses from cache_dir, usage:
+
+        ds = open_url(url, application=DAPCache('/tmp/dapcache', mode='replay'))
+    '''
+    def __init__(self, cache_dir, mode='cache', timeout=600):
+        if mode not in MODES:
+            raise ValueError(f'mode must be one of {MODES}')
+        self.cache_dir = cache_dir
+        self.mode = mode
+        self.timeout = timeout
+        self.hits = 0
+        self.misses = 0
+        for subdir in ('requests', 'objects'):
+            os.makedirs(os.path.join(cache_dir, subdir), exist_ok=True)
+
+    @staticmethod
+    def key(url):
+        '''Return digest of url, with its constraint expression unquoted so that equivalent requests match
+        '''
+        return hashlib.sha256(unquote(url).encode('utf-8')).hexdigest()
+
+    def _request_file(self, url):
+        return os.path.join(self.cache_dir, 'requests', self.key(url) + '.json')
+
+    def _object_file(self, digest):
+        return os.path.join(self.cache_dir, 'objects', digest[:2], digest)
+
+    def get(self, url):
+        '''Return (status, headers, body) for url from the cache, None if it's not there
+        '''
+        try:
+            with open(self._request_file(url)) as f:
+                entry = json.load(f)
+            with open(self._object_file(entry['digest']), 'rb') as f:
+                body = f.read()
+        except (OSError, ValueError, KeyError):
+            return None
+
+        return entry['status'], entry['headers'], body
+
+    def put(self, url, status, headers, body):
+        '''Store body of the response to url under its content digest
+        '''
+        digest = hashlib.sha256(body).hexdigest()
+        object_file = self._object_file(digest)
+        if not os.path.exists(object_file):
+            os.makedirs(os.path.dirname(object_file), exist_ok=True)
+            with open(object_file + '.tmp', 'wb') as f:
+                f.write(body)
+            os.replace(object_file + '.tmp', object_file)
+
+        request_file = self._request_file(url)
+        with open(request_file + '.tmp', 'w') as f:
+            json.dump({'url': url, 'status': status, 'headers': headers, 'digest': digest}, f)
+        os.replace(request_file + '.tmp', request_file)
+
+    def fetch(self, url):
+        '''Return (status, headers, body) for url from the server
+        '''
+        r = requests.get(url, timeout=self.timeout)
+        headers = {h: r.headers[h] for h in HEADERS if h in r.headers}
+
+        return r.status_code, headers, r.content
+
+    def __call__(self, environ, start_response):
+        url = Request(environ).url
+        cached = None
+        if self.mode != 'record':
+            cached = self.get(url)
+
+        if cached:
+            self.hits += 1
+            status, headers, body = cached
+        elif self.mode == 'replay':
+            raise DAPCacheMiss(f'{url} is not in the cache in {self.cache_dir}')
+        else:
+            self.misses += 1
+            status, headers, body = self.fetch(url)
+            # Don't store errors, they may be transient
+            if status == 200:
+                self.put(url, status, headers, body)
+
+        logger.debug(f'{self.mode}: {status} {len(body)} bytes for {url}')
+        response = Response(body=body, status=status)
+        for name, value in headers.items():
+            response.headers[name] = value
+
+        return response(environ, start_response)
+
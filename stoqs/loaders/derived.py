@@ -0,0 +1,130 @@
+'''
+Columnar stage for Parameters that STOQS derives from other Measured Parameters.
+
+The datavalues of the input Parameters of an Activity are read with one query
+into NumPy arrays aligned by Measurement, each derived quantity is computed on
+the whole arrays at once and the results are bulk inserted.  A derived
+quantity is added by registering a DerivedParameter whose compute function
+takes the dictionary of input arrays, e.g.:
+
+    register(DerivedParameter('buoyancy_frequency', ('sea_water_sigma_t',), compute_n2, units='s-1'))
+
+Input arrays are keyed by the standard_name of the input Parameters, the
+coordinate arrays 'depth', 'latitude' and 'longitude' are also provided.
+'''
+
+import logging
+from collections import OrderedDict
+import numpy as np
+import seawater.eos80 as sw
+from django.db import connections
+from stoqs import models as m
+from utils.utils import spiciness
+
+logger = logging.getLogger(__name__)
+
+# Parameter names created by STOQS Loads, shared with loaders and DAPloaders
+SIGMAT = 'sigmat'
+SPICE = 'spice'
+SPICINESS = 'Spiciness'
+
+TEMPERATURE = 'sea_water_temperature'
+SALINITY = 'sea_water_salinity'
+
+
+class DerivedParameter(object):
+    '''A Parameter computed by compute(columns) from the arrays of the Parameters with
+    standard_names in inputs.  The other arguments are for creating the Parameter.
+    '''
+    def __init__(self, name, inputs, compute, standard_name=None, long_name=None, units=None, description=None):
+        self.name = name
+        self.inputs = tuple(inputs)
+        self.compute = compute
+        self.standard_name = standard_name
+        self.long_name = long_name
+        self.units = units
+        self.description = description
+
+    def get_parameter(self, dbAlias, name=None):
+        '''Return the Parameter for the derived values, created if not yet in the database
+        '''
+        parameter, _ = m.Parameter.objects.using(dbAlias).get_or_create(name=name or self.name,
+                            defaults={'standard_name': self.standard_name, 'long_name': self.long_name,
+                                      'units': self.units})
+        # Update with description, being kind to legacy databases
+        if self.description and parameter.description != self.description:
+            parameter.description = self.description
+            parameter.save(using=dbAlias)
+
+        return parameter
+
+
+# Derived Parameters in the order that they are computed
+REGISTRY = OrderedDict()
+
+
+def register(derived):
+    REGISTRY[derived.name] = derived
+    return derived
+
+
+def _sigmat(columns):
+    return sw.pden(columns[SALINITY], columns[TEMPERATURE], sw.pres(columns['depth'], columns['latitude'])) - 1000.0
+
+
+def _spice(columns):
+    return spiciness(columns[TEMPERATURE], columns[SALINITY])
+
+
+register(DerivedParameter(SIGMAT, (TEMPERATURE, SALINITY), _sigmat, standard_name='sea_water_sigma_t',
+                long_name='Sigma-T', units='kg m-3',
+                description=("Calculated in STOQS loader from Measured Parameters having standard_names"
+                             " sea_water_temperature and sea_water_salinity, and pressure converted from depth"
+                             " using seawater.eos80 module: sw.pden(s, t, sw.pres(me.depth, me.geom.y)) - 1000.0.")))
+register(DerivedParameter(SPICE, (TEMPERATURE, SALINITY), _spice, long_name=SPICINESS,
+                description=("Calculated in STOQS loader from Measured Parameters having standard_names"
+                             " sea_water_temperature and sea_water_salinity using algorithm from Flament (2002):"
+                             " http://www.satlab.hawaii.edu/spice.")))
+
+
+def fetch_columns(dbAlias, activity, parameters, start=None):
+    '''Return dictionary of arrays aligned by Measurement for the Measurements of activity
+    that have a datavalue for all of parameters, a dictionary of key to Parameter.  Keys are
+    'measurement_id', 'depth', 'latitude', 'longitude' and the keys of parameters.
+    Measurements after datetime start only are returned if start is given.
+    '''
+    keys = list(parameters)
+    me = m.Measurement._meta.db_table
+    ip = m.InstantPoint._meta.db_table
+    mp = m.MeasuredParameter._meta.db_table
+    joins = ' '.join(f'JOIN {mp} mp{i} ON mp{i}.measurement_id = me.id AND mp{i}.parameter_id = %s'
+                     for i in range(len(keys)))
+    sql = ('SELECT me.id, me.depth, ST_Y(me.geom), ST_X(me.geom), '
+           + ', '.join(f'mp{i}.datavalue' for i in range(len(keys)))
+           + f' FROM {me} me JOIN {ip} ip ON ip.id = me.instantpoint_id {joins} WHERE ip.activity_id = %s')
+    params = [parameters[k].id for k in keys] + [activity.id]
+    if start:
+        sql += ' AND ip.timevalue > %s'
+        params.append(start)
+
+    with connections[dbAlias].cursor() as cursor:
+        cursor.execute(sql + ' ORDER BY me.id', params)
+        rows = cursor.fetchall()
+
+    columns = {}
+    names = ['measurement_id', 'depth', 'latitude', 'longitude'] + keys
+    values = list(zip(*rows)) or [()] * len(names)
+    for name, column in zip(names, values):
+        columns[name] = np.array(column, dtype='int64' if name == 'measurement_id' else 'float64')
+
+    return columns
+
+
+def derive(derived, columns):
+    '''Return (measurement ids, values) of the finite values of derived computed from columns
+    '''
+    with np.errstate(invalid='ignore', divide='ignore', over='ignore'):
+        values = np.asarray(derived.compute(columns), dtype='float64')
+    good = np.isfinite(values)
+
+    return columns['measurement_id'][good], values[good]
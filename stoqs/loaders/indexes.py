@@ -0,0 +1,114 @@
+'''
+Runtime management of the indexes of the tables that bulk loads write to most.
+
+Loading into MeasuredParameter, Measurement and InstantPoint is faster
+without their secondary indexes (e.g. on datavalue, depth, geom and
+timevalue) being updated on every insert.  An IndexManager drops those
+indexes in the database, leaving the primary key, unique and foreign key
+indexes that loads depend on, and rebuilds them afterwards with
+CREATE INDEX CONCURRENTLY so that the tables remain readable.
+
+Each dropped index's definition is recorded as a Resource of ResourceType
+'dropped_index' before it is dropped, so that a load that fails or is killed
+leaves the record of what to restore in the database itself:
+
+    manager = IndexManager(dbAlias)
+    with manager.dropped():
+        ... load ...
+
+or restore() at any later time, e.g. with load.py --restore_indexes.
+'''
+
+import logging
+from contextlib import contextmanager
+from django.db import connections
+from stoqs.models import InstantPoint, Measurement, MeasuredParameter, Resource, ResourceType
+
+logger = logging.getLogger(__name__)
+
+DROPPED_INDEX = 'dropped_index'
+
+HOT_MODELS = (MeasuredParameter, Measurement, InstantPoint)
+
+
+class IndexManager(object):
+    '''Drop and restore the secondary indexes of HOT_MODELS in database dbAlias
+    '''
+    def __init__(self, dbAlias, models=HOT_MODELS):
+        self.dbAlias = dbAlias
+        self.tables = [model._meta.db_table for model in models]
+
+    def _resources(self):
+        return Resource.objects.using(self.dbAlias).filter(resourcetype__name=DROPPED_INDEX)
+
+    def secondary_indexes(self):
+        '''Return list of (index name, table name, index definition) of the indexes of the tables
+        that are not for a primary key, unique constraint or foreign key
+        '''
+        with connections[self.dbAlias].cursor() as cursor:
+            cursor.execute('''SELECT i.relname, t.relname, pg_get_indexdef(i.oid)
+                              FROM pg_index x
+                              JOIN pg_class i ON i.oid = x.indexrelid
+                              JOIN pg_class t ON t.oid = x.indrelid
+                              WHERE t.relname = ANY(%s) AND NOT x.indisprimary AND NOT x.indisunique
+                                AND NOT EXISTS (SELECT 1 FROM pg_constraint c
+                                                WHERE c.conrelid = t.oid AND c.contype = 'f'
+                                                  AND c.conkey = string_to_array(x.indkey::text, ' ')::int2[])
+                              ORDER BY t.relname, i.relname''', [self.tables])
+            return cursor.fetchall()
+
+    def drop(self):
+        '''Record and drop the secondary indexes, return the names of those dropped
+        '''
+        rt, _ = ResourceType.objects.using(self.dbAlias).get_or_create(name=DROPPED_INDEX,
+                        defaults={'description': 'Definition of an index dropped for loading, to be restored'})
+        dropped = []
+        for name, table, definition in self.secondary_indexes():
+            # Recorded first so that the definition is never lost
+            Resource.objects.using(self.dbAlias).get_or_create(name=name, resourcetype=rt,
+                                                               defaults={'uristring': table, 'value': definition})
+            logger.info(f'Dropping index {name} on {table}')
+            with connections[self.dbAlias].cursor() as cursor:
+                cursor.execute(f'DROP INDEX CONCURRENTLY IF EXISTS {name}')
+            dropped.append(name)
+
+        return dropped
+
+    def _index_state(self, name):
+        '''Return None if index name does not exist, else whether it is valid
+        '''
+        with connections[self.dbAlias].cursor() as cursor:
+            cursor.execute('''SELECT x.indisvalid FROM pg_index x JOIN pg_class i ON i.oid = x.indexrelid
+                              WHERE i.relname = %s''', [name])
+            row = cursor.fetchone()
+
+        return row[0] if row else None
+
+    def restore(self):
+        '''Rebuild the indexes recorded as dropped and remove their records, return the names
+        of those rebuilt.  An invalid index left by a failed concurrent build is rebuilt.
+        '''
+        restored = []
+        for resource in self._resources().order_by('id'):
+            state = self._index_state(resource.name)
+            with connections[self.dbAlias].cursor() as cursor:
+                if state is False:
+                    logger.info(f'Dropping invalid index {resource.name}')
+                    cursor.execute(f'DROP INDEX CONCURRENTLY IF EXISTS {resource.name}')
+                if not state:
+                    logger.info(f'Creating index {resource.name} on {resource.uristring}')
+                    cursor.execute(resource.value.replace('CREATE INDEX', 'CREATE INDEX CONCURRENTLY', 1))
+                    restored.append(resource.name)
+            resource.delete(using=self.dbAlias)
+
+        return restored
+
+    @contextmanager
+    def dropped(self):
+        '''Context manager with the secondary indexes dropped, restored on leaving even if the load fails
+        '''
+        self.drop()
+        try:
+            yield self
+        finally:
+            self.restore()
@@ -20,8 +20,6 @@ django.setup()
 import time
 import logging
 import datetime
-import fileinput
-import glob
 import importlib
 import platform
 import socket
@@ -36,6 +34,7 @@ from django.db import transaction, connections
 from slacker import Slacker
 from stoqs.models import ResourceType, Resource, Campaign, CampaignResource, MeasuredParameter, \
                          SampledParameter, Activity, Parameter, Platform
+from indexes import IndexManager
 from timing import MINUTES
 
 def tail(f, n):
@@ -173,46 +172,6 @@ class Loader(object):
                 load_command.endswith('.sh') or 
                 '&&' in load_command)
 
-    def _drop_indexes(self):
-        # As of 2017 the STOQS project does not commit migration files.
-        # If significant schema changes are made the SOP is to reload databases;
-        # this also helps ensure that the archived NetCDF files are still accessible.
-        # To try loading data with more efficiency in the database this method
-        # removes migrations and modifies the models.py file to remove indexes.
-        # The migration files need to be removed because of this Django patch:
-        # https://code.djangoproject.com/ticket/28052
-        migration_files = glob.glob(os.path.join(app_dir, 'stoqs/migrations', '00*.py'))
-        for m_f in migration_files:
-            if '0001_initial.py' not in m_f:
-                self.logger.info('Removing migration file: %s', m_f)
-                os.remove(m_f)
-
-        model_files = (os.path.join(app_dir, 'stoqs/migrations/0001_initial.py'),
-                       os.path.join(app_dir, 'stoqs/models.py'))
-        with fileinput.input(files=model_files, inplace=True, backup='.bak') as f:
-            for line in f:
-                if '_index=True' in line:
-                    print(line.replace('_index=True', '_index=False'), end='')
-                else:
-                    print(line, end='')
-
-    def _create_indexes(self):
-        # Add indexes back to models.py
-        ##migration_files = glob.glob(os.path.join(app_dir, 'stoqs/migrations', '00*.py'))
-        ##for m_f in migration_files:
-        ##    if '0001_initial.py' not in m_f:
-        ##        self.logger.info('Removing migration file: %s', m_f)
-        ##        os.remove(m_f)
-
-        model_file = os.path.join(app_dir, 'stoqs/models.py')
-        ##model_file = os.path.join(app_dir, 'stoqs/migrations/0001_initial.py')
-        with fileinput.input(files=(model_file,), inplace=True) as f:
-            for line in f:
-                if '_index=False' in line:
-                    print(line.replace('_index=False', '_index=True'), end='')
-                else:
-                    print(line, end='')
-
     def checks(self):
         # That stoqs/campaigns.py file can be loaded
         try:
@@ -414,6 +373,18 @@ local   all             all                                     peer
             if ret != 0:
                 self.logger.warn('Failed to drop %s', db)
 
+    def restore_indexes(self):
+        '''Create the indexes recorded as dropped in the databases of the --db option
+        '''
+        for db in self.args.db or []:
+            if db not in settings.DATABASES:
+                settings.DATABASES[db] = settings.DATABASES.get('default').copy()
+                settings.DATABASES[db]['NAME'] = db
+
+            self.logger.info('Creating indexes dropped from %s', db)
+            restored = IndexManager(db).restore()
+            self.logger.info('Created indexes: %s', ', '.join(restored) or 'None')
+
     def list(self):
         stoqs_campaigns = []
         campaigns = importlib.import_module(self.args.campaigns)
@@ -492,17 +463,16 @@ local   all             all                                     peer
                     # If running test for all databases just go on to next database
                     continue
 
-            if self.args.drop_indexes:
-                self.logger.info('Dropping indexes...')
-                self._drop_indexes()
-            else:
-                call_command('makemigrations', 'stoqs', settings='config.settings.local', noinput=True)
-
+            call_command('makemigrations', 'stoqs', settings='config.settings.local', noinput=True)
             call_command('migrate', settings='config.settings.local', noinput=True, database=db)
 
             if create_only:
                 return
 
+            if self.args.drop_indexes:
+                self.logger.info('Dropping indexes...')
+                IndexManager(db).drop()
+
             if hasattr(self.args, 'verbose') and not load_command.endswith('.sh'):
                 if self.args.verbose > 2:
                     load_command += ' -v'
@@ -529,11 +499,21 @@ else
     tail -20 {log}) | mail -s "{db} load FAILED" {email}
 fi''').format(**{'log':log_file, 'db': db, 'email': self.args.email})
 
+            if self.args.drop_indexes and self.args.background:
+                # Restore once the backgrounded load finishes, whether or not it succeeds
+                cmd += (f'\n{sys.executable} {os.path.abspath(__file__)} --restore_indexes'
+                        f' --db {db} >> {log_file} 2>&1;')
+
             if self.args.background:
                 cmd = '({}) &'.format(cmd)
 
             self.logger.info('Executing: %s', cmd)
-            ret = os.system(cmd)
+            try:
+                ret = os.system(cmd)
+            finally:
+                if self.args.drop_indexes and not self.args.background:
+                    self.logger.info('Creating indexes...')
+                    IndexManager(db).restore()
             self.logger.debug(f'ret = {ret}')
 
             self._copy_log_file(log_file)
@@ -568,12 +548,6 @@ fi''').format(**{'log':log_file, 'db': db, 'email': self.args.email})
             if ret != 0:
                 self.logger.error(f'Non-zero return code from load script. Check {log_file}')
 
-            if self.args.drop_indexes:
-                self.logger.info('Creating indexes...')
-                self._create_indexes()
-                call_command('makemigrations', 'stoqs', settings='config.settings.local', noinput=True)
-                call_command('migrate', settings='config.settings.local', noinput=True, database=db)
-
             # Record details of the database load to the database
             try:
                 self.recordprovenance(db, load_command, log_file)
@@ -670,7 +644,11 @@ To get any stdout/stderr output you must use -v, the default is no output.
         parser.add_argument('--updateprovenance', action='store_true', help=('Use after background jobs finish to copy'
                                                                             ' loadlogs and update provenance information'))
         parser.add_argument('--grant_everyone_select', action='store_true', help='Grant everyone role select privileges on all relations')
-        parser.add_argument('--drop_indexes', action='store_true', help='Before load drop indexes and create them following the load')
+        parser.add_argument('--drop_indexes', action='store_true', help=('Before load drop the secondary indexes of the MeasuredParameter,'
+                                                                        ' Measurement and InstantPoint tables and create them concurrently'
+                                                                        ' following the load'))
+        parser.add_argument('--restore_indexes', action='store_true', help=('Create indexes dropped by a --drop_indexes load that did not'
+                                                                           ' restore them, in the databases of the --db option'))
 
         parser.add_argument('-v', '--verbose', nargs='?', choices=[1,2,3], type=int, help='Turn on verbose output. If > 2 load is verbose too.', const=1, default=0)
     
@@ -704,5 +682,7 @@ if __name__ == '__main__':
         l.updateprovenance()
     elif l.args.grant_everyone_select:
         l.grant_everyone_select()
+    elif l.args.restore_indexes:
+        l.restore_indexes()
     else:
         l.load()
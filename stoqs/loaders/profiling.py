@@ -0,0 +1,150 @@
+'''
+Phase level profiling of the load of an Activity.
+
+loaders/timing.py reports only the elapsed time of a whole load script.  A
+LoadProfile records for each named phase of a load (e.g. DAP reads, coordinate
+insertion, MeasuredParameter insertion, derived Parameters, post processing)
+the wall time, rows processed, database round trips and the peak resident
+memory of the process, usage:
+
+    profile = LoadProfile(dbAlias)
+    with profile.phase('dap_read') as phase:
+        values = ds[pname].data[:]
+        phase.rows += len(values)
+    save_report(dbAlias, campaign, activity.name, profile.report(activity=activity.name))
+
+Database round trips are counted by wrapping the cursors of the dbAlias
+connection in the thread that created the LoadProfile.  Phases may be nested,
+the time and round trips of an inner phase are also included in the outer one.
+'''
+
+import json
+import logging
+import resource
+from collections import OrderedDict
+from contextlib import contextmanager
+from timeit import default_timer
+from django.db import connections
+from django.db.backends.utils import CursorWrapper
+from stoqs import models as m
+
+logger = logging.getLogger(__name__)
+
+# ResourceType name of the Campaign Resources holding the reports
+LOAD_PROFILE = 'load_profile'
+
+
+def peak_rss_mb():
+    '''Return peak resident set size of this process in MB (ru_maxrss is in KB on Linux)
+    '''
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+class Phase(object):
+    '''Totals for the times a phase of the load is entered
+    '''
+    def __init__(self, name):
+        self.name = name
+        self.calls = 0
+        self.seconds = 0.0
+        self.rows = 0
+        self.round_trips = 0
+        self.peak_rss_mb = 0.0
+
+    def as_dict(self):
+        return OrderedDict((('name', self.name), ('calls', self.calls), ('seconds', round(self.seconds, 3)),
+                            ('rows', self.rows), ('round_trips', self.round_trips),
+                            ('peak_rss_mb', round(self.peak_rss_mb, 1))))
+
+
+class _CountingCursorWrapper(CursorWrapper):
+    '''Count statements sent to the database in profile.round_trips
+    '''
+    def __init__(self, cursor, db, profile):
+        super().__init__(cursor, db)
+        self.profile = profile
+
+    def callproc(self, procname, params=None):
+        self.profile.round_trips += 1
+        return super().callproc(procname, params)
+
+    def execute(self, sql, params=None):
+        self.profile.round_trips += 1
+        return super().execute(sql, params)
+
+    def executemany(self, sql, param_list):
+        self.profile.round_trips += 1
+        return super().executemany(sql, param_list)
+
+    def copy_expert(self, sql, file, *args, **kwargs):
+        self.profile.round_trips += 1
+        return self.cursor.copy_expert(sql, file, *args, **kwargs)
+
+
+class LoadProfile(object):
+    '''Phases of a load with the database round trips made on dbAlias
+    '''
+    def __init__(self, dbAlias):
+        self.dbAlias = dbAlias
+        self.phases = OrderedDict()
+        self.round_trips = 0
+        self._start = default_timer()
+
+        # Instance attributes take the place of the methods BaseDatabaseWrapper uses to wrap cursors
+        connection = connections[dbAlias]
+        connection.make_cursor = lambda cursor: _CountingCursorWrapper(cursor, connection, self)
+        connection.make_debug_cursor = connection.make_cursor
+
+    def close(self):
+        '''Stop counting round trips
+        '''
+        connection = connections[self.dbAlias]
+        for name in ('make_cursor', 'make_debug_cursor'):
+            connection.__dict__.pop(name, None)
+
+    @contextmanager
+    def phase(self, name):
+        '''Context manager recording a phase of the load, yields the Phase whose rows may be incremented
+        '''
+        phase = self.phases.setdefault(name, Phase(name))
+        round_trips = self.round_trips
+        start = default_timer()
+        try:
+            yield phase
+        finally:
+            phase.calls += 1
+            phase.seconds += default_timer() - start
+            phase.round_trips += self.round_trips - round_trips
+            phase.peak_rss_mb = max(phase.peak_rss_mb, peak_rss_mb())
+
+    def report(self, **metadata):
+        '''Return JSON serializable dictionary of metadata (e.g. activity, url) and the phases
+        '''
+        report = OrderedDict(metadata)
+        report['seconds'] = round(default_timer() - self._start, 3)
+        report['round_trips'] = self.round_trips
+        report['peak_rss_mb'] = round(peak_rss_mb(), 1)
+        report['phases'] = [phase.as_dict() for phase in self.phases.values()]
+
+        return report
+
+
+@contextmanager
+def unprofiled(name):
+    '''Stand in for LoadProfile.phase() when a load is not being profiled
+    '''
+    yield Phase(name)
+
+
+def save_report(dbAlias, campaign, name, report):
+    '''Save report as JSON in the value of Resource name associated with campaign, replacing
+    the report of a previous load of the same name
+    '''
+    name = name[:m.Resource._meta.get_field('name').max_length]
+    rt, _ = m.ResourceType.objects.using(dbAlias).get_or_create(name=LOAD_PROFILE,
+                    defaults={'description': 'Phase timing report of the load of an Activity'})
+    m.Resource.objects.using(dbAlias).filter(name=name, resourcetype=rt, campaignresource__campaign=campaign).delete()
+    r = m.Resource.objects.using(dbAlias).create(uristring='', name=name, value=json.dumps(report), resourcetype=rt)
+    m.CampaignResource.objects.using(dbAlias).create(campaign=campaign, resource=r)
+
+    return r
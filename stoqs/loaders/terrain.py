@@ -0,0 +1,122 @@
+'''
+Sampling of terrain (bathymetry and topography) grids in GMT .grd files.
+
+Bottom depths at Measurement locations are interpolated in process from the
+grid with vectorized bilinear lookups, rather than by writing the locations
+to a file for GMT's grdtrack(1) to read and waiting for its output.  Only the
+window of the grid that covers the points being sampled is read from disk.
+Both the old GMT format (a 1-D z variable with x_range, y_range, spacing and
+dimension variables) and the newer COARDS compliant 2-D format are read.
+'''
+
+import logging
+import numpy as np
+from netCDF4 import Dataset
+
+logger = logging.getLogger(__name__)
+
+
+class TerrainGridError(Exception):
+    pass
+
+
+class TerrainGrid(object):
+    '''Elevations (negative below sea level) on the regular grid in grd_file.  Usage:
+
+        grid = TerrainGrid('Monterey25.grd')
+        elevations = grid.sample(longitudes, latitudes)
+    '''
+    def __init__(self, grd_file):
+        self.grd_file = grd_file
+        try:
+            with Dataset(grd_file) as ds:
+                if 'x_range' in ds.variables:
+                    self._read_old_format(ds)
+                else:
+                    self._read_cf_format(ds)
+        except (IOError, OSError) as e:
+            raise TerrainGridError(f'Cannot read {grd_file}: {e}')
+
+        logger.debug(f'Read {self.ny} x {self.nx} grid header from {grd_file}, bbox = {self.bbox}')
+
+    def _read_old_format(self, ds):
+        # The first row of z is the northernmost, nodes are offset by half a cell for pixel registration
+        xmin, xmax = (float(v) for v in ds.variables['x_range'][:])
+        ymin, ymax = (float(v) for v in ds.variables['y_range'][:])
+        dx, dy = (float(v) for v in ds.variables['spacing'][:])
+        self.nx, self.ny = (int(v) for v in ds.variables['dimension'][:])
+        offset = 0.5 if getattr(ds.variables['z'], 'node_offset', 0) else 0.0
+        self.x0, self.dx = xmin + offset * dx, dx
+        self.y0, self.dy = ymax - offset * dy, -dy
+        self.bbox = (xmin, ymin, xmax, ymax)
+        self.z_name = 'z'
+        self.flat = True
+
+    def _read_cf_format(self, ds):
+        for x_name, y_name in (('lon', 'lat'), ('x', 'y')):
+            if x_name in ds.variables and y_name in ds.variables:
+                break
+        else:
+            raise TerrainGridError(f'No lon/lat or x/y coordinate variables in {self.grd_file}')
+
+        xs = ds.variables[x_name][:].astype('float64')
+        ys = ds.variables[y_name][:].astype('float64')
+        self.nx, self.ny = len(xs), len(ys)
+        self.x0, self.dx = xs[0], (xs[-1] - xs[0]) / (self.nx - 1)
+        self.y0, self.dy = ys[0], (ys[-1] - ys[0]) / (self.ny - 1)
+        xmin, xmax = getattr(ds.variables[x_name], 'actual_range', (xs.min(), xs.max()))
+        ymin, ymax = getattr(ds.variables[y_name], 'actual_range', (ys.min(), ys.max()))
+        self.bbox = (float(xmin), float(ymin), float(xmax), float(ymax))
+        self.z_name = next(name for name, var in ds.variables.items()
+                                if var.dimensions == (y_name, x_name))
+        self.flat = False
+
+    def _window(self, r0, r1, c0, c1):
+        '''Return float64 array of the grid rows r0 to r1 and columns c0 to c1 inclusive, NaN for missing values
+        '''
+        with Dataset(self.grd_file) as ds:
+            z = ds.variables[self.z_name]
+            if self.flat:
+                window = z[r0 * self.nx:(r1 + 1) * self.nx].reshape(-1, self.nx)[:, c0:c1 + 1]
+            else:
+                window = z[r0:r1 + 1, c0:c1 + 1]
+
+        return np.ma.filled(np.ma.asarray(window, dtype='float64'), np.nan)
+
+    def contains(self, lons, lats):
+        '''Return boolean array that is True for the points within the bounding box of the grid
+        '''
+        xmin, ymin, xmax, ymax = self.bbox
+        lons = np.asarray(lons, dtype='float64')
+        lats = np.asarray(lats, dtype='float64')
+
+        return (lons >= xmin) & (lons <= xmax) & (lats >= ymin) & (lats <= ymax)
+
+    def sample(self, lons, lats):
+        '''Return float64 array of elevations bilinearly interpolated from the four grid nodes
+        around each point.  Points outside of the grid and where a node is missing are NaN.
+        '''
+        lons = np.atleast_1d(np.asarray(lons, dtype='float64'))
+        lats = np.atleast_1d(np.asarray(lats, dtype='float64'))
+        elevations = np.full(lons.shape, np.nan)
+        inside = self.contains(lons, lats)
+        if not inside.any():
+            return elevations
+
+        # Fractional column and row of each point, points in the outer half cell of
+        # pixel registered grids take the value at the edge
+        fx = np.clip((lons[inside] - self.x0) / self.dx, 0, self.nx - 1)
+        fy = np.clip((lats[inside] - self.y0) / self.dy, 0, self.ny - 1)
+        c = np.minimum(np.floor(fx).astype('int64'), self.nx - 2)
+        r = np.minimum(np.floor(fy).astype('int64'), self.ny - 2)
+        tx = fx - c
+        ty = fy - r
+
+        r0, c0 = r.min(), c.min()
+        z = self._window(r0, r.max() + 1, c0, c.max() + 1)
+        r -= r0
+        c -= c0
+        elevations[inside] = (z[r, c] * (1 - tx) * (1 - ty) + z[r, c + 1] * tx * (1 - ty) +
+                              z[r + 1, c] * (1 - tx) * ty + z[r + 1, c + 1] * tx * ty)
+
+        return elevations
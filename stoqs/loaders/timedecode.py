@@ -0,0 +1,146 @@
+'''
+Vectorized decoding of CF (COARDS/udunits) and EPIC time coordinates.
+
+The scalar coards from_udunits() and to_udunits() and jdcal conversions cost
+a Python function call and a string parse of the units for every element of
+a time axis.  The functions here parse the units once and convert whole
+arrays with NumPy datetime64 arithmetic at microsecond resolution, following
+the same floating point steps as the scalar conversions so that the results
+are identical.
+'''
+
+import re
+import numpy as np
+
+# Seconds per unit of time recognized in a udunits time string
+SECONDS_PER_UNIT = {}
+for names, seconds in ((('microseconds', 'microsecond', 'us'), 1e-6),
+                       (('milliseconds', 'millisecond', 'msecs', 'msec', 'ms'), 1e-3),
+                       (('seconds', 'second', 'secs', 'sec', 's'), 1.0),
+                       (('minutes', 'minute', 'mins', 'min'), 60.0),
+                       (('hours', 'hour', 'hrs', 'hr', 'h'), 3.6e3),
+                       (('days', 'day', 'd'), 8.64e4),
+                       (('weeks', 'week'), 7 * 8.64e4)):
+    for name in names:
+        SECONDS_PER_UNIT[name] = seconds
+
+UNITS_RE = re.compile(r'''^\s*(?P<unit>\w+)\s+since\s+
+                          (?P<date>\d{1,4}[-/]\d{1,2}[-/]\d{1,2})
+                          (?:[\sT]+(?P<time>\d{1,2}:\d{1,2}(?::\d{1,2}(?:\.\d*)?)?))?
+                          \s*(?P<tz>Z|UTC|GMT|[-+]\d{1,2}(?::?\d{2})?)?\s*$''', re.VERBOSE | re.IGNORECASE)
+
+# EPIC datum: Time (UTC) in True Julian Days: 2440000 = 0000 h on May 23, 1968
+EPIC_DATUM = np.datetime64('1968-05-23T00:00:00', 'us')
+EPIC_DATUM_JD = 2440000
+MS_PER_DAY = 86400000
+
+# Range of datetime.datetime in microseconds since EPOCH
+EPOCH = np.datetime64('1970-01-01T00:00:00', 'us')
+MIN_US = (np.datetime64('0001-01-01T00:00:00', 'us') - EPOCH).astype('int64')
+MAX_US = (np.datetime64('9999-12-31T23:59:59.999999', 'us') - EPOCH).astype('int64')
+
+
+class TimeUnitsError(ValueError):
+    pass
+
+
+def parse_units(units):
+    '''Return (seconds per unit, seconds of the origin since EPOCH) for udunits time
+    string units, e.g. 'seconds since 1970-01-01 00:00:00'
+    '''
+    match = UNITS_RE.match(units)
+    if not match or match.group('unit').lower() not in SECONDS_PER_UNIT:
+        raise TimeUnitsError(f'Cannot parse time units "{units}"')
+
+    year, month, day = (int(v) for v in re.split('[-/]', match.group('date')))
+    origin = (np.datetime64(f'{year:04d}-{month:02d}-{day:02d}', 'us') - EPOCH).astype('int64') / 1e6
+    if match.group('time'):
+        hms = match.group('time').split(':')
+        origin += int(hms[0]) * 3600 + int(hms[1]) * 60 + (float(hms[2]) if len(hms) > 2 else 0.0)
+
+    tz = match.group('tz')
+    if tz and tz[0] in '+-':
+        # Time zone offset: local time = UTC + offset
+        hours, _, minutes = tz[1:].partition(':')
+        if not minutes and len(hours) > 2:
+            hours, minutes = hours[:-2], hours[-2:]
+        offset = int(hours) * 3600 + int(minutes or 0) * 60
+        origin += -offset if tz[0] == '+' else offset
+
+    return SECONDS_PER_UNIT[match.group('unit').lower()], origin
+
+
+def _from_epoch_seconds(seconds):
+    '''Return datetime64[us] array for float64 seconds since EPOCH, NaN and inf become NaT.
+    Like datetime.timedelta(seconds=...) the fraction of a second is rounded to the nearest
+    microsecond and OverflowError is raised for values outside of the range of datetime.
+    '''
+    bad = ~np.isfinite(seconds)
+    seconds = np.where(bad, 0, seconds)
+    whole = np.trunc(seconds)
+    out_of_range = (whole < MIN_US / 1e6) | (whole > MAX_US / 1e6)
+    if np.any(out_of_range):
+        raise OverflowError(f'Time values out of range of datetime: {seconds[out_of_range][:5]} seconds since {EPOCH}')
+
+    us = whole.astype('int64') * 1000000 + np.round((seconds - whole) * 1e6).astype('int64')
+    datetimes = EPOCH + us.astype('timedelta64[us]')
+    datetimes[bad] = np.datetime64('NaT')
+
+    return datetimes
+
+
+def _to_epoch_seconds(datetimes):
+    '''Return float64 seconds since EPOCH for datetimes, summed from days, seconds and
+    microseconds as datetime.timedelta arithmetic does
+    '''
+    us = (np.asarray(datetimes, dtype='datetime64[us]') - EPOCH).astype('int64')
+    days, us = np.divmod(us, 86400000000)
+    seconds, us = np.divmod(us, 1000000)
+
+    return days * 8.64e4 + seconds + us * 1e-6
+
+
+def from_udunits(values, units):
+    '''Return datetime64[us] array for the numeric time values in udunits time string units.
+    NaN and infinite values become NaT.
+    '''
+    seconds_per_unit, origin = parse_units(units)
+    values = np.atleast_1d(np.asarray(values, dtype='float64'))
+
+    return _from_epoch_seconds(origin + values * seconds_per_unit)
+
+
+def to_udunits(datetimes, units):
+    '''Return float64 array of datetimes (datetime64 values or datetime objects) in udunits time string units
+    '''
+    seconds_per_unit, origin = parse_units(units)
+
+    return (_to_epoch_seconds(datetimes) - origin) / seconds_per_unit
+
+
+def to_datetimes(datetimes):
+    '''Return list of datetime.datetime objects (None for NaT) for a datetime64 array
+    '''
+    return np.asarray(datetimes, dtype='datetime64[us]').tolist()
+
+
+def from_epic(times, time2s):
+    '''Return datetime64[us] array for EPIC True Julian Day times and time2 milliseconds since midnight
+    '''
+    days = np.atleast_1d(np.asarray(times, dtype='float64')) - EPIC_DATUM_JD
+    ms = np.atleast_1d(np.asarray(time2s, dtype='float64'))
+    datum = (EPIC_DATUM - EPOCH).astype('int64') / 1e6
+
+    return _from_epoch_seconds(datum + days * 8.64e4 + ms / 1e3)
+
+
+def to_epic(datetimes):
+    '''Return (True Julian Day, milliseconds since midnight) int64 arrays for datetimes
+    '''
+    datetimes = np.asarray(datetimes, dtype='datetime64[ms]')
+    days = datetimes.astype('datetime64[D]')
+    times = (days - EPIC_DATUM.astype('datetime64[D]')).astype('int64') + EPIC_DATUM_JD
+    time2s = (datetimes - days).astype('int64')
+
+    return times, time2s
+
@@ -25,6 +25,7 @@ MBARI Jan 4, 2012
 
 from celery.task import task
 from stoqs import models
+from utils.sectiontiles import remove_pyramids
 
 @task()
 def delete_activity(dbAlias, activity_id):
@@ -40,6 +41,7 @@ def delete_activity(dbAlias, activity_id):
         logger.error("Activity with id = %d in dbAlias = '%s' DoesNotExist", (activityId, dbAlias))
     else:
         activity.delete(using=dbAlias)
+        remove_pyramids(dbAlias, activityId)
     
     return "Deleted Activity with id = %d." % activityId    # Will be output as a logger info message by celeryd
 
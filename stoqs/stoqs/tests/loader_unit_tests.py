@@ -0,0 +1,478 @@
+#!/usr/bin/env python
+
+'''
+Unit tests for loader components that do not need a STOQS database, e.g.:
+- Concurrent THREDDS catalog crawler, against a local stand-in HTTP server
+- Vectorized value and coordinate quality masks
+- Vectorized time decoding, for equivalence with the coards and jdcal scalar conversions
+- OPeNDAP response cache record and replay
+- Batched nearest time InstantPoint matching
+- Bilinear sampling of GMT terrain grids
+- Vectorized derived Parameters, for equivalence with the per Measurement calculations
+- Depth-time section tile pyramids
+'''
+
+import os
+import sys
+parent_dir = os.path.join(os.path.dirname(__file__), "../../loaders")
+sys.path.insert(0, parent_dir)  # So that loader modules are found
+sys.path.insert(0, os.path.join(parent_dir, 'CANON/realtime'))  # For batching without the realtime dependencies
+
+import logging
+import numpy as np
+import shutil
+import tempfile
+import threading
+import coards
+import jdcal
+from datetime import datetime, timedelta
+from http.server import HTTPServer, SimpleHTTPRequestHandler
+from socketserver import ThreadingMixIn
+
+from django.conf import settings
+from django.db import connections
+from django.test import SimpleTestCase
+from stoqs.models import Measurement, Parameter
+from catalog import CatalogCrawler, SKIPS
+from loaders import STOQS_Loader
+from DAPloaders import Base_Loader
+import timedecode
+from dapcache import DAPCache, DAPCacheMiss
+from webob import Request
+from SampleLoaders import InstantPointMatcher, ClosestTimeNotFoundException
+from terrain import TerrainGrid
+import derived
+from profiling import LoadProfile
+from batching import MicroBatcher, MemoryQueue, consume
+import seawater.eos80 as sw
+from utils.utils import spiciness, simplify_points
+from utils.simplify import douglas_peucker, simplify_series
+from utils.sectiontiles import SectionPyramid, write_pyramid
+from netCDF4 import Dataset
+
+logger = logging.getLogger('stoqs.tests')
+settings.LOGGING['loggers']['stoqs.tests']['level'] = 'INFO'
+
+CATALOG_DIR = os.path.join(os.path.dirname(__file__), 'thredds_catalogs')
+
+
+class CatalogRequestHandler(SimpleHTTPRequestHandler):
+    '''Serve files from CATALOG_DIR, recording the requested paths and response codes
+    '''
+    def translate_path(self, path):
+        return os.path.join(CATALOG_DIR, path.split('?')[0].lstrip('/'))
+
+    def log_request(self, code='-', size='-'):
+        self.server.requests.append((self.path, int(code)))
+
+
+class CatalogServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class CatalogCrawlerTestCase(SimpleTestCase):
+
+    def setUp(self):
+        self.server = CatalogServer(('127.0.0.1', 0), CatalogRequestHandler)
+        self.server.requests = []
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.base = f'http://127.0.0.1:{self.server.server_port}/missionlogs/'
+        self.cache_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.cache_dir)
+
+    def test_crawl(self):
+        skips = SKIPS + ['.*Normal*', '.*.cfg$']
+        crawler = CatalogCrawler(max_in_flight=2)
+        urls = crawler.crawl([self.base + 'catalog.xml'], select=['.*2S_scieng.nc$'], skip=skips)
+
+        host = f'http://127.0.0.1:{self.server.server_port}'
+        self.assertEqual(urls, [
+            host + '/thredds/dodsC/LRAUV/tethys/missionlogs/2018/20180918_20180920/20180918T174000/201809181740_201809191100_2S_scieng.nc',
+            host + '/thredds/dodsC/LRAUV/tethys/missionlogs/2018/20181001_20181003/201810011200_201810021400_2S_scieng.nc'])
+
+    def test_catalog_refs(self):
+        crawler = CatalogCrawler()
+        url = self.base + 'catalog.xml'
+        refs = crawler.catalog_refs(url, crawler.fetch(url), skip=[])
+        self.assertEqual([title for title, _ in refs], ['20180918_20180920', '20181001_20181003', 'README'])
+        self.assertEqual(refs[0][1], self.base + '20180918_20180920/catalog.xml')
+
+    def test_cache(self):
+        url = self.base + '20181001_20181003/catalog.xml'
+        first = CatalogCrawler(cache_dir=self.cache_dir).crawl([url])
+        self.assertTrue(CatalogCrawler(cache_dir=self.cache_dir).cache.last_modified(url))
+
+        # Unmodified catalog is not sent again, the cached copy is used
+        second = CatalogCrawler(cache_dir=self.cache_dir).crawl([url])
+        self.assertEqual(first, second)
+        self.assertEqual([code for _, code in self.server.requests], [200, 304])
+
+
+
+class DAPCacheTestCase(SimpleTestCase):
+    '''Catalog fixtures stand in for OPeNDAP responses, the cache doesn't look inside them
+    '''
+    def setUp(self):
+        self.server = CatalogServer(('127.0.0.1', 0), CatalogRequestHandler)
+        self.server.requests = []
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.url = f'http://127.0.0.1:{self.server.server_port}/missionlogs/catalog.xml?temperature[0:1:10]'
+        self.cache_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.cache_dir)
+
+    def test_record_replay(self):
+        recorded = Request.blank(self.url).get_response(DAPCache(self.cache_dir, mode='record'))
+        self.assertEqual(recorded.status_code, 200)
+
+        # Replay serves the same body without contacting the server
+        self.server.shutdown()
+        replay = DAPCache(self.cache_dir, mode='replay')
+        replayed = Request.blank(self.url).get_response(replay)
+        self.assertEqual(replayed.body, recorded.body)
+        self.assertEqual((replay.hits, replay.misses), (1, 0))
+        self.assertEqual(len(self.server.requests), 1)
+
+        # A different index range is a different slice
+        with self.assertRaises(DAPCacheMiss):
+            Request.blank(self.url.replace('10]', '20]')).get_response(replay)
+
+
+class QualityMaskTestCase(SimpleTestCase):
+
+    def setUp(self):
+        self.loader = STOQS_Loader.__new__(STOQS_Loader)
+        self.loader.logger = logger
+        self.loader.url = 'http://localhost/pctd/test.nc'
+        self.loader.coord_dicts = {'temp': {'time': 'time', 'depth': 'depth', 
+                                            'latitude': 'latitude', 'longitude': 'longitude'}}
+        self.loader.mv_by_key = {'temp': -999.0, 'depth': None, 'latitude': None, 'longitude': -1.e34}
+        self.loader.fv_by_key = {'temp': 1.e35, 'depth': -99.0, 'latitude': None, 'longitude': None}
+
+    def test_bad_value_mask(self):
+        values = [10.0, -999.0, np.nan, 1.e35, np.inf, 'null', 0.0]
+        self.assertEqual(self.loader.bad_value_mask('temp', values).tolist(),
+                         [False, True, True, True, True, True, False])
+
+    def test_screen_values(self):
+        parameter = Parameter(id=1, name='temp')
+        meass, values = self.loader.screen_values('temp', parameter, ['a', 'b', 'c', 'd'], [10.0, -999.0, np.nan, 11.0])
+        self.assertEqual((meass, values), (['a', 'd'], [10.0, 11.0]))
+        self.loader.count_rejected(parameter, 1)
+        self.assertEqual(self.loader.report_rejected(), {'temp': 3})
+
+    def test_trajectory_screening(self):
+        # Parameters with the same coordinates share the Measurements, bad values of one do not shift the next
+        loader = Base_Loader.__new__(Base_Loader)
+        loader.__dict__.update(self.loader.__dict__)
+        loader.param_by_key = {'temp': Parameter(id=1, name='temp'), 'sal': Parameter(id=2, name='sal')}
+        meass = [Measurement(id=i) for i in range(4)]
+        mask = np.array([False, False, False, False, True])
+        loaded = {}
+        for pname, values in (('temp', [10.0, np.nan, 12.0, 13.0, 0.0]), ('sal', [33.0, 11.0, 14.0, 15.0, 0.0])):
+            param_meass, mps = loader._trajectory_measuredparameters(pname, meass, values, mask)
+            loaded[pname] = [(mp.measurement.id, mp.datavalue) for mp in loader._measuredparameter_with_measurement(param_meass, mps)]
+
+        self.assertEqual(len(meass), 4)
+        self.assertEqual(loaded['temp'], [(0, 10.0), (2, 12.0), (3, 13.0)])
+        self.assertEqual(loaded['sal'], [(0, 33.0), (1, 11.0), (2, 14.0), (3, 15.0)])
+
+    def test_bad_coords(self):
+        times = [1.0, 2.0, 2.0, 1.5, 3.0, 4.0, 5.0]
+        depths = [0.0, 1.0, 2.0, 3.0, -99.0, 6000.0, 7.0]
+        latitudes = [36.8, 36.8, 36.8, 36.8, 36.8, 36.8, np.nan]
+        longitudes = [-122.0, -122.0, -122.0, -122.0, -122.0, -122.0, -1.e34]
+
+        bad_coords, bad_times = self.loader.bad_coords(['temp'], times, depths, latitudes, longitudes)
+        self.assertEqual(bad_coords.tolist(), [False, False, False, False, True, True, True])
+        # Duplicate and decreasing times are flagged for known problematic sources, e.g. pctd
+        self.assertEqual((bad_times & ~bad_coords).tolist(), [False, False, True, True, False, False, False])
+
+
+class TimeDecodeTestCase(SimpleTestCase):
+    units = ('seconds since 1970-01-01 00:00:00', 'days since 1900-01-01', 'hours since 2013-03-01 00:00:00', 
+             'minutes since 2000-1-1 0:0:0', 'seconds since 2000-01-01T00:00:00Z', 'hours since 1990-11-25 12:00 +2:00')
+
+    def setUp(self):
+        rs = np.random.RandomState(0)
+        self.values = {'seconds': rs.uniform(1.2e9, 1.6e9, 1000), 'days': rs.uniform(30000, 45000, 1000),
+                       'hours': rs.uniform(-1000, 10000, 1000), 'minutes': rs.uniform(0, 1e7, 1000)}
+
+    def test_from_udunits(self):
+        for units in self.units:
+            values = self.values[units.split()[0]]
+            expected = [coards.from_udunits(v, units) for v in values]
+            self.assertEqual(timedecode.to_datetimes(timedecode.from_udunits(values, units)), expected, units)
+
+    def test_to_udunits(self):
+        for units in self.units:
+            datetimes = [coards.from_udunits(v, units) for v in self.values[units.split()[0]]]
+            expected = [coards.to_udunits(dt, units) for dt in datetimes]
+            self.assertEqual(timedecode.to_udunits(datetimes, units).tolist(), expected, units)
+
+    def test_nan_and_overflow(self):
+        units = 'seconds since 1970-01-01 00:00:00'
+        self.assertEqual(timedecode.to_datetimes(timedecode.from_udunits([np.nan, 0.0], units)), 
+                         [None, datetime(1970, 1, 1)])
+        with self.assertRaises(OverflowError):
+            timedecode.from_udunits([-4.31865376e+107], units)
+
+    def test_epic(self):
+        rs = np.random.RandomState(0)
+        times = rs.randint(2440000, 2460000, 1000)
+        time2s = rs.randint(0, 86400000, 1000)
+        expected = []
+        for jd, ms in zip(times, time2s):
+            gcal = jdcal.jd2gcal(jd - 0.5, ms / 86400000.0)
+            expected.append(datetime(*gcal[:3]) + timedelta(days=gcal[3]))
+
+        datetimes = timedecode.from_epic(times, time2s)
+        self.assertEqual(timedecode.to_datetimes(datetimes), expected)
+
+        jds, ms = timedecode.to_epic(datetimes)
+        self.assertEqual(jds.tolist(), [int(sum(jdcal.gcal2jd(dt.year, dt.month, dt.day)) + 0.5) for dt in expected])
+        self.assertEqual(ms.tolist(), time2s.tolist())
+
+
+class InstantPointMatcherTestCase(SimpleTestCase):
+
+    def setUp(self):
+        self.matcher = InstantPointMatcher.__new__(InstantPointMatcher)
+        self.matcher.max_secs = 86400
+        self.matcher.ids = np.array([11, 12, 13, 14])
+        self.matcher.activity_ids = np.array([1, 1, 1, 1])
+        self.matcher.timevalues = np.array(['2018-09-18T17:40:00', '2018-09-18T17:40:10', 
+                                            '2018-09-18T17:40:20', '2018-09-18T18:40:00'], dtype='datetime64[us]')
+
+    def test_match(self):
+        tvs = [datetime(2018, 9, 18, 17, 39, 0), datetime(2018, 9, 18, 17, 40, 4, 500000),
+               datetime(2018, 9, 18, 17, 40, 5), datetime(2018, 9, 18, 17, 40, 18), datetime(2018, 9, 20, 0, 0, 0)]
+        matches = self.matcher.match(tvs)
+        # Closest point with whole seconds difference, the earlier one for ties, none beyond max_secs
+        self.assertEqual([(ip.id, secs) for ip, secs in matches[:4]], [(11, 60), (11, 4), (11, 5), (13, 2)])
+        self.assertEqual(matches[1][0].timevalue, datetime(2018, 9, 18, 17, 40, 0))
+        self.assertEqual(matches[4], (None, None))
+        with self.assertRaises(ClosestTimeNotFoundException):
+            self.matcher.closest(tvs[4])
+
+
+class TerrainGridTestCase(SimpleTestCase):
+    '''Bilinear interpolation reproduces a plane exactly, z = 2 * x - 3 * y - 100
+    '''
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.xs = np.arange(-122.0, -121.0, 0.25)
+        self.ys = np.arange(36.0, 37.0, 0.5)
+        self.z = 2 * self.xs[np.newaxis, :] - 3 * self.ys[:, np.newaxis] - 100
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def _write_cf(self):
+        grd_file = os.path.join(self.dir, 'cf.grd')
+        with Dataset(grd_file, 'w') as ds:
+            ds.createDimension('lon', len(self.xs))
+            ds.createDimension('lat', len(self.ys))
+            ds.createVariable('lon', 'f8', ('lon',))[:] = self.xs
+            ds.createVariable('lat', 'f8', ('lat',))[:] = self.ys
+            ds.createVariable('z', 'f4', ('lat', 'lon'))[:] = self.z
+
+        return grd_file
+
+    def _write_old(self):
+        grd_file = os.path.join(self.dir, 'old.grd')
+        with Dataset(grd_file, 'w') as ds:
+            ds.createDimension('side', 2)
+            ds.createDimension('xysize', self.z.size)
+            ds.createVariable('x_range', 'f8', ('side',))[:] = [self.xs[0], self.xs[-1]]
+            ds.createVariable('y_range', 'f8', ('side',))[:] = [self.ys[0], self.ys[-1]]
+            ds.createVariable('spacing', 'f8', ('side',))[:] = [0.25, 0.5]
+            ds.createVariable('dimension', 'i4', ('side',))[:] = [len(self.xs), len(self.ys)]
+            ds.createVariable('z', 'f4', ('xysize',))[:] = self.z[::-1].flatten()
+
+        return grd_file
+
+    def test_sample(self):
+        lons = np.array([-122.0, -121.25, -121.6, -121.3, -123.0])
+        lats = np.array([36.0, 36.5, 36.2, 36.45, 36.2])
+        expected = 2 * lons - 3 * lats - 100
+        for grd_file in (self._write_cf(), self._write_old()):
+            grid = TerrainGrid(grd_file)
+            self.assertEqual(grid.bbox, (-122.0, 36.0, -121.25, 36.5))
+            elevations = grid.sample(lons, lats)
+            np.testing.assert_allclose(elevations[:4], expected[:4], rtol=1e-6)
+            # Outside of the grid
+            self.assertTrue(np.isnan(elevations[4]))
+
+
+class DerivedParameterTestCase(SimpleTestCase):
+
+    def setUp(self):
+        rs = np.random.RandomState(0)
+        self.columns = {'measurement_id': np.arange(100), 'depth': rs.uniform(0, 1000, 100),
+                        'latitude': rs.uniform(20, 50, 100), 'longitude': rs.uniform(-130, -120, 100),
+                        derived.TEMPERATURE: rs.uniform(2, 25, 100), derived.SALINITY: rs.uniform(32, 35, 100)}
+        self.columns[derived.SALINITY][3] = np.nan
+
+    def test_sigmat_and_spice(self):
+        c = self.columns
+        for name, scalar in ((derived.SIGMAT, lambda t, s, d, la: sw.pden(s, t, sw.pres(d, la)) - 1000.0),
+                             (derived.SPICE, lambda t, s, d, la: spiciness(t, s))):
+            expected = [scalar(t, s, d, la) for t, s, d, la in
+                        zip(c[derived.TEMPERATURE], c[derived.SALINITY], c['depth'], c['latitude'])]
+            measurement_ids, values = derived.derive(derived.REGISTRY[name], c)
+            # Values that can't be calculated are not loaded
+            self.assertNotIn(3, measurement_ids.tolist())
+            np.testing.assert_allclose(values, np.delete(expected, 3), rtol=1e-12)
+
+
+class SimplifyTestCase(SimpleTestCase):
+
+    def setUp(self):
+        rs = np.random.RandomState(0)
+        self.ems = 1.5e12 + 1000.0 * np.arange(20000)
+        self.depths = np.cumsum(rs.normal(0, 1, 20000))
+
+    def test_same_as_simplify_points(self):
+        line = list(zip(self.ems.tolist(), self.depths.tolist()))
+        expected = [i for _, _, i in simplify_points(line, 10)]
+        self.assertEqual(douglas_peucker(self.ems, self.depths, 10).tolist(), expected)
+
+    def test_repeated_x(self):
+        # Track like line whose x values repeat and turn back: no point removed is further than tolerance
+        rs = np.random.RandomState(1)
+        x = rs.randint(0, 10, 200).astype(float)
+        y = rs.normal(0, 1, 200)
+        kept = douglas_peucker(x, y, 0.5)
+        for anchor, floater in zip(kept[:-1], kept[1:]):
+            for i in range(anchor + 1, floater):
+                sx, sy = x[floater] - x[anchor], y[floater] - y[anchor]
+                proj = np.clip(((x[i] - x[anchor]) * sx + (y[i] - y[anchor]) * sy) / (sx * sx + sy * sy or 1), 0, 1)
+                self.assertLessEqual(np.hypot(x[i] - x[anchor] - proj * sx, y[i] - y[anchor] - proj * sy), 0.5)
+
+        # A point behind the start of its segment, which simplify_points() drops
+        line = [(5.0, -0.5), (8.0, -1.0), (9.0, 0.9), (5.0, -2.3)]
+        self.assertEqual([i for _, _, i in simplify_points(line, 0.5)], [0, 1, 3])
+        self.assertEqual(douglas_peucker(*zip(*line), 0.5).tolist(), [0, 1, 2, 3])
+
+    def test_max_points(self):
+        kept = douglas_peucker(self.ems, self.depths, 0, max_points=100)
+        self.assertEqual(len(kept), 100)
+        self.assertEqual((kept[0], kept[-1]), (0, len(self.ems) - 1))
+        # The most significant points are kept first
+        self.assertTrue(set(douglas_peucker(self.ems, self.depths, 0, max_points=10)) <= set(kept))
+
+    def test_nan_excluded(self):
+        self.depths[[0, 500]] = np.nan
+        kept = simplify_series(self.ems, self.depths, 10)
+        self.assertEqual(kept[0], 1)
+        self.assertNotIn(500, kept.tolist())
+
+
+class LoadProfileTestCase(SimpleTestCase):
+
+    def test_phases(self):
+        profile = LoadProfile('default')
+        try:
+            for rows in (10, 20):
+                with profile.phase('measuredparameters') as phase:
+                    with profile.phase('dap_read'):
+                        pass
+                    phase.rows += rows
+            report = profile.report(activity='test')
+        finally:
+            profile.close()
+
+        self.assertEqual(report['activity'], 'test')
+        self.assertEqual([p['name'] for p in report['phases']], ['measuredparameters', 'dap_read'])
+        self.assertEqual((report['phases'][0]['calls'], report['phases'][0]['rows']), (2, 30))
+        self.assertGreater(report['phases'][0]['peak_rss_mb'], 0)
+
+    def test_closed_on_failure(self):
+        loader = Base_Loader.__new__(Base_Loader)
+        loader.profile = LoadProfile('default')
+        loader.activity = None      # Fails making the report
+        with self.assertRaises(AttributeError):
+            loader._save_load_profile(0, 'trajectory', completed=False)
+
+        self.assertIsNone(loader.profile)
+        self.assertNotIn('make_cursor', connections['default'].__dict__)
+
+
+class MicroBatcherTestCase(SimpleTestCase):
+
+    def setUp(self):
+        self.now = 0.0
+        self.batches = []
+        self.batcher = MicroBatcher(lambda messages: self.batches.append([m.body for m in messages]),
+                                    max_messages=2, max_seconds=5, clock=lambda: self.now)
+        self.queue = MemoryQueue(sleep=self.sleep)
+        self.queue.basic_consume(queue='test', callback=self.batcher.add)
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+    def test_count_window(self):
+        for body in 'abcde':
+            self.queue.put(body)
+        consume(self.queue, self.batcher)
+
+        # The last message is flushed when its time window closes
+        self.assertEqual(self.batches, [['a', 'b'], ['c', 'd'], ['e']])
+        self.assertEqual(self.now, 5.0)
+
+    def test_time_window(self):
+        self.queue.put('a')
+        self.queue.drain_events()
+        self.sleep(4)
+        self.batcher.poll()
+        self.assertEqual((self.batches, self.batcher.timeout()), ([], 1.0))
+        self.sleep(1)
+        self.batcher.poll()
+        self.assertEqual(self.batches, [['a']])
+        self.assertIsNone(self.batcher.timeout())
+
+
+class SectionPyramidTestCase(SimpleTestCase):
+    '''Interpolation of the measurements and of the tiles reproduces a plane, z = (x - t0) / 1000 + 2 * y
+    '''
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        rs = np.random.RandomState(0)
+        self.t0 = 1.5e9
+        self.x = self.t0 + rs.uniform(0, 172800, 5000)
+        self.y = rs.uniform(0, 100, 5000)
+        self.path = os.path.join(self.dir, 'pyramid')
+        self.manifest = write_pyramid(self.path, self.x, self.y, (self.x - self.t0) / 1000 + 2 * self.y)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_levels(self):
+        self.assertEqual(self.manifest['levels'], 4)
+        self.assertEqual(len([f for f in os.listdir(self.path) if f.endswith('.npz')]), 1 + 2 + 4 + 8)
+        pyramid = SectionPyramid(self.path)
+        self.assertEqual(pyramid.level_for(self.x.min(), self.x.max(), 1000), 2)
+        self.assertEqual(pyramid.level_for(self.x.min(), self.x.max(), 100000), 3)
+
+    def test_sample(self):
+        pyramid = SectionPyramid(self.path)
+        xi = np.linspace(self.t0 + 50000, self.t0 + 70000, 200)
+        yi = np.linspace(10, 90, 50)
+        zi, px, py = pyramid.sample(xi, yi)
+        np.testing.assert_allclose(zi, (xi[np.newaxis, :] - self.t0) / 1000 + 2 * yi[:, np.newaxis], rtol=1e-4)
+        self.assertTrue(len(px) and np.all((px >= xi[0]) & (px <= xi[-1])))
+
+        zi, px, py = pyramid.sample(xi + 200000, yi)
+        self.assertTrue(np.all(np.isnan(zi)))
+        self.assertEqual(len(px), 0)
+
+    def test_degenerate(self):
+        self.assertIsNone(write_pyramid(os.path.join(self.dir, 'flat'), self.x, np.zeros(5000), self.x))
@@ -24,15 +24,29 @@ MBARI Dec 29, 2011
 
 import os
 import sys
+import shutil
+import tempfile
 import time
 import json
 import time
 import logging
+import numpy as np
 
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from itertools import groupby
+from operator import itemgetter
 from django.conf import settings
-from django.test import TestCase
+from django.db import connection
+from django.test import RequestFactory, TestCase, TransactionTestCase
 from django.urls import reverse
-from stoqs.models import Activity, Parameter, Resource, MeasuredParameter
+from stoqs.models import Activity, InstantPoint, Parameter, Resource, MeasuredParameter, SimpleDepthTime
+from loaders import STOQS_Loader
+from loaders.indexes import IndexManager, DROPPED_INDEX
+from utils.STOQSQManager import STOQSQManager, OptionDeadlineExceeded
+from utils.decimate import minmax_decimate
+from utils.rendercache import RenderCache
+from utils.sectiontiles import SectionPyramid, fingerprint, pyramid_dir, remove_pyramids, write_pyramid
 
 logger = logging.getLogger('stoqs.tests')
 settings.LOGGING['loggers']['stoqs.tests']['level'] = 'INFO'
@@ -526,6 +540,204 @@ class SummaryDataTestCase(TestCase):
         data = json.loads(response.content) # Verify we don't get an exception when we load the data.
         self.assertEqual(response.status_code, 200, 'Status code should be 200 for %s' % req)
 
+    def test_minmax_decimate(self):
+        qs_mp = MeasuredParameter.objects.filter(parameter__name__contains='SEA_WATER_SALINITY_HR', datavalue__isnull=False)
+        rows = minmax_decimate(qs_mp, 'datavalue', series='measurement__nominallocation__depth', buckets=2)
+
+        for nd, nd_rows in groupby(rows, key=itemgetter(0)):
+            nd_rows = list(nd_rows)
+            values = qs_mp.filter(measurement__nominallocation__depth=nd).values_list('datavalue', flat=True)
+            self.assertLessEqual(len(nd_rows), 4)
+            self.assertEqual(nd_rows[0][3], len(values))
+            self.assertEqual(min(row[2] for row in nd_rows), min(values))
+            self.assertEqual(max(row[2] for row in nd_rows), max(values))
+            self.assertEqual([row[1] for row in nd_rows], sorted(row[1] for row in nd_rows))
+
+
+class OptionsTestCase(TestCase):
+    multi_db = False
+
+    # Generation and caching of the Query UI options, these do not need the fixture
+
+    def test_concurrent_options(self):
+        qm = STOQSQManager(RequestFactory().get('/'), None, 'default', only=[], **{'except': []})
+        qm.options_functions = {'platforms': lambda: 'fast',
+                                'extent': lambda: time.sleep(2) or 'slow',
+                                'resources': lambda: 1 / 0,
+                                'counts': lambda: 'serial'}
+        with self.settings(STOQS_OPTIONS_WORKERS=2, STOQS_OPTION_TIMEOUT=0.5, STOQS_OPTION_CACHE_TIMEOUT=0):
+            results = qm.generateOptions()
+
+        self.assertEqual((results['platforms'], results['counts']), ('fast', 'serial'))
+        self.assertNotIn('extent', results)
+        self.assertEqual(results['incomplete']['extent'], 'timeout')
+        self.assertIn('resources', results['incomplete'])
+
+    def test_option_deadline(self):
+        # An option making queries after its time allowed is stopped rather than holding its worker thread
+        qm = STOQSQManager(RequestFactory().get('/'), None, 'default')
+        def slow():
+            time.sleep(0.2)
+            return Parameter.objects.count()
+
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            with self.assertRaises(OptionDeadlineExceeded):
+                executor.submit(qm._callOnWorkerConnection, 'extent', slow, 0.1, {}).result()
+
+    def test_option_cache_keys(self):
+        request = RequestFactory().get('/')
+        qm1 = STOQSQManager(request, None, 'default', platforms=['dorado', 'tethys'], parameterplot=['1', None],
+                            time=[None, None], showdataas=['contour'])
+        qm2 = STOQSQManager(request, None, 'default', platforms=['tethys', 'dorado'], parameterplot=['2', None],
+                            time=[], showdataas=['scatter'])
+
+        # Order of platforms, empty time and showdataas that affects neither do not change the keys
+        self.assertEqual(qm1._optionCacheKey('extent'), qm2._optionCacheKey('extent'))
+        self.assertNotEqual(qm1._optionCacheKey('parameterminmax'), qm2._optionCacheKey('parameterminmax'))
+        self.assertNotEqual(qm1._optionCacheKey('extent'),
+                            STOQSQManager(request, None, 'default', platforms=['dorado'])._optionCacheKey('extent'))
+
+        # Loading an Activity changes the version of the data and so the keys
+        self.assertNotEqual(qm1._optionCacheKey('extent', [('id__count', '1')]),
+                            qm1._optionCacheKey('extent', [('id__count', '2')]))
+
+
+class RenderCacheTestCase(TestCase):
+    multi_db = False
+
+    # Keys include the version of the data, which needs the database but not the fixture
+
+    def test_render_cache(self):
+        directory = tempfile.mkdtemp()
+        try:
+            cache = RenderCache(directory, max_bytes=250)
+            key1 = cache.key('default', 'section', {'platforms': ['dorado', 'tethys'], 'only': ['parametertime']}, cm='jetplus')
+            key2 = cache.key('default', 'section', {'platforms': ['tethys', 'dorado'], 'time': [None, None]}, cm='jetplus')
+            self.assertEqual(key1, key2)
+            self.assertNotEqual(key1, cache.key('default', 'section', {'platforms': ['dorado']}, cm='jetplus'))
+            self.assertNotEqual(key1, cache.key('default', 'section', {'platforms': ['dorado', 'tethys']}, cm='thermal'))
+
+            def render(name):
+                path = os.path.join(directory, name)
+                with open(path, 'wb') as f:
+                    f.write(b'x' * 100)
+                return path
+
+            self.assertIsNone(cache.get(key1))
+            files = cache.store(key1, {'strideInfo': 'stride = 2'}, {'.png': render('ABC.png'), '_colorbar.png': ''})
+            self.assertEqual(files, {'.png': key1 + '.png'})
+            self.assertEqual(cache.get(key1)['strideInfo'], 'stride = 2')
+            self.assertFalse(os.path.exists(os.path.join(directory, 'ABC.png')))
+
+            # The least recently used plot is evicted when the cache exceeds max_bytes
+            os.utime(os.path.join(directory, key1 + '.json'), (0, 0))
+            key3 = cache.key('default', 'parameterparameter', {})
+            cache.store(key3, {}, {'.png': render('DEF.png')})
+            self.assertIsNone(cache.get(key1))
+            self.assertFalse(os.path.exists(os.path.join(directory, key1 + '.png')))
+            self.assertIsNotNone(cache.get(key3))
+        finally:
+            shutil.rmtree(directory)
+
+
+class SectionTilesTestCase(TestCase):
+    fixtures = ['stoqs_test_data.json']
+    multi_db = False
+
+    def test_stale_pyramid(self):
+        mp = MeasuredParameter.objects.filter(parameter__name__contains='temperature').select_related(
+                                              'measurement__instantpoint__activity', 'parameter').first()
+        activity = mp.measurement.instantpoint.activity
+        directory = tempfile.mkdtemp()
+        try:
+            with self.settings(MEDIA_ROOT=directory):
+                path = pyramid_dir('default', activity.id, mp.parameter.id)
+                rs = np.random.RandomState(0)
+                x, y = rs.uniform(0, 86400, 1000), rs.uniform(0, 100, 1000)
+                write_pyramid(path, x, y, x + y, fingerprint('default', activity.id, mp.parameter.id))
+                self.assertIsNotNone(SectionPyramid.open('default', activity.id, mp.parameter.id))
+
+                # As after an --append or a reload that reuses the Activity id
+                Activity.objects.filter(id=activity.id).update(enddate=activity.enddate + timedelta(days=1))
+                self.assertIsNone(SectionPyramid.open('default', activity.id, mp.parameter.id))
+
+                remove_pyramids('default', activity.id)
+                self.assertFalse(os.path.exists(path))
+        finally:
+            shutil.rmtree(directory)
+
+
+class SimpleDepthTimeTestCase(TestCase):
+    fixtures = ['stoqs_test_data.json']
+    multi_db = False
+
+    def setUp(self):
+        self.loader = STOQS_Loader.__new__(STOQS_Loader)
+        self.loader.logger = logger
+        self.loader.dbAlias = 'default'
+        self.loader.dataStartDatetime = None
+        self.loader.activity = Activity.objects.filter(platform__name='dorado',
+                                                       instantpoint__measurement__isnull=False).distinct().first()
+
+    def _points(self):
+        return list(SimpleDepthTime.objects.filter(activity=self.loader.activity).order_by('epochmilliseconds')
+                                           .values_list('instantpoint_id', 'epochmilliseconds', 'depth'))
+
+    def test_rebuild_after_append(self):
+        count = self.loader._rebuildSimpleDepthTime(10)
+        points = self._points()
+        self.assertEqual(len(points), count)
+        self.assertGreater(count, 2)
+
+        # Loading again replaces the points rather than adding to them
+        self.loader._rebuildSimpleDepthTime(10)
+        self.assertEqual(self._points(), points)
+
+        # As for an --append of the data after the middle of the Activity
+        times = list(InstantPoint.objects.filter(activity=self.loader.activity).order_by('timevalue')
+                                         .values_list('timevalue', flat=True))
+        self.loader.dataStartDatetime = times[len(times) // 2]
+        earlier = set(InstantPoint.objects.filter(activity=self.loader.activity, timevalue__lt=self.loader.dataStartDatetime)
+                                          .values_list('id', flat=True))
+        before = [p for p in points if p[0] in earlier]
+        self.loader._rebuildSimpleDepthTime(10)
+        appended = self._points()
+        self.assertEqual(len(appended), len({ip_id for ip_id, _, _ in appended}))
+        self.assertEqual((appended[0], appended[-1]), (points[0], points[-1]))
+
+        # Points before the appended data are kept, the series is simplified again from the last of them
+        self.assertTrue(before)
+        self.assertEqual(appended[:len(before)], before)
+
+
+class IndexManagerTestCase(TransactionTestCase):
+    multi_db = False
+
+    # Indexes are dropped and created CONCURRENTLY, which cannot be done in the transaction of a TestCase
+
+    def _indexes(self):
+        with connection.cursor() as cursor:
+            cursor.execute('''SELECT i.relname, x.indisvalid FROM pg_index x
+                              JOIN pg_class i ON i.oid = x.indexrelid JOIN pg_class t ON t.oid = x.indrelid
+                              WHERE t.relname = %s''', [InstantPoint._meta.db_table])
+            return dict(cursor.fetchall())
+
+    def test_drop_restore(self):
+        manager = IndexManager('default', models=(InstantPoint,))
+        names = {name for name, _, _ in manager.secondary_indexes()}
+        self.assertTrue(names, 'InstantPoint.timevalue should have a secondary index')
+        before = self._indexes()
+
+        with self.assertRaises(ZeroDivisionError):
+            with manager.dropped():
+                self.assertFalse(names & set(self._indexes()))
+                self.assertEqual(set(Resource.objects.filter(resourcetype__name=DROPPED_INDEX)
+                                                     .values_list('name', flat=True)), names)
+                1 / 0                   # A failed load
+
+        self.assertEqual(self._indexes(), before)
+        self.assertFalse(Resource.objects.filter(resourcetype__name=DROPPED_INDEX).exists())
+
 
 class BugsFoundTestCase(TestCase):
     fixtures = ['stoqs_test_data.json']
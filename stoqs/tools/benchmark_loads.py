@@ -0,0 +1,275 @@
+#!/usr/bin/env python
+
+'''
+Measure the ingest throughput of the DAPloaders on synthetic data without
+network access.  NetCDF files like those of an AUV (CF trajectory), an LRAUV,
+an EPIC timeSeries instrument and an OceanSITES mooring (CF timeSeriesProfile)
+are generated with a fixed random seed, served over OPeNDAP from a local pydap
+server and loaded with Trajectory_Loader, Lrauv_Loader, TimeSeries_Loader and
+Mooring_Loader into a newly created database.  The loads are profiled (as with
+the --profile option of the load scripts) and rows per second are reported per
+loader class and phase.  To use:
+
+    1. Have a local PostGIS server that the load.py script can create databases in
+    2. ./benchmark_loads.py                          # Default sizes, best of 3
+    3. ./benchmark_loads.py -n 1000000 --copy --json results.json
+
+stoqs/tests/loading_tests.py checks the correctness of loads, this is for
+noticing changes in their speed: keep the --json output of runs to compare.
+'''
+
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+from argparse import Namespace
+from collections import OrderedDict
+from wsgiref.simple_server import make_server, WSGIRequestHandler
+
+import django
+import numpy as np
+from netCDF4 import Dataset
+
+# Insert Django App directory (parent of config) into python path
+sys.path.insert(0, os.path.abspath(os.path.join(
+                    os.path.dirname(__file__), "../")))
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'config.settings.local')
+django.setup()
+
+from django.conf import settings
+from pydap.handlers.netcdf import NetCDFHandler
+from loaders import timedecode
+from loaders.DAPloaders import runTrajectoryLoader, runLrauvLoader, runTimeSeriesLoader, runMooringLoader
+from loaders.load import Loader
+from loaders.profiling import LOAD_PROFILE
+from stoqs.models import Activity, Resource
+
+CAMPAIGN_NAME = 'Load benchmark'
+START_ES = 1.5e9            # 2017-07-14, 1 Hz samples from here
+FILL_VALUE = 1e35
+BAD_FRACTION = 0.001        # Fraction of datavalues that are fill values
+
+
+def _add_variable(ds, name, dims, values, dtype='f8', fill_value=None, **attributes):
+    var = ds.createVariable(name, dtype, dims, fill_value=fill_value)
+    for key, value in attributes.items():
+        setattr(var, key, value)
+    var[:] = values
+
+    return var
+
+
+def _with_fill_values(values, rs):
+    values = np.array(values, dtype='float64')
+    values.flat[rs.choice(values.size, int(values.size * BAD_FRACTION), replace=False)] = FILL_VALUE
+
+    return values
+
+
+def write_trajectory(path, n, rs, lrauv=False):
+    '''Write CF-1.6 trajectory of an AUV doing yo-yos, LRAUV files name data variables by their standard_name
+    '''
+    times = START_ES + np.arange(n)
+    phase = np.arange(n) / 600.0
+    depths = 52.5 + 47.5 * (4 * np.abs(phase - np.floor(phase + 0.5)) - 1)
+    heading = np.cumsum(rs.normal(0, 0.01, n))
+    temperatures = 14.0 - depths / 10.0 + rs.normal(0, 0.05, n)
+    salinities = 33.2 + depths / 200.0 + rs.normal(0, 0.01, n)
+
+    with Dataset(path, 'w') as ds:
+        ds.Conventions = 'CF-1.6'
+        ds.featureType = 'trajectory'
+        ds.title = 'Synthetic trajectory for benchmarking loads'
+        ds.createDimension('time', n)
+        _add_variable(ds, 'time', ('time',), times, standard_name='time', units='seconds since 1970-01-01 00:00:00')
+        _add_variable(ds, 'depth', ('time',), depths, standard_name='depth', units='m')
+        _add_variable(ds, 'latitude', ('time',), 36.8 + np.cumsum(1e-5 * np.sin(heading)),
+                      standard_name='latitude', units='degrees_north')
+        _add_variable(ds, 'longitude', ('time',), -122.0 + np.cumsum(1e-5 * np.cos(heading)),
+                      standard_name='longitude', units='degrees_east')
+        for name, standard_name, units, values in (('temperature', 'sea_water_temperature', 'Celsius', temperatures),
+                                                   ('salinity', 'sea_water_salinity', '1e-3', salinities)):
+            _add_variable(ds, standard_name if lrauv else name, ('time',), _with_fill_values(values, rs),
+                          fill_value=FILL_VALUE, standard_name=standard_name, units=units,
+                          coordinates='time depth latitude longitude')
+
+    return ['sea_water_temperature', 'sea_water_salinity'] if lrauv else ['temperature', 'salinity']
+
+
+def write_epic_timeseries(path, n, rs):
+    '''Write EPIC timeSeries of an instrument at a nominal depth as from the CCE moorings
+    '''
+    times, time2s = timedecode.to_epic((START_ES + np.arange(n) * 60).astype('datetime64[s]'))
+    with Dataset(path, 'w') as ds:
+        ds.Conventions = 'PMEL/EPIC'
+        ds.featureType = 'timeSeries'
+        ds.title = 'Synthetic EPIC time series for benchmarking loads'
+        for dim, size in (('time', n), ('depth', 1), ('lat', 1), ('lon', 1)):
+            ds.createDimension(dim, size)
+        _add_variable(ds, 'time', ('time',), times, dtype='i4', standard_name='time', units='True Julian Day')
+        _add_variable(ds, 'time2', ('time',), time2s, dtype='i4', units='msec since 0:00 GMT')
+        _add_variable(ds, 'depth', ('depth',), [50.0], dtype='f4', standard_name='depth', units='m')
+        _add_variable(ds, 'lat', ('lat',), [34.3], dtype='f4', standard_name='latitude', units='degree_north')
+        _add_variable(ds, 'lon', ('lon',), [-120.8], dtype='f4', standard_name='longitude', units='degree_east')
+        for name, epic_code, units, values in (('T_28', 28, 'C', 9.0 + rs.normal(0, 0.2, n)),
+                                               ('S_41', 41, 'PSU', 33.9 + rs.normal(0, 0.02, n))):
+            _add_variable(ds, name, ('time', 'depth', 'lat', 'lon'),
+                          _with_fill_values(values, rs).reshape(n, 1, 1, 1), dtype='f4',
+                          fill_value=FILL_VALUE, epic_code=epic_code, units=units, coordinates='time depth lat lon')
+
+    return ['T_28', 'S_41']
+
+
+def write_oceansites_mooring(path, n, rs, levels=10):
+    '''Write OceanSITES CF-1.6 timeSeriesProfile of a mooring with levels instruments
+    '''
+    depths = np.linspace(1.0, 300.0, levels)
+    with Dataset(path, 'w') as ds:
+        ds.Conventions = 'CF-1.6, OceanSITES-Manual-1.2'
+        ds.featureType = 'timeSeriesProfile'
+        ds.title = 'Synthetic OceanSITES mooring for benchmarking loads'
+        for dim, size in (('TIME', n), ('DEPTH', levels), ('LATITUDE', 1), ('LONGITUDE', 1)):
+            ds.createDimension(dim, size)
+        _add_variable(ds, 'TIME', ('TIME',), START_ES + np.arange(n) * 600, standard_name='time',
+                      units='seconds since 1970-01-01 00:00:00')
+        _add_variable(ds, 'DEPTH', ('DEPTH',), depths, standard_name='depth', units='m', positive='down')
+        _add_variable(ds, 'LATITUDE', ('LATITUDE',), [36.75], standard_name='latitude', units='degrees_north')
+        _add_variable(ds, 'LONGITUDE', ('LONGITUDE',), [-122.03], standard_name='longitude', units='degrees_east')
+        profile = rs.normal(0, 0.1, (n, levels))
+        for name, standard_name, units, values in (
+                    ('TEMP', 'sea_water_temperature', 'Celsius', 14.0 - depths / 40.0 + profile),
+                    ('PSAL', 'sea_water_salinity', '1e-3', 33.2 + depths / 600.0 + profile / 10.0)):
+            _add_variable(ds, name, ('TIME', 'DEPTH', 'LATITUDE', 'LONGITUDE'),
+                          _with_fill_values(values, rs).reshape(n, levels, 1, 1), dtype='f4',
+                          fill_value=FILL_VALUE, standard_name=standard_name, units=units)
+
+    return ['TEMP', 'PSAL']
+
+
+class _QuietHandler(WSGIRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+def serve_opendap(data_dir):
+    '''Serve the NetCDF files in data_dir over OPeNDAP from a background thread,
+    return (server, base url)
+    '''
+    def app(environ, start_response):
+        # e.g. /trajectory.nc.dods is answered by a handler for trajectory.nc
+        name = environ['PATH_INFO'].lstrip('/').rsplit('.', 1)[0]
+        return NetCDFHandler(os.path.join(data_dir, name))(environ, start_response)
+
+    server = make_server('127.0.0.1', 0, app, handler_class=_QuietHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    return server, f'http://127.0.0.1:{server.server_port}'
+
+
+def create_database(db):
+    '''Create empty STOQS database db, as stoqs/tests/load_data.py does
+    '''
+    campaigns = Namespace(campaigns={db: 'benchmark_loads'})
+    loader = Loader()
+    loader.args = Namespace(test=False, clobber=True, db=db, drop_indexes=False)
+    loader.load(campaigns, create_only=True)
+
+
+def load_report(db, aName):
+    '''Return the load profile report saved for Activity aName and delete the Activity
+    '''
+    resource = Resource.objects.using(db).get(name=aName, resourcetype__name=LOAD_PROFILE)
+    Activity.objects.using(db).filter(name=aName).delete()
+
+    return json.loads(resource.value)
+
+
+def benchmark(db, base_url, data_dir, points, repeat, args):
+    '''Load each synthetic file repeat times, return OrderedDict of the fastest report for each loader class
+    '''
+    rs = np.random.RandomState(0)
+    command_line_args = Namespace(append=False, copy=args.copy, upsert=False, resume=False, profile=True)
+    loads = OrderedDict((
+        ('Trajectory_Loader', ('trajectory.nc', write_trajectory(os.path.join(data_dir, 'trajectory.nc'), points, rs),
+            lambda url, aName, parms: runTrajectoryLoader(url, CAMPAIGN_NAME, '', aName, 'benchmark_auv', 'ff0000',
+                                        'auv', 'AUV Mission', parms, db, 1, command_line_args=command_line_args))),
+        ('Lrauv_Loader', ('lrauv.nc', write_trajectory(os.path.join(data_dir, 'lrauv.nc'), points, rs, lrauv=True),
+            lambda url, aName, parms: runLrauvLoader(url, CAMPAIGN_NAME, '', aName, 'benchmark_lrauv', '00ff00',
+                                        'auv', 'LRAUV Mission', parms, db, command_line_args=command_line_args))),
+        ('TimeSeries_Loader', ('epic.nc', write_epic_timeseries(os.path.join(data_dir, 'epic.nc'), points, rs),
+            lambda url, aName, parms: runTimeSeriesLoader(url, CAMPAIGN_NAME, '', aName, 'benchmark_instrument',
+                                        '0000ff', 'mooring', 'Mooring Deployment', parms, db, 1,
+                                        command_line_args=command_line_args))),
+        ('Mooring_Loader', ('mooring.nc', write_oceansites_mooring(os.path.join(data_dir, 'mooring.nc'), points // 10, rs),
+            lambda url, aName, parms: runMooringLoader(url, CAMPAIGN_NAME, '', aName, 'benchmark_mooring',
+                                        'ffff00', 'mooring', 'Mooring Deployment', parms, db, 1,
+                                        command_line_args=command_line_args))),
+    ))
+
+    reports = OrderedDict()
+    for loader_class, (file_name, parms, run) in loads.items():
+        if args.loaders and loader_class not in args.loaders:
+            continue
+        for i in range(repeat):
+            aName = f'{loader_class} {i}'
+            run(f'{base_url}/{file_name}', aName, parms)
+            report = load_report(db, aName)
+            if loader_class not in reports or report['seconds'] < reports[loader_class]['seconds']:
+                reports[loader_class] = report
+
+    return reports
+
+
+def print_reports(reports):
+    for loader_class, report in reports.items():
+        print(f"{loader_class}: {report['measuredparameters']} MeasuredParameters in {report['seconds']:.2f} s"
+              f" = {report['measuredparameters'] / report['seconds']:.0f} rows/s,"
+              f" {report['round_trips']} round trips, peak RSS {report['peak_rss_mb']} MB")
+        for phase in report['phases']:
+            rate = f"{phase['rows'] / phase['seconds']:10.0f} rows/s" if phase['rows'] and phase['seconds'] else ' ' * 15
+            print(f"    {phase['name']:25s} {phase['seconds']:8.2f} s {phase['rows']:10d} rows {rate}"
+                  f" {phase['round_trips']:6d} round trips")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-d', '--database', action='store', default='stoqs_load_benchmark',
+                        help='Database to create (dropping it if it exists) and load (default=stoqs_load_benchmark)')
+    parser.add_argument('-n', '--points', action='store', type=int, default=100000,
+                        help='Number of time values in the trajectory and EPIC files, the mooring has a tenth'
+                             ' of them at 10 depths (default=100000)')
+    parser.add_argument('-r', '--repeat', action='store', type=int, default=3,
+                        help='Number of times to load each file, the fastest load is reported (default=3)')
+    parser.add_argument('--loaders', action='store', nargs='*',
+                        help='Benchmark only these loader classes, e.g. Trajectory_Loader Mooring_Loader')
+    parser.add_argument('--copy', action='store_true',
+                        help='Load with PostgreSQL COPY FROM STDIN in place of bulk_create(), as the load scripts --copy option')
+    parser.add_argument('--json', action='store',
+                        help='Write the reports to this file to compare with later runs')
+    args = parser.parse_args()
+
+    db = args.database
+    if db not in settings.DATABASES:
+        settings.DATABASES[db] = settings.DATABASES.get('default').copy()
+        settings.DATABASES[db]['NAME'] = db
+    create_database(db)
+
+    data_dir = tempfile.mkdtemp()
+    server, base_url = serve_opendap(data_dir)
+    try:
+        reports = benchmark(db, base_url, data_dir, args.points, args.repeat, args)
+    finally:
+        server.shutdown()
+        shutil.rmtree(data_dir)
+
+    print_reports(reports)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(OrderedDict((('points', args.points), ('copy', args.copy), ('reports', reports))), f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+
+'''
+Compare the time taken and the points kept by the pure Python simplify_points()
+and the NumPy douglas_peucker() on synthetic tracks like those of an AUV:
+a depth-time yo-yo and a meandering latitude-longitude track. To use:
+
+    ./benchmark_simplify.py                     # Million point tracks
+    ./benchmark_simplify.py -n 100000 --max_points 2000
+'''
+
+import argparse
+import os
+import sys
+from timeit import default_timer
+
+import numpy as np
+
+# Insert Django App directory (parent of utils) into python path
+sys.path.insert(0, os.path.abspath(os.path.join(
+                    os.path.dirname(__file__), "../")))
+
+from utils.utils import simplify_points
+from utils.simplify import douglas_peucker
+
+
+def depth_time_track(n, rs):
+    '''Return epoch milliseconds and depths of a 1 Hz yo-yo between 5 and 100 m with sensor noise
+    '''
+    ems = 1.5e12 + 1000.0 * np.arange(n)
+    phase = np.arange(n) / 600.0
+    depths = 52.5 + 47.5 * (2 * np.abs(phase - np.floor(phase + 0.5)) * 2 - 1) + rs.normal(0, 0.05, n)
+
+    return ems, depths
+
+
+def lon_lat_track(n, rs):
+    '''Return longitudes and latitudes of a random walk heading that meanders across Monterey Bay
+    '''
+    heading = np.cumsum(rs.normal(0, 0.01, n))
+    lons = -122.0 + np.cumsum(1e-5 * np.cos(heading))
+    lats = 36.8 + np.cumsum(1e-5 * np.sin(heading))
+
+    return lons, lats
+
+
+def benchmark(name, x, y, tolerance, max_points, skip_python):
+    print(f'{name}: {len(x)} points, tolerance = {tolerance}')
+    if not skip_python:
+        start = default_timer()
+        python_kept = [k for _, _, k in simplify_points(list(zip(x.tolist(), y.tolist())), tolerance)]
+        print(f'    simplify_points():  {default_timer() - start:8.2f} s, {len(python_kept)} points kept')
+
+    start = default_timer()
+    kept = douglas_peucker(x, y, tolerance)
+    print(f'    douglas_peucker():  {default_timer() - start:8.2f} s, {len(kept)} points kept')
+    if not skip_python and kept.tolist() != python_kept:
+        print(f'    {len(set(kept.tolist()) ^ set(python_kept))} points differ: simplify_points() measures'
+              ' distances only of points not behind the start of a segment')
+
+    if max_points:
+        start = default_timer()
+        kept = douglas_peucker(x, y, tolerance, max_points=max_points)
+        print(f'    douglas_peucker(max_points={max_points}): {default_timer() - start:8.2f} s, {len(kept)} points kept')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-n', '--points', action='store', type=int, default=1000000,
+                        help='Number of points in the synthetic tracks (default=1000000)')
+    parser.add_argument('--max_points', action='store', type=int,
+                        help='Also time douglas_peucker() with this budget of points')
+    parser.add_argument('--skip_python', action='store_true',
+                        help='Do not time simplify_points(), which may take minutes for a million points')
+    args = parser.parse_args()
+
+    rs = np.random.RandomState(0)
+    # Tolerances as used for SimpleDepthTime and for the Activity maptrack
+    benchmark('Depth-time', *depth_time_track(args.points, rs), 10, args.max_points, args.skip_python)
+    benchmark('Longitude-latitude', *lon_lat_track(args.points, rs), 0.001, args.max_points, args.skip_python)
+
+
+if __name__ == '__main__':
+    main()
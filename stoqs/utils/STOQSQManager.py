@@ -13,9 +13,11 @@ STOQS Query manager for building ajax responses to selections made for QueryUI
 '''
 
 from django.conf import settings
-from django.db import transaction
-from django.db.models import Q, Max, Min, Sum, Avg
+from django.core.cache import cache
+from django.db import connections, transaction
+from django.db.models import F, Q, Max, Min, Sum, Avg
 from django.db.models.sql import query
+from django.db.backends.utils import CursorWrapper
 from django.contrib.gis.db.models import Extent, Union
 from django.contrib.gis.geos import fromstr, MultiPoint
 from django.db.utils import DatabaseError, DataError
@@ -27,7 +29,10 @@ from loaders.SampleLoaders import SAMPLED, NETTOW, PLANKTONPUMP, ESP_ARCHIVE, sa
 from .utils import round_to_n, postgresifySQL, EPOCH_STRING, EPOCH_DATETIME
 from .utils import (getGet_Actual_Count, getShow_Sigmat_Parameter_Values, getShow_StandardName_Parameter_Values, 
                    getShow_All_Parameter_Values, getShow_Parameter_Platform_Data)
-from .utils import simplify_points, getParameterGroups
+from .utils import getParameterGroups, normalize_criteria
+from .simplify import simplify_line
+from .decimate import minmax_decimate, effective_stride, st_x, st_y
+from .rendercache import data_version
 from .geo import GPS
 from .MPQuery import MPQuery
 from .PQuery import PQuery
@@ -44,6 +49,13 @@ import time
 import os
 import tempfile
 import numpy as np
+import hashlib
+import json
+import threading
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FuturesTimeoutError
+from functools import partial
+from itertools import groupby
+from operator import itemgetter
 
 logger = logging.getLogger(__name__)
 
@@ -59,6 +71,72 @@ LATITUDE_UNITS = 'degrees_north'
 DEPTH_UNITS = 'm'
 TIME_UNITS = 'seconds since 1970-01-01'
 
+# Request items that select the Activities, Samples and ActivityParameters of the querysets all options use
+SELECTION_KEYS = ('sampledparametersgroup', 'measuredparametersgroup', 'parameterstandardname', 'platforms',
+                  'time', 'depth', 'mplabels')
+
+# Options whose results may be cached, with the request items other than SELECTION_KEYS that affect them
+CACHED_OPTIONS = {
+    'sampledparametersgroup': (),
+    'measuredparametersgroup': (),
+    'parameterminmax': ('parameterplot', 'cmin', 'cmax', 'cmincmax_lock'),
+    'platforms': ('ve',),
+    'time': (),
+    'depth': (),
+    'simpledepthtime': ('activitynames',),
+    'sampledepthtime': ('activitynames',),
+    'sampledurationsdepthtime': (),
+    'extent': (),
+    'activityparameterhistograms': ('showallparametervalues', 'showsigmatparametervalues', 'showstandardnameparametervalues'),
+    'parameterplatforms': (),
+}
+
+# Options whose functions share the MPQuery, PQuery and ParameterParameter objects of the STOQSQManager,
+# these are not generated concurrently with each other
+SERIAL_OPTIONS = ('counts', 'mpsql', 'spsql', 'parametertime', 'parameterplatformdatavaluepng', 'parameterparameterpng',
+                  'parameterparameterx3d', 'measuredparameterx3d', 'platformanimation')
+
+# Thread pools shared by all requests, by number of workers, so that the threads and database connections
+# of options generating concurrently are bounded however many requests there are
+_options_executors = {}
+_options_executors_lock = threading.Lock()
+
+
+def _options_executor(workers):
+    with _options_executors_lock:
+        if workers not in _options_executors:
+            _options_executors[workers] = ThreadPoolExecutor(max_workers=workers)
+
+        return _options_executors[workers]
+
+
+class OptionDeadlineExceeded(Exception):
+    pass
+
+
+class _DeadlineCursorWrapper(CursorWrapper):
+    '''Refuse statements once the time allowed for generating an option has passed
+    '''
+    def __init__(self, cursor, db, deadline):
+        super().__init__(cursor, db)
+        self.deadline = deadline
+
+    def _check(self):
+        if time.time() > self.deadline:
+            raise OptionDeadlineExceeded('Option not generated within its time allowed')
+
+    def callproc(self, procname, params=None):
+        self._check()
+        return super().callproc(procname, params)
+
+    def execute(self, sql, params=None):
+        self._check()
+        return super().execute(sql, params)
+
+    def executemany(self, sql, param_list):
+        self._check()
+        return super().executemany(sql, param_list)
+
 
 class STOQSQManager(object):
     '''
@@ -237,7 +315,7 @@ class STOQSQManager(object):
         corresponding JSON object should be trivial.
         '''
         
-        results = {}
+        calls = {}
         for k, v in list(self.options_functions.items()):
             logger.debug('k, v = %s, %s', k, v)
             if self.kwargs['only'] != []:
@@ -247,15 +325,127 @@ class STOQSQManager(object):
                 continue
 
             if k == 'measuredparametersgroup':
-                results[k] = v(MEASUREDINSITU)
+                calls[k] = partial(v, MEASUREDINSITU)
             elif k == 'sampledparametersgroup':
-                results[k] = v(SAMPLED)
+                calls[k] = partial(v, SAMPLED)
             else:
-                results[k] = v()
+                calls[k] = v
+
+        cache_timeout = getattr(settings, 'STOQS_OPTION_CACHE_TIMEOUT', 0)
+        cached = {}
+        cache_keys = {}
+        if cache_timeout:
+            version = data_version(self.dbname)
+            cache_keys = {k: self._optionCacheKey(k, version) for k in calls if k in CACHED_OPTIONS}
+            cached = cache.get_many(list(cache_keys.values()))
+            for k, key in cache_keys.items():
+                if key in cached:
+                    del calls[k]
+            logger.debug('Options from cache: %s', [k for k, key in cache_keys.items() if key in cached])
+
+        workers = getattr(settings, 'STOQS_OPTIONS_WORKERS', 0)
+        if workers:
+            results = self._generateOptionsConcurrently(calls, workers, getattr(settings, 'STOQS_OPTION_TIMEOUT', 60))
+        else:
+            results = {}
+            for k, call in calls.items():
+                results[k] = call()
+
+        if cache_timeout:
+            cache.set_many({cache_keys[k]: results[k] for k in calls if k in cache_keys and k in results}, cache_timeout)
+            results.update({k: cached[key] for k, key in cache_keys.items() if key in cached})
         
         ##logger.info('qs.query = %s', pprint.pformat(str(self.qs.query)))
         ##logger.info('results = %s', pprint.pformat(results))
         return results
+
+    def _optionCacheKey(self, option, version=None):
+        '''
+        Return cache key for option from a hash of the values of the request items that affect it,
+        normalized so that the order of set valued items and the form of empty values do not matter,
+        and of version, the data_version() of the database, so that options are generated again when
+        Activities are loaded.
+        '''
+        if version is None:
+            version = data_version(self.dbname)
+        criteria = {}
+        for k in SELECTION_KEYS + CACHED_OPTIONS[option]:
+            value = self.kwargs.get(k)
+            if value is None:
+                value = self.request.GET.getlist(k)
+            criteria[k] = value
+
+        digest = hashlib.sha1(json.dumps([normalize_criteria(criteria), version], sort_keys=True, default=str).encode()).hexdigest()
+
+        return f'stoqs_option:{self.dbname}:{option}:{digest}'
+
+    def _callOnWorkerConnection(self, k, call, timeout, started):
+        '''
+        Call an options function in a worker thread, which has its own connection to the database.
+        The connection's statement_timeout makes the database abandon a query that exceeds the budget
+        and no further queries are made once the budget is spent, so that an option making many queries
+        releases its thread and connection soon after it times out.
+        '''
+        started[k] = time.time()
+        connection = connections[self.dbname]
+        try:
+            with connection.cursor() as cursor:
+                cursor.execute('SET statement_timeout = %s', [int(timeout * 1000)])
+
+            # Instance attributes take the place of the methods BaseDatabaseWrapper uses to wrap cursors
+            connection.make_cursor = lambda cursor: _DeadlineCursorWrapper(cursor, connection, started[k] + timeout)
+            connection.make_debug_cursor = connection.make_cursor
+            return call()
+        finally:
+            for name in ('make_cursor', 'make_debug_cursor'):
+                connection.__dict__.pop(name, None)
+            connection.close()
+
+    def _generateOptionsConcurrently(self, calls, workers, timeout):
+        '''
+        Generate the options of calls with up to workers threads, those in SERIAL_OPTIONS share the
+        query state of this object and are generated one after another in this thread meanwhile.
+        An option not returned within timeout seconds of starting, or that fails, is left out of
+        the results and reported with the reason in the 'incomplete' dictionary of the results.
+        '''
+        results = {}
+        incomplete = {}
+        started = {}
+        executor = _options_executor(workers)
+        futures = {k: executor.submit(self._callOnWorkerConnection, k, call, timeout, started)
+                        for k, call in calls.items() if k not in SERIAL_OPTIONS}
+
+        try:
+            for k, call in calls.items():
+                if k in SERIAL_OPTIONS:
+                    results[k] = call()
+        except Exception:
+            # The shared pool need not generate the options of a failed request that have not started
+            for future in futures.values():
+                future.cancel()
+            raise
+
+        for k, future in futures.items():
+            while True:
+                try:
+                    results[k] = future.result(timeout=max(0, started.get(k, time.time()) + timeout - time.time()))
+                except FuturesTimeoutError:
+                    if k not in started and not future.cancel():
+                        # Began just now after waiting behind other options, allow it its budget
+                        continue
+                    # Not waited for, its thread is freed by the statement_timeout and the check before each
+                    # query, but an option spending its time in Python rather than queries holds it until done
+                    logger.warn('Option %s not generated within %s seconds', k, timeout)
+                    incomplete[k] = 'timeout'
+                except Exception as e:
+                    logger.exception('Option %s failed: %s', k, e)
+                    incomplete[k] = str(e)
+                break
+
+        if incomplete:
+            results['incomplete'] = incomplete
+
+        return results
     
     #
     # Methods that generate summary data, based on the current query criteria
@@ -947,10 +1137,10 @@ class STOQSQManager(object):
     #
     # The following set of private (_...) methods are for building the parametertime response
     #
-    def _collectParameters(self, platform, pt, pa_units, is_standard_name, ndCounts, strides, colors):
+    def _collectParameters(self, platform, pt, pa_units, is_standard_name, strides, colors):
         '''
         Get parameters for this platform and collect units in a parameter name hash, use standard_name if set and repair bad names.
-        Return a tuple of pa_units, is_standard_name, ndCounts, and pt dictionaries.
+        Return a tuple of pa_units, is_standard_name, pt, colors and strides dictionaries.
         '''
 
         # Get parameters for this platform and collect units in a parameter name hash, use standard_name if set and repair bad names
@@ -986,14 +1176,12 @@ class STOQSQManager(object):
                 logger.debug('Parameter name "%s" has standard_name = %s', parameter.name, parameter.standard_name)
                 pa_units[parameter.standard_name] = unit
                 is_standard_name[parameter.standard_name] = True
-                ndCounts[parameter.standard_name] = nds
                 colors[parameter.standard_name] = parameter.id
                 strides[parameter.standard_name] = {}
             else:
                 logger.debug('Parameter name "%s" does not have a standard_name', parameter.name)
                 pa_units[parameter.name] = unit
                 is_standard_name[parameter.name] = False
-                ndCounts[parameter.name] = nds
                 colors[parameter.name] = parameter.id
                 strides[parameter.name] = {}
 
@@ -1009,27 +1197,23 @@ class STOQSQManager(object):
                 pa_units['Longitude'] = LONGITUDE_UNITS
                 strides['Longitude'] = {}
                 is_standard_name['Longitude'] = False
-                ndCounts['Longitude'] = 1
             if 'Latitude' in self.kwargs['parametertimeplotcoord']:
                 pt[LATITUDE_UNITS] = {}
                 pa_units['Latitude'] = LATITUDE_UNITS
                 strides['Latitude'] = {}
                 is_standard_name['Latitude'] = False
-                ndCounts['Latitude'] = 1
             if 'Depth' in self.kwargs['parametertimeplotcoord']:
                 pt[DEPTH_UNITS] = {}
                 pa_units['Depth'] = DEPTH_UNITS
                 strides['Depth'] = {}
                 is_standard_name['Depth'] = False
-                ndCounts['Depth'] = 1
             if 'Time' in self.kwargs['parametertimeplotcoord']:
                 pt[TIME_UNITS] = {}
                 pa_units['Time'] = TIME_UNITS
                 strides['Time'] = {}
                 is_standard_name['Time'] = False
-                ndCounts['Time'] = 1
 
-        return (pa_units, is_standard_name, ndCounts, pt, colors, strides)
+        return (pa_units, is_standard_name, pt, colors, strides)
 
     def _get_activity_nominaldepths(self, p):
         '''Return hash of starting depths for parameter keyed by activity
@@ -1060,79 +1244,46 @@ class STOQSQManager(object):
 
         return plotTimeSeriesActivityDepths
 
-    def _append_coords_to_pt(self, qs_mp, pt, pa_units, a, stride, units_dict, strides):
+    def _append_coords_to_pt(self, qs_mp, pt, pa_units, a, buckets, units_dict, strides):
         '''
         Add coordinates to pt dictionary of dictionaries, making sure to append only once.
-        Only called if self.kwargs['parametertimeplotcoord'], and needs to be called once per request
-        '''
-        # Order by nominal depth first so that strided access collects data correctly from each depth
-        pt_qs_mp = qs_mp.order_by('measurement__nominallocation__depth', 'measurement__instantpoint__timevalue')[::stride]
+        Only called if self.kwargs['parametertimeplotcoord'], and needs to be called once per request.
+        Each coordinate is decimated in the database to its min and max in buckets time intervals.
+        '''
+        coords = (('Longitude', LONGITUDE_UNITS, st_x('measurement__geom')),
+                  ('Latitude', LATITUDE_UNITS, st_y('measurement__geom')),
+                  ('Depth', DEPTH_UNITS, F('measurement__depth')),
+                  ('Time', TIME_UNITS, F('measurement__instantpoint__timevalue')))
+        qs_mp = qs_mp.filter(datavalue__isnull=False)
         logger.debug(f'Adding coordinates for a.name = {a.name}')
-        for mp in pt_qs_mp:
-            if mp['datavalue'] is None:
+        for coord, units, value in coords:
+            if coord not in self.kwargs['parametertimeplotcoord']:
                 continue
 
-            tv = mp['measurement__instantpoint__timevalue']
-            ems = int(1000 * to_udunits(tv, 'seconds since 1970-01-01'))
-
-            if 'Longitude' in self.kwargs['parametertimeplotcoord']:
-                units = LONGITUDE_UNITS
-                an_nd = f"{units} - Longitude - {a.name}"
-                units_dict[units] = 'Longitude'
-                strides['Longitude'][a.name] = stride
-                try:
-                    pt[units][an_nd].append((ems, mp['measurement__geom'].x))
-                except KeyError:
-                    pt[units][an_nd] = []
-                    pt[units][an_nd].append((ems, mp['measurement__geom'].x))
-            if 'Latitude' in self.kwargs['parametertimeplotcoord']:
-                units = LATITUDE_UNITS
-                an_nd = f"{units} - Latitude - {a.name}"
-                units_dict[units] = 'Latitude'
-                strides['Latitude'][a.name] = stride
-                try:
-                    pt[units][an_nd].append((ems, mp['measurement__geom'].y))
-                except KeyError:
-                    pt[units][an_nd] = []
-                    pt[units][an_nd].append((ems, mp['measurement__geom'].y))
-            if 'Depth' in self.kwargs['parametertimeplotcoord']:
-                units = DEPTH_UNITS
-                an_nd = f"{units} - Depth - {a.name}"
-                units_dict[units] = 'Depth'
-                strides['Depth'][a.name] = stride
-                try:
-                    pt[units][an_nd].append((ems, mp['measurement__depth']))
-                except KeyError:
-                    pt[units][an_nd] = []
-                    pt[units][an_nd].append((ems, mp['measurement__depth']))
-            if 'Time' in self.kwargs['parametertimeplotcoord']:
-                units = TIME_UNITS
-                an_nd = f"{units} - Time - {a.name}"
-                units_dict[units] = 'Time'
-                strides['Time'][a.name] = stride
-                try:
-                    pt[units][an_nd].append((ems, ems))
-                except KeyError:
-                    pt[units][an_nd] = []
-                    pt[units][an_nd].append((ems, ems))
+            rows = minmax_decimate(qs_mp, value, buckets=buckets)
+            an_nd = f"{units} - {coord} - {a.name}"
+            units_dict[units] = coord
+            strides[coord][a.name] = effective_stride(rows)
+            if coord == 'Time':
+                pt[units].setdefault(an_nd, []).extend((ems, ems) for _, ems, _, _ in rows)
+            else:
+                pt[units].setdefault(an_nd, []).extend((ems, v) for _, ems, v, _ in rows)
 
         return pt, units_dict, strides
 
-    def _getParameterTimeFromMP(self, qs_mp, pt, pa_units, a, p, is_standard_name, stride, a_nds, units_dict, strides, save_mp_for_plot=True):
+    def _getParameterTimeFromMP(self, qs_mp, pt, pa_units, a, p, is_standard_name, buckets, a_nds, units_dict, strides, save_mp_for_plot=True):
         '''
-        Return hash of time series measuredparameter data with specified stride
+        Return hash of time series measuredparameter data for each nominal depth decimated in the database
+        to the min and max datavalues in buckets time intervals, with the effective stride in strides
         '''
-        # Order by nominal depth first so that strided access collects data correctly from each depth
-        pt_qs_mp = qs_mp.order_by('measurement__nominallocation__depth', 'measurement__instantpoint__timevalue')[::stride]
-        logger.debug('Adding time series of parameter = %s in key = %s', p, pa_units[p])
-        for mp in pt_qs_mp:
-            if mp['datavalue'] is None:
-                continue
+        if not save_mp_for_plot:
+            return pt, units_dict, strides
 
-            tv = mp['measurement__instantpoint__timevalue']
-            ems = int(1000 * to_udunits(tv, 'seconds since 1970-01-01'))
+        logger.debug('Adding time series of parameter = %s in key = %s', p, pa_units[p])
+        rows = minmax_decimate(qs_mp, 'datavalue', series='measurement__nominallocation__depth', buckets=buckets)
+        strides[p][a.name] = effective_stride(rows)
 
-            nd = mp['measurement__nominallocation__depth']
+        for nd, nd_rows in groupby(rows, key=itemgetter(0)):
             if nd:
                 an_nd = "%s - %s - %s @ %s" % (pa_units[p], p, a.name, nd,)
             elif a in a_nds:
@@ -1143,13 +1294,8 @@ class STOQSQManager(object):
                     an_nd = "%s - %s - %s starting @ ? m" % (pa_units[p], p, a.name)
             else:
                 an_nd = "%s - %s - %s" % (pa_units[p], p, a.name)
-   
-            if save_mp_for_plot: 
-                try:
-                    pt[pa_units[p]][an_nd].append((ems, mp['datavalue']))
-                except KeyError:
-                    pt[pa_units[p]][an_nd] = []
-                    pt[pa_units[p]][an_nd].append((ems, mp['datavalue']))
+
+            pt[pa_units[p]].setdefault(an_nd, []).extend((ems, dv) for _, ems, dv, _ in nd_rows)
 
         return pt, units_dict, strides
         
@@ -1198,7 +1344,7 @@ class STOQSQManager(object):
 
         return isInSelection 
 
-    def _buildParameterTime(self, pa_units, is_standard_name, ndCounts, pt, strides, pt_qs_mp):
+    def _buildParameterTime(self, pa_units, is_standard_name, pt, strides, pt_qs_mp):
         '''
         Build structure of timeseries/timeseriesprofile parameters organized by units
         '''
@@ -1257,8 +1403,6 @@ class STOQSQManager(object):
             logger.debug('--------------------p = %s, u = %s, is_standard_name[p] = %s', p, u, is_standard_name[p])
             
             # Select each time series by Activity and test against secondsperpixel for deciding on min & max or stride selection
-            if not ndCounts[p]:
-                ndCounts[p] = 1         # Trajectories with plotTimeSeriesDepth will not have a nominal depth, set to 1 for calculation below
             a_nds = self._get_activity_nominaldepths(p)
             for acount, a in enumerate(qs_awp.distinct('name')):
                 qs_mp_a = qs_mp.filter(measurement__instantpoint__activity__name=a.name)
@@ -1267,17 +1411,12 @@ class STOQSQManager(object):
                 logger.debug('a.name = %s, a.startdate = %s, a.enddate %s, aseconds = %s, secondsperpixel = %s', 
                              a.name, a.startdate, a.enddate, aseconds, secondsperpixel)
                 if float(aseconds) > float(secondsperpixel) or len(self.kwargs.get('platforms')) == 1:
-                    # Multiple points of this activity can be displayed in the flot, get an appropriate stride
-                    logger.debug('PIXELS_WIDE = %s, ndCounts[p] = %s', PIXELS_WIDE, ndCounts[p])
-                    stride = int(round(qs_mp_a.count() / PIXELS_WIDE / ndCounts[p]))
-                    if stride < 1:
-                        stride = 1
-                    logger.debug('Getting timeseries from MeasuredParameter table with stride = %s', stride)
-                    strides[p][a.name] = stride
-                    logger.debug('Adding timeseries for p = %s, a = %s', p, a)
-                    pt, units, strides = self._getParameterTimeFromMP(qs_mp_a, pt, pa_units, a, p, is_standard_name, stride, a_nds, units, strides, save_mp_for_plot)
+                    # Multiple points of this activity can be displayed in the flot, a min and max per pixel pair
+                    # of each series keeps the cost of the query independent of the number of MeasuredParameters
+                    logger.debug('Adding timeseries for p = %s, a = %s with %s buckets', p, a, PIXELS_WIDE // 2)
+                    pt, units, strides = self._getParameterTimeFromMP(qs_mp_a, pt, pa_units, a, p, is_standard_name, PIXELS_WIDE // 2, a_nds, units, strides, save_mp_for_plot)
                     if self.kwargs['parametertimeplotcoord'] and acount == 0 and pcount == 0:
-                        pt, units, strides = self._append_coords_to_pt(qs_mp, pt, pa_units, a, stride, units, strides)
+                        pt, units, strides = self._append_coords_to_pt(qs_mp, pt, pa_units, a, PIXELS_WIDE // 2, units, strides)
 
                 else:
                     # Construct just two points for this activity-parameter using the min & max from the AP table
@@ -1299,7 +1438,6 @@ class STOQSQManager(object):
         strides = {}
         pa_units = {}
         is_standard_name = {}
-        ndCounts = {}
         colors = {}
         counts = 0
 
@@ -1333,8 +1471,8 @@ class STOQSQManager(object):
                     if 'parametertime' in self.kwargs['only'] or self.kwargs['parametertab']:
                         # Initialize structure organized by units for parameters left in the selection 
                         logger.debug('Calling self._collectParameters() with platform = %s', platform)
-                        pa_units, is_standard_name, ndCounts, pt, colors, strides = self._collectParameters(platform, pt, 
-                                                                    pa_units, is_standard_name, ndCounts, strides, colors)
+                        pa_units, is_standard_name, pt, colors, strides = self._collectParameters(platform, pt, 
+                                                                    pa_units, is_standard_name, strides, colors)
                 logger.debug('Done, counts = {}'.format(counts))
   
         if pa_units: 
@@ -1347,7 +1485,7 @@ class STOQSQManager(object):
             pt_qs_mp = self.mpq.qs_mp_no_parm
 
             logger.debug('Before self._buildParameterTime: pt = %s', list(pt.keys())) 
-            pt, units, strides = self._buildParameterTime(pa_units, is_standard_name, ndCounts, pt, strides, pt_qs_mp)
+            pt, units, strides = self._buildParameterTime(pa_units, is_standard_name, pt, strides, pt_qs_mp)
             logger.debug('After self._buildParameterTime: pt = %s', list(pt.keys())) 
 
         return({'pt': pt, 'units': units, 'counts': counts, 'colors': colors, 'strides': strides})
@@ -1462,7 +1600,7 @@ class STOQSQManager(object):
                 else:
                     label = '%s %s' % (s[2], s[3],)                                 # Show entire Activity name & sample name
 
-                tdk = simplify_points(samp_depth_time_series, sample_simplify_crit)
+                tdk = simplify_line(samp_depth_time_series, sample_simplify_crit)
                 simple_series = [(t,d) for (t,d,_) in tdk]
                 sample_durations.append({'label': label, 'data': simple_series})
 
@@ -22,6 +22,8 @@ from django.db import connections, DatabaseError, transaction
 from datetime import datetime
 from stoqs import models
 from utils.utils import pearsonr, round_to_n, EPOCH_STRING
+from utils.sectiontiles import SectionPyramid
+from utils.rendercache import RenderCache
 from loaders.SampleLoaders import SAMPLED, NETTOW, VERTICALNETTOW, PLANKTONPUMP, ESP_ARCHIVE
 from loaders import MEASUREDINSITU, X3DPLATFORMMODEL, X3D_MODEL, X3D_MODEL_SCALEFACTOR
 import seawater.eos80 as sw
@@ -222,6 +224,7 @@ class MeasuredParameter(BaseParameter):
         self.contourParameterID = contourParameterID
         self.contourParameterGroups = contourParameterGroups
         self.scale_factor = None
+        self.renderCache = RenderCache('sections')
 
         # - Use a new imageID for each new image
         self.imageID = ''.join(random.choice(string.ascii_uppercase + string.digits) for x in range(10))
@@ -469,6 +472,37 @@ class MeasuredParameter(BaseParameter):
         return clt.colors[indx]
 
 
+    def _composeSection(self, parameterID, xi, yi):
+        '''
+        Return (zi, px, py) gridded values of parameterID at times xi (in seconds) and depths yi and the locations
+        of the measurements composed from the section tile pyramids of the Activities in the selection, or None
+        if the selection constrains data values or an Activity does not have a pyramid.
+        '''
+        if self.kwargs.get('parametervalues') or self.kwargs.get('mplabels'):
+            return None
+
+        acts = self.qs.filter(platform__name=self.platformName, activityparameter__parameter__id=parameterID,
+                              startdate__lte=datetime.fromtimestamp(xi[-1]), enddate__gte=datetime.fromtimestamp(xi[0]))
+        if self.kwargs.get('activitynames'):
+            acts = acts.filter(name__in=self.kwargs.get('activitynames'))
+
+        zi = np.full((len(yi), len(xi)), np.nan)
+        px = []
+        py = []
+        for activity_id in acts.values_list('id', flat=True).distinct():
+            pyramid = SectionPyramid.open(self.request.META['dbAlias'], activity_id, parameterID)
+            if not pyramid:
+                return None
+            azi, apx, apy = pyramid.sample(xi, yi)
+            zi = np.where(np.isnan(zi), azi, zi)
+            px.extend(apx)
+            py.extend(apy)
+
+        if self.scale_factor:
+            px = [x / self.scale_factor for x in px]
+
+        return zi, px, py
+
     def renderDatavaluesForFlot(self, tgrid_max=1000, dgrid_max=100, dinc=0.5, contourFlag=False):
         '''
         Produce a .png image without axes suitable for overlay on a Flot graphic. Return a
@@ -497,6 +531,19 @@ class MeasuredParameter(BaseParameter):
             return None, None, None
 
         sectionPngFileFullPath = os.path.join(settings.MEDIA_ROOT, 'sections', sectionPngFile)
+
+        # Identical plots requested by any user or session are rendered once
+        renderKey = None
+        if self.renderCache.enabled:
+            renderKey = self.renderCache.key(self.request.META['dbAlias'], 'section', self.kwargs,
+                                    parameter=(self.parameterID, self.contourParameterID, self.platformName),
+                                    parameterMinMax=self.parameterMinMax, cm=self.cm_name, num_colors=self.num_colors,
+                                    cmin=self.cmin, cmax=self.cmax,
+                                    full_screen=self.request.GET.get('full_screen'),
+                                    grid=(tgrid_max, dgrid_max, dinc, contourFlag))
+            cached = self.renderCache.get(renderKey)
+            if cached:
+                return cached['files']['.png'], cached['files'].get('_colorbar.png', ''), cached['strideInfo']
         
         # Estimate horizontal (time) grid spacing by number of points in selection, expecting that simplified depth-time
         # query has salient points, typically in the vertices of the yo-yos. 
@@ -570,38 +617,57 @@ class MeasuredParameter(BaseParameter):
                 # Silently ignore
                 pass
 
-            if not self.x and not self.y and not self.z and self.qs_mp is not None:
-                self.loadData(self.qs_mp)
-
-            # Copy x, y, z values for color plot (scatter or "contour")
-            cx = list(self.x)
-            cy = list(self.y)
-            cz = list(self.z)
-            self.logger.debug('Number of cx, cy, cz data values retrieved from database = %d', len(cz)) 
-
-            clx = []
-            cly = []
-            clz = []
-            if self.contourParameterID is not None:
-                self.x = []
-                self.y = []
-                self.z = []
-                self.loadData(self.contour_qs_mp)
-                # Copy x, y, z values for contour line plot
-                clx = list(self.x)
-                cly = list(self.y)
-                clz = list(self.z)
-                self.logger.debug('Number of clx, cly, clz data values retrieved from database = %d', len(clz)) 
-
             if 'showdataas' in self.kwargs:
                 if self.kwargs['showdataas']:
                     if self.kwargs['showdataas'][0] == 'contour':
                         contourFlag = True
-          
-            if len(cz) == 0 and len(clz) == 0:
-                return None, None, 'No data returned from selection'
 
-            if contourFlag:
+            # Contoured sections of in situ measurements are read from the tile pyramids built at load time if they exist
+            zi = None
+            zli = None
+            tiled = None
+            if contourFlag and SAMPLED not in self.parameterGroups and SAMPLED not in self.contourParameterGroups:
+                xi_seconds = xi * self.scale_factor if self.scale_factor else xi
+                tiled = {pid: self._composeSection(pid, xi_seconds, yi)
+                         for pid in (self.parameterID, self.contourParameterID) if pid is not None}
+                if None in tiled.values():
+                    tiled = None
+
+            if tiled:
+                zi, cx, cy = tiled.get(self.parameterID, (None, [], []))
+                zli, clx, cly = tiled.get(self.contourParameterID, (None, [], []))
+                self.strideInfo = ''
+                self.logger.debug('Composed section from tiles with %d and %d measurement locations', len(cx), len(clx))
+                if len(cx) == 0 and len(clx) == 0:
+                    return None, None, 'No data returned from selection'
+            else:
+                if not self.x and not self.y and not self.z and self.qs_mp is not None:
+                    self.loadData(self.qs_mp)
+
+                # Copy x, y, z values for color plot (scatter or "contour")
+                cx = list(self.x)
+                cy = list(self.y)
+                cz = list(self.z)
+                self.logger.debug('Number of cx, cy, cz data values retrieved from database = %d', len(cz)) 
+
+                clx = []
+                cly = []
+                clz = []
+                if self.contourParameterID is not None:
+                    self.x = []
+                    self.y = []
+                    self.z = []
+                    self.loadData(self.contour_qs_mp)
+                    # Copy x, y, z values for contour line plot
+                    clx = list(self.x)
+                    cly = list(self.y)
+                    clz = list(self.z)
+                    self.logger.debug('Number of clx, cly, clz data values retrieved from database = %d', len(clz)) 
+
+                if len(cz) == 0 and len(clz) == 0:
+                    return None, None, 'No data returned from selection'
+
+            if contourFlag and zi is None and self.parameterID is not None:
                 try:
                     self.logger.debug('Gridding data with sdt_count = %d, and y_count = %d', sdt_count, y_count)
                     # See https://scipy-cookbook.readthedocs.io/items/Matplotlib_Gridding_irregularly_spaced_data.html
@@ -615,7 +681,7 @@ class MeasuredParameter(BaseParameter):
 
                 self.logger.debug('zi = %s', zi)
 
-            if self.qs_mp is not None:
+            if self.qs_mp is not None and not contourFlag:
                 COLORED_DOT_SIZE_THRESHOLD = 5000
                 if self.qs_mp.count() > COLORED_DOT_SIZE_THRESHOLD:
                     coloredDotSize = 10
@@ -690,7 +756,8 @@ class MeasuredParameter(BaseParameter):
                         ax.plot(xs, ys, c='k', lw=3, alpha=0.5)
 
                 if self.contourParameterID is not None:
-                    zli = griddata((clx, cly), clz, (xi[None,:], yi[:,None]), method='cubic', rescale=True)
+                    if zli is None:
+                        zli = griddata((clx, cly), clz, (xi[None,:], yi[:,None]), method='cubic', rescale=True)
                     CS = ax.contour(xi, yi, zli, colors='white')
                     ax.clabel(CS, fontsize=9, inline=1)
 
@@ -710,6 +777,11 @@ class MeasuredParameter(BaseParameter):
                     self.logger.exception('%s', e)
                     return None, None, 'Could not plot the colormap'
 
+            if renderKey:
+                files = self.renderCache.store(renderKey, {'strideInfo': self.strideInfo},
+                                               {'.png': sectionPngFileFullPath, '_colorbar.png': self.colorbarPngFileFullPath})
+                return files['.png'], files.get('_colorbar.png', ''), self.strideInfo
+
             return sectionPngFile, self.colorbarPngFile, self.strideInfo
         else:
             self.logger.warn('xi and yi are None.  tmin, tmax, dmin, dmax = %s, %s, %s, %s', tmin, tmax, dmin, dmax)
@@ -832,6 +904,7 @@ class ParameterParameter(BaseParameter):
         self.pDict = pDict
         self.mpq = mpq
         self.pq = pq
+        self.renderCache = RenderCache('parameterparameter')
 
         self.pMinMax = pMinMax
         self.set_colormap()
@@ -1029,6 +1102,16 @@ class ParameterParameter(BaseParameter):
         pplrFlag = self.request.GET.get('pplr', False)
         ppfrFlag = self.request.GET.get('ppfr', False)
         ppslFlag = self.request.GET.get('ppsl', False)
+
+        # Identical plots requested by any user or session are rendered once
+        renderKey = None
+        if self.renderCache.enabled:
+            renderKey = self.renderCache.key(self.request.META['dbAlias'], 'parameterparameter', self.kwargs,
+                                    pDict=self.pDict, pMinMax=self.pMinMax, flags=(pplrFlag, ppfrFlag, ppslFlag),
+                                    cm=self.cm_name, num_colors=self.num_colors, cmin=self.cmin, cmax=self.cmax)
+            cached = self.renderCache.get(renderKey)
+            if cached:
+                return cached['files']['.png'], cached['infoText'], cached['sql']
      
         sql = ''
         try:
@@ -1199,6 +1282,10 @@ class ParameterParameter(BaseParameter):
 
         else:
             plt.close()
+            if renderKey:
+                files = self.renderCache.store(renderKey, {'infoText': infoText, 'sql': sql}, {'.png': ppPngFileFullPath})
+                return files['.png'], infoText, sql
+
             return ppPngFile, infoText, sql
 
     def makeX3D(self):
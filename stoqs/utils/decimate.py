@@ -0,0 +1,85 @@
+'''
+Database side decimation of MeasuredParameter time series for the
+parameter-time plot.
+
+Rather than counting the rows of a series and fetching every stride'th one,
+minmax_decimate() has PostgreSQL divide the time span of each series into a
+fixed number of buckets, about one per pixel pair of the plot, and return
+only the rows having the minimum and maximum value in each bucket.  Spikes
+that a stride would step over are kept, and no more than 2 * buckets rows per
+series cross the wire whether the series has 10 thousand or 10 million points.
+Window functions also give the number of rows in each series, so the
+effective stride can still be reported.
+'''
+
+import logging
+from django.db import connections
+from django.db.models import F, FloatField, Func, Value, IntegerField
+
+logger = logging.getLogger(__name__)
+
+# Columns of the queryset wrapped by minmax_sql()
+SERIES = 'dec_series'
+TIME = 'dec_time'
+VALUE = 'dec_value'
+
+
+def minmax_sql(sql, buckets):
+    '''Return SQL selecting (series, epoch milliseconds, value, rows in series) of the rows with
+    the minimum or maximum value in each of buckets equal time intervals of each series from
+    sql, which selects the columns SERIES, TIME and VALUE
+    '''
+    buckets = int(buckets)
+    return f'''SELECT {SERIES}, ems, {VALUE}, n FROM (
+                   SELECT {SERIES}, ems, {VALUE}, n,
+                          row_number() OVER (PARTITION BY {SERIES}, bucket ORDER BY {VALUE}, ems) AS rmin,
+                          row_number() OVER (PARTITION BY {SERIES}, bucket ORDER BY {VALUE} DESC, ems) AS rmax
+                   FROM (SELECT {SERIES}, ems, {VALUE}, n,
+                                LEAST(FLOOR((ems - lo) * {buckets}.0 / GREATEST(hi - lo, 1)), {buckets - 1}) AS bucket
+                         FROM (SELECT {SERIES}, ems, {VALUE},
+                                      MIN(ems) OVER s AS lo, MAX(ems) OVER s AS hi, COUNT(*) OVER s AS n
+                               FROM (SELECT {SERIES}, (EXTRACT(EPOCH FROM {TIME}) * 1000)::bigint AS ems, {VALUE}
+                                     FROM ({sql}) AS mp WHERE {VALUE} IS NOT NULL) AS t
+                               WINDOW s AS (PARTITION BY {SERIES})) AS r) AS b) AS w
+               WHERE rmin = 1 OR rmax = 1
+               ORDER BY {SERIES}, ems'''
+
+
+def st_x(field):
+    return Func(F(field), function='ST_X', output_field=FloatField())
+
+
+def st_y(field):
+    return Func(F(field), function='ST_Y', output_field=FloatField())
+
+
+def minmax_decimate(qs_mp, value, series=None, buckets=400):
+    '''Return list of (series, epoch milliseconds, value, rows in series) decimated from MeasuredParameter
+    queryset qs_mp.  value and series are field names or expressions, all rows are one series if series is None.
+    '''
+    if isinstance(value, str):
+        value = F(value)
+    if series is None:
+        series = Value(0, output_field=IntegerField())
+    elif isinstance(series, str):
+        series = F(series)
+
+    qs = qs_mp.order_by().values(**{SERIES: series, TIME: F('measurement__instantpoint__timevalue'), VALUE: value})
+    sql, params = qs.query.get_compiler(using=qs.db).as_sql()
+    with connections[qs.db].cursor() as cursor:
+        cursor.execute(minmax_sql(sql, buckets), params)
+        rows = cursor.fetchall()
+
+    logger.debug('Decimated to %d rows with stride %d', len(rows), effective_stride(rows))
+
+    return rows
+
+
+def effective_stride(rows):
+    '''Return the number of rows of the series decimated by minmax_decimate() per row in rows
+    '''
+    if not rows:
+        return 1
+    totals = {row[0]: row[3] for row in rows}
+
+    return max(1, int(round(sum(totals.values()) / len(rows))))
@@ -0,0 +1,140 @@
+'''
+Content addressed cache of the PNG images rendered for the Query UI.
+
+The depth-time section and parameter-parameter plots used to be saved under
+new random names for every request, so identical plots requested by other
+users or sessions were rendered again.  A RenderCache names the files of a
+plot after a hash of everything that determines it - the database, the
+normalized request items, the colormap, plot limits and a version of the
+data in the database - and saves them with the information returned with
+them, e.g. the stride or the regression text:
+
+    cache = RenderCache('sections')
+    key = cache.key(dbAlias, 'section', self.kwargs, cm=self.cm_name, ...)
+    cached = cache.get(key)
+    if cached:
+        return cached['files']['.png'], ...
+    ... render to pngFileFullPath ...
+    files = cache.store(key, {'strideInfo': strideInfo}, {'.png': pngFileFullPath})
+
+Files are moved into the cache before its metadata file is written, so a
+plot is served only when complete.  Reading a plot touches its metadata file
+and the least recently used plots are removed when the cache directory
+holds more than settings.STOQS_RENDER_CACHE_BYTES.
+'''
+
+import hashlib
+import json
+import logging
+import os
+import re
+from django.conf import settings
+from django.db.models import Count, Max
+from stoqs import models
+from .utils import normalize_criteria
+
+logger = logging.getLogger(__name__)
+
+# Request items that do not affect the plots
+IGNORED_KEYS = ('only', 'except', 'parametertab', 'secondsperpixel', 'updatefromzoom', 'x3dterrains', 'x3dplaybacks',
+                'resources', 'speedup', 'showgeox3dmeasurement', 'showgeox3dsample', 'showplatforms', 'geoorigin', 've')
+
+CACHED_FILE = re.compile(r'^[0-9a-f]{40}[._]')
+METADATA = '.json'
+
+
+def data_version(dbAlias):
+    '''Return values that change when Activities are loaded, appended to or deleted
+    '''
+    version = models.Activity.objects.using(dbAlias).aggregate(Count('id'), Max('id'), Max('enddate'))
+
+    return sorted((k, str(v)) for k, v in version.items())
+
+
+class RenderCache(object):
+    '''PNG files in directory subdir of MEDIA_ROOT named by the key of the plot
+    '''
+    def __init__(self, subdir, max_bytes=None):
+        self.directory = os.path.join(settings.MEDIA_ROOT, subdir)
+        self.max_bytes = settings.STOQS_RENDER_CACHE_BYTES if max_bytes is None else max_bytes
+
+    @property
+    def enabled(self):
+        return self.max_bytes > 0
+
+    def key(self, dbAlias, kind, kwargs, **extra):
+        '''Return hash of the kind of plot, the request items kwargs and extra items that determine it
+        '''
+        criteria = normalize_criteria({k: v for k, v in kwargs.items() if k not in IGNORED_KEYS})
+        parts = [dbAlias, kind, criteria, extra, data_version(dbAlias)]
+
+        return hashlib.sha1(json.dumps(parts, sort_keys=True, default=str).encode()).hexdigest()
+
+    def _path(self, name):
+        return os.path.join(self.directory, name)
+
+    def get(self, key):
+        '''Return the metadata saved with the plot of key, including its file names in 'files', None if not cached
+        '''
+        if not self.enabled:
+            return None
+        try:
+            with open(self._path(key + METADATA)) as f:
+                metadata = json.load(f)
+            if not all(os.path.exists(self._path(name)) for name in metadata['files'].values()):
+                return None
+            os.utime(self._path(key + METADATA))
+        except (OSError, ValueError, KeyError):
+            return None
+
+        logger.debug('Render cache hit for %s', key)
+
+        return metadata
+
+    def store(self, key, metadata, paths):
+        '''Move the rendered files of paths, a dictionary keyed by the suffix to give each, into the cache
+        as the plot of key, return dictionary of their new file names by suffix
+        '''
+        files = {suffix: key + suffix for suffix, path in paths.items() if path}
+        os.makedirs(self.directory, exist_ok=True)
+        for suffix, name in files.items():
+            os.replace(paths[suffix], self._path(name))
+
+        metadata = dict(metadata, files=files)
+        building = self._path(f'.{key}.{os.getpid()}{METADATA}')
+        with open(building, 'w') as f:
+            json.dump(metadata, f)
+        os.replace(building, self._path(key + METADATA))
+        self.evict()
+
+        return files
+
+    def evict(self):
+        '''Remove the least recently used plots until the cache holds no more than max_bytes
+        '''
+        plots = {}
+        for entry in os.scandir(self.directory):
+            if CACHED_FILE.match(entry.name):
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    continue
+                plot = plots.setdefault(entry.name[:40], {'bytes': 0, 'used': 0, 'names': []})
+                plot['bytes'] += stat.st_size
+                plot['names'].append(entry.name)
+                if entry.name.endswith(METADATA):
+                    # Touched when the plot is read, files without one are evicted first
+                    plot['used'] = stat.st_mtime
+
+        total = sum(plot['bytes'] for plot in plots.values())
+        for key, plot in sorted(plots.items(), key=lambda item: item[1]['used']):
+            if total <= self.max_bytes:
+                break
+            # Metadata first so that the plot is no longer served
+            for name in sorted(plot['names'], key=lambda name: not name.endswith(METADATA)):
+                try:
+                    os.remove(self._path(name))
+                except OSError:
+                    pass
+            total -= plot['bytes']
+            logger.debug('Evicted %s from render cache', key)
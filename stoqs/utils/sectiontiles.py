@@ -0,0 +1,224 @@
+'''
+Multi-resolution pyramids of gridded depth-time section values.
+
+MeasuredParameter.renderDatavaluesForFlot() in utils/Viz/plotting.py grids
+up to MP_MAX_POINTS measurements with griddata() for every contour section
+it draws.  A SectionPyramid holds the values of one Parameter of one Activity
+interpolated at load time onto grids of DEPTH_ROWS depths and successively
+doubled numbers of times: level 0 is a single tile of TILE_COLUMNS times
+spanning the Activity and level n has 2**n such tiles.  Each tile is saved
+as an .npz file with the locations of up to TILE_MAX_POINTS of the
+measurements within it, for drawing as dots.  A section is composed by
+reading the tiles of the coarsest level that resolves the requested time
+range and interpolating them onto the plot grid, so that zooming in reads
+a few tiles rather than interpolating the measurements again:
+
+    build_pyramid(dbAlias, activity, parameter)                 # At load time
+    pyramid = SectionPyramid.open(dbAlias, activity.id, parameter.id)
+    if pyramid:
+        zi, px, py = pyramid.sample(xi, yi)
+
+Times are in seconds as returned by time.mktime(), as plotting.py uses.
+
+Pyramids are saved by database, Activity id and Parameter id, ids that are
+reused when a database is reloaded.  The manifest of a pyramid holds a
+fingerprint of the data it was built from - the Activity's name, start and
+end and the number of MeasuredParameters - and open() returns None if that no
+longer matches the database, e.g. after an --append without --section_tiles,
+so that the section is gridded from the measurements instead.
+'''
+
+import json
+import logging
+import os
+import shutil
+import time
+from itertools import islice
+import numpy as np
+from django.conf import settings
+from scipy.interpolate import CloughTocher2DInterpolator, RegularGridInterpolator
+from stoqs import models
+
+logger = logging.getLogger(__name__)
+
+TILE_COLUMNS = 256              # Times in each tile, about a quarter of the width of the time-depth-flot plot
+DEPTH_ROWS = 100                # Depths in each tile, the dgrid_max of renderDatavaluesForFlot()
+MAX_LEVEL = 8                   # Finest level has at most 256 tiles
+TILE_MAX_POINTS = 2500          # Measurement locations saved with each tile
+BUILD_MAX_POINTS = 1000000      # Measurements interpolated to build a pyramid
+MANIFEST = 'pyramid.json'
+
+
+def pyramid_dir(dbAlias, activity_id, parameter_id):
+    return os.path.join(settings.MEDIA_ROOT, 'sectiontiles', dbAlias, f'{activity_id}_{parameter_id}')
+
+
+def remove_pyramids(dbAlias, activity_id):
+    '''Remove the pyramids of all of the Parameters of the Activity, e.g. when it is deleted
+    '''
+    directory = os.path.dirname(pyramid_dir(dbAlias, activity_id, 0))
+    prefix = f'{activity_id}_'
+    if os.path.isdir(directory):
+        for name in os.listdir(directory):
+            if name.startswith(prefix):
+                shutil.rmtree(os.path.join(directory, name), ignore_errors=True)
+
+
+def fingerprint(dbAlias, activity_id, parameter_id):
+    '''Return dictionary of values that change when the MeasuredParameters of the Parameter in the Activity
+    change or the Activity is replaced by another with the same id, None if there is no such Activity
+    '''
+    activity = models.Activity.objects.using(dbAlias).filter(id=activity_id).values('name', 'startdate', 'enddate').first()
+    if not activity:
+        return None
+    count = models.MeasuredParameter.objects.using(dbAlias).filter(measurement__instantpoint__activity_id=activity_id,
+                                                                   parameter_id=parameter_id).count()
+
+    return {'activity': activity['name'], 'startdate': str(activity['startdate']), 'enddate': str(activity['enddate']),
+            'measuredparameters': count}
+
+
+def pyramid_levels(n_times):
+    '''Return the number of levels for measurements at n_times distinct times, the finest level having
+    no more than half as many times as the measurements, as for the simpledepthtime estimate in plotting.py
+    '''
+    levels = 1
+    while levels <= MAX_LEVEL and TILE_COLUMNS * 2 ** levels <= n_times / 2:
+        levels += 1
+
+    return levels
+
+
+def write_pyramid(path, x, y, z, fingerprint=None):
+    '''Interpolate values z at times x and depths y onto the tiles of a pyramid saved in directory path,
+    with fingerprint of the data in its manifest, return the manifest or None if the measurements do not
+    span both time and depth
+    '''
+    x, y, z = (np.asarray(a, dtype=float) for a in (x, y, z))
+    if len(z) < 3 or x.min() == x.max() or y.min() == y.max():
+        return None
+
+    manifest = {'tmin': x.min(), 'tmax': x.max(), 'dmin': y.min(), 'dmax': y.max(),
+                'levels': pyramid_levels(len(np.unique(x))), 'columns': TILE_COLUMNS, 'rows': DEPTH_ROWS,
+                'fingerprint': fingerprint}
+    interpolator = CloughTocher2DInterpolator(np.column_stack((x, y)), z, rescale=True)
+    di = np.linspace(manifest['dmin'], manifest['dmax'], DEPTH_ROWS)
+
+    # Build in a temporary directory so that a pyramid is never read partially written
+    building = path + '.building'
+    shutil.rmtree(building, ignore_errors=True)
+    os.makedirs(building)
+    for level in range(manifest['levels']):
+        ti = np.linspace(manifest['tmin'], manifest['tmax'], TILE_COLUMNS * 2 ** level)
+        for index in range(2 ** level):
+            t = ti[index * TILE_COLUMNS:(index + 1) * TILE_COLUMNS]
+            end = ti[(index + 1) * TILE_COLUMNS] if (index + 1) * TILE_COLUMNS < len(ti) else np.inf
+            inside = np.flatnonzero((x >= t[0]) & (x < end))
+            inside = inside[::max(1, int(np.ceil(len(inside) / TILE_MAX_POINTS)))]
+            np.savez_compressed(os.path.join(building, f'{level}_{index}.npz'), t=t, d=di,
+                                z=interpolator(*np.meshgrid(t, di)).astype(np.float32), px=x[inside], py=y[inside])
+
+    with open(os.path.join(building, MANIFEST), 'w') as f:
+        json.dump(manifest, f)
+    shutil.rmtree(path, ignore_errors=True)
+    os.rename(building, path)
+
+    return manifest
+
+
+def build_pyramid(dbAlias, activity, parameter):
+    '''Build the pyramid of parameter's MeasuredParameters in activity, return its manifest or None if
+    there are not measurements to grid, in which case any pyramid built before is removed
+    '''
+    path = pyramid_dir(dbAlias, activity.id, parameter.id)
+    qs = (models.MeasuredParameter.objects.using(dbAlias)
+              .filter(measurement__instantpoint__activity=activity, parameter=parameter,
+                      datavalue__isnull=False, measurement__depth__isnull=False)
+              .order_by('measurement__instantpoint__timevalue')
+              .values_list('measurement__instantpoint__timevalue', 'measurement__depth', 'datavalue'))
+    stride = max(1, int(qs.count() / BUILD_MAX_POINTS))
+    rows = [(time.mktime(tv.timetuple()), depth, dv) for tv, depth, dv in islice(qs.iterator(), 0, None, stride)]
+    manifest = None
+    if rows:
+        x, y, z = zip(*rows)
+        logger.debug('Building section tiles of %s in %s from %d measurements', parameter.name, activity.name, len(z))
+        manifest = write_pyramid(path, x, y, z, fingerprint(dbAlias, activity.id, parameter.id))
+    if not manifest:
+        shutil.rmtree(path, ignore_errors=True)
+
+    return manifest
+
+
+class SectionPyramid(object):
+    '''Read access to the tiles of a pyramid written by write_pyramid()
+    '''
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, MANIFEST)) as f:
+            self.manifest = json.load(f)
+
+    @classmethod
+    def open(cls, dbAlias, activity_id, parameter_id):
+        '''Return the SectionPyramid of the Activity and Parameter, None if one has not been built from the
+        data now in the database
+        '''
+        path = pyramid_dir(dbAlias, activity_id, parameter_id)
+        if not os.path.exists(os.path.join(path, MANIFEST)):
+            return None
+
+        pyramid = cls(path)
+        if pyramid.manifest.get('fingerprint') != fingerprint(dbAlias, activity_id, parameter_id):
+            logger.info(f'Section tiles in {path} were built from other data than is in {dbAlias}, not using them')
+            return None
+
+        return pyramid
+
+    def _spacing(self, level):
+        return (self.manifest['tmax'] - self.manifest['tmin']) / (self.manifest['columns'] * 2 ** level - 1)
+
+    def level_for(self, tmin, tmax, columns):
+        '''Return the coarsest level with time spacing no greater than that of columns times from tmin to tmax
+        '''
+        wanted = (tmax - tmin) / max(columns - 1, 1)
+        for level in range(self.manifest['levels']):
+            if self._spacing(level) <= wanted:
+                return level
+
+        return self.manifest['levels'] - 1
+
+    def read(self, tmin, tmax, columns):
+        '''Return (times, depths, values, point times, point depths) of the tiles at the level for
+        columns times that overlap tmin to tmax, None if none do
+        '''
+        if tmax < self.manifest['tmin'] or tmin > self.manifest['tmax']:
+            return None
+
+        level = self.level_for(tmin, tmax, columns)
+        tile_seconds = self._spacing(level) * self.manifest['columns']
+        first, last = (min(2 ** level - 1, max(0, int((t - self.manifest['tmin']) // tile_seconds)))
+                       for t in (tmin, tmax))
+        tiles = []
+        for index in range(first, last + 1):
+            with np.load(os.path.join(self.path, f'{level}_{index}.npz')) as tile:
+                tiles.append({name: tile[name] for name in ('t', 'd', 'z', 'px', 'py')})
+
+        return (np.concatenate([tile['t'] for tile in tiles]), tiles[0]['d'],
+                np.concatenate([tile['z'] for tile in tiles], axis=1),
+                np.concatenate([tile['px'] for tile in tiles]), np.concatenate([tile['py'] for tile in tiles]))
+
+    def sample(self, xi, yi):
+        '''Return (values on the grid of times xi and depths yi, NaN where there are none, and the times
+        and depths of the measurements within xi)
+        '''
+        zi = np.full((len(yi), len(xi)), np.nan)
+        tiles = self.read(xi[0], xi[-1], len(xi))
+        if tiles is None:
+            return zi, np.array([]), np.array([])
+
+        t, d, z, px, py = tiles
+        interpolator = RegularGridInterpolator((d, t), z, bounds_error=False, fill_value=np.nan)
+        ygrid, xgrid = np.meshgrid(yi, xi, indexing='ij')
+        zi = interpolator(np.column_stack((ygrid.ravel(), xgrid.ravel()))).reshape(zi.shape)
+        inside = (px >= xi[0]) & (px <= xi[-1])
+
+        return zi, px[inside], py[inside]
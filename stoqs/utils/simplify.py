@@ -0,0 +1,99 @@
+'''
+Douglas-Peucker line simplification with NumPy, for full resolution time
+series (e.g. the depth or bottom depth of an AUV) and tracks.
+
+simplify_points() from utils.utils compares every point of a segment with
+it in a Python loop, too slow for more than about 1e5 points.  Here the
+distances of all of the points of a segment are computed with one set of
+array operations and segments are split in order of their greatest distance,
+which allows a budget of max_points to be set as well as a tolerance, then
+the max_points most significant points are kept.  simplify_points() does not
+measure the distance of a point that lies behind the start of its segment, so
+it may drop such a point even if it is further than tolerance from the line;
+here every point is measured.  The points kept are the same for series such as
+depth against epoch milliseconds, where steps in x are long compared with
+changes in y, but may differ for tracks, whose x values repeat and turn back.
+See tools/benchmark_simplify.py for a comparison of the two.
+'''
+
+import heapq
+import logging
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+def _segment_distances(x, y, anchor, floater):
+    '''Return distances of the points between anchor and floater from the segment joining them,
+    the distance to the nearer end for points not alongside the segment
+    '''
+    px = x[anchor + 1:floater] - x[anchor]
+    py = y[anchor + 1:floater] - y[anchor]
+    sx = x[floater] - x[anchor]
+    sy = y[floater] - y[anchor]
+    seg_len2 = sx * sx + sy * sy
+    if seg_len2 == 0.0:
+        return np.hypot(px, py)
+
+    proj = np.clip((px * sx + py * sy) / seg_len2, 0.0, 1.0)
+
+    return np.hypot(px - proj * sx, py - proj * sy)
+
+
+def douglas_peucker(x, y, tolerance=0.0, max_points=None):
+    '''Return sorted array of the indices of the points of the line x, y kept by Douglas-Peucker
+    simplification: no point removed is further than tolerance from the simplified line.  If
+    max_points is given no more than max_points (at least 2) points are kept.
+    '''
+    x = np.asarray(x, dtype='float64')
+    y = np.asarray(y, dtype='float64')
+    n = len(x)
+    if n < 3:
+        return np.arange(n)
+
+    max_points = max(max_points or n, 2)
+    keep = np.zeros(n, dtype=bool)
+    keep[[0, n - 1]] = True
+    num_kept = 2
+
+    # Heap of (-greatest distance, anchor, floater, index of farthest point) of segments to split
+    segments = []
+    def push(anchor, floater):
+        if floater - anchor > 1:
+            distances = _segment_distances(x, y, anchor, floater)
+            farthest = int(np.argmax(distances))
+            heapq.heappush(segments, (-distances[farthest], anchor, floater, anchor + 1 + farthest))
+
+    push(0, n - 1)
+    while segments and num_kept < max_points:
+        distance, anchor, floater, farthest = heapq.heappop(segments)
+        if -distance <= tolerance:
+            break
+        keep[farthest] = True
+        num_kept += 1
+        push(anchor, farthest)
+        push(farthest, floater)
+
+    return np.flatnonzero(keep)
+
+
+def simplify_line(pts, tolerance, max_points=None):
+    '''Replacement for simplify_points(): return list of (x, y, index) for the points kept from pts,
+    a list of (x, y) tuples.  Points simplify_points() drops without measuring their distance may be kept.
+    '''
+    if not pts:
+        return []
+    x, y = (np.array(c, dtype='float64') for c in zip(*pts))
+
+    return [pts[i] + (i,) for i in douglas_peucker(x, y, tolerance, max_points).tolist()]
+
+
+def simplify_series(x, y, tolerance, max_points=None):
+    '''Return indices into x and y of the points of the simplified line.  Points
+    must be in order of x, NaN values of y are not included.
+    '''
+    x = np.asarray(x, dtype='float64')
+    y = np.asarray(y, dtype='float64')
+    good = np.flatnonzero(~np.isnan(y))
+
+    return good[douglas_peucker(x[good], y[good], tolerance, max_points)]
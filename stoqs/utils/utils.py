@@ -107,6 +107,30 @@ def getShow_Parameter_Platform_Data(kwargs):
 # General utility methods called by STOQSQueryManager, MPQuery, etc.
 #
 
+# Request items whose list values are in an order that matters, e.g. start and end time
+POSITIONAL_KEYS = ('time', 'depth', 'parameterplot', 'parametercontourplot', 'flotlimits', 'parameterparameter')
+
+def normalize_criteria(criteria, positional=POSITIONAL_KEYS):
+    '''
+    Return copy of dictionary of request items for use in cache keys, normalized so that the order of
+    set valued items and the form of empty values do not matter.  Items in positional keep their order.
+    '''
+    normalized = {}
+    for k, value in criteria.items():
+        if isinstance(value, (list, tuple)):
+            if k in positional:
+                value = [str(v) if v not in (None, '') else None for v in value]
+            else:
+                value = sorted(str(v) for v in value if v not in (None, ''))
+            if not any(v is not None for v in value):
+                value = None
+        elif value in ('', 0, False):
+            value = None
+        if value is not None:
+            normalized[k] = value
+
+    return normalized
+
 def getParameterGroups(dbAlias, parameter=None):
     '''
     Return list of ParameterGroups that parameter belongs to
@@ -111,6 +111,9 @@ echo "Unit tests..."
 DATABASE_URL=$DATABASE_SUPERUSER_URL
 coverage run -a --source=utils,stoqs manage.py test stoqs.tests.unit_tests --settings=config.settings.ci
 unit_tests_status=$?
+echo "Loader unit tests..."
+coverage run -a --source=utils,stoqs manage.py test stoqs.tests.loader_unit_tests --settings=config.settings.ci
+unit_tests_status=$(($unit_tests_status + $?))
 
 # MAPSERVER_DATABASE_URL needs to use postgres role for proper mapfile CONNECTION settings
 MAPSERVER_DATABASE_URL="postgis://stoqsadm:$1@127.0.0.1:$PGPORT/stoqs"